@@ -12,7 +12,12 @@ import os
 import fitsio
 from fitsio import FITS,FITSHDR
 from SaclayMocks import box
+from SaclayMocks import boxio
+from SaclayMocks import boxstats
 from SaclayMocks import constant
+from SaclayMocks import cosmology
+from SaclayMocks import manifest
+from SaclayMocks import qso
 from SaclayMocks import util
 import argparse
 from time import time
@@ -111,6 +116,14 @@ def main():
     parser.add_argument("-seed", type=int, help="specify a seed", default=None)
     parser.add_argument("-rsd", help="If True, rsd are added, default True", default='True')
     parser.add_argument("-dgrowthfile", help="dD/dz file, default etc/dgrowth.fits", default=None)
+    parser.add_argument("-wait", type=str, help="If True, wait for make_boxes.py to write the boxes of the slice (see SaclayMocks.manifest), default False", default='False')
+    parser.add_argument("-wait_timeout", type=float, help="maximum waiting time in s with -wait True, default None: no limit", default=None)
+    parser.add_argument("-run_id", help="with -wait True, only read the boxes of the make_boxes.py run with this -run_id, default None: any run", default=None)
+    parser.add_argument("-sampler", help="fused: numba kernels on blocks of z-planes (SaclayMocks.qso), legacy: loop on z-planes, default fused", default='fused', choices=['fused', 'legacy'])
+    parser.add_argument("-nzblock", type=int, help="number of z-planes per block of the fused sampler, default 16", default=16)
+    parser.add_argument("-draw", help="draw of the fused sampler: bernoulli (one object at most per cell, as the legacy sampler) or poisson (Poisson number of objects per cell), default bernoulli", default='bernoulli', choices=['bernoulli', 'poisson'])
+    parser.add_argument("-sparse", type=float, help="the fused sampler uses geometric skipping in the z-planes where the probability of a cell is below sparse (bernoulli only), default 0.1", default=0.1)
+    parser.add_argument("-full_stats", type=str, help="If True, the fused sampler computes the statistics of the QSO density (expected number of QSO, max, saturated cells) in all the cells, also in the z-planes drawn by geometric skipping (slower), default False", default='False')
     args = parser.parse_args()
     zmin = args.zmin
     zmax = args.zmax
@@ -158,17 +171,27 @@ def main():
     if args.zfix is not None:
         print("Redshift has been fixed to {}".format(args.zfix))
 
-    #........................................   read box.fits header
-    boxfits = fitsio.FITS(args.indir+"/boxln_1-{}.fits".format(i_slice))
-    head = boxfits[0].read_header()
+    #........................................   read box header
+    if util.str2bool(args.wait):
+        names = ['boxln_1']
+        if not random_cond:
+            names += ['boxln_2', 'boxln_3']
+            if rsd:
+                names += ['vx', 'vy', 'vz']
+        manifest.Manifest(args.indir).wait_slice(names, i_slice, args.Nslice, timeout=args.wait_timeout, run=args.run_id)
+    # boxes are read from the fits files or the hdf5 store, see SaclayMocks.boxio
+    boxreader = boxio.BoxReader(args.indir, "boxln_1")
     Nslice = args.Nslice
-    DX = head["DX"]
-    DY = head["DY"]
-    DZ = head["DZ"]
-    NZ = head["NAXIS1"]
-    NY = head["NAXIS2"]
-    NX = head["NAXIS3"]
-    NX_fullbox = head["NX"]
+    DX = boxreader.DX
+    DY = boxreader.DY
+    DZ = boxreader.DZ
+    NZ = boxreader.NZ
+    NY = boxreader.NY
+    NX_fullbox = boxreader.NX
+    # x-planes [ix0:ix1] of the slice, as read by BoxReader.read_slice:
+    # the slices of a box can have different widths
+    ix0 = i_slice*NX_fullbox//Nslice
+    NX = (i_slice+1)*NX_fullbox//Nslice - ix0
 
     print("Treating: slice = {} ; Nslice = {}\n".format(i_slice, Nslice))
     # out_file = args.out
@@ -181,26 +204,35 @@ def main():
         # p1,2,3 are first the lognormal field boxes
         # at the end, we draw the QSO with a probability ~ f(p1, p2, p3)
         t0=time()
-        p1 = boxfits[0].read()
-        boxfits.close()
-        p2 = fitsio.read(args.indir+"/boxln_2-{}.fits".format(i_slice), ext=0)
-        p3 = fitsio.read(args.indir+"/boxln_3-{}.fits".format(i_slice), ext=0)
+        p = []
+        moments = []
+        for reader in [boxreader, boxio.BoxReader(args.indir, "boxln_2"), boxio.BoxReader(args.indir, "boxln_3")]:
+            p.append(reader.read_slice(i_slice, Nslice))
+            # moments from the box headers if available, otherwise in one pass
+            m = reader.slice_moments(i_slice, Nslice)
+            if m is None:
+                m = boxstats.merge(boxstats.plane_moments(p[-1]))
+            moments.append(m)
+        p1, p2, p3 = p
+        del p
+        NX = p1.shape[0]
         t1=time()
         print("read boxes in {} s, shape: {}".format(t1-t0,p1.shape))
-        sigma_p_1 = np.std(p1)
-        sigma_p_2 = np.std(p2)
-        sigma_p_3 = np.std(p3)
-        sigma_p_tot = np.std([p1, p2, p3])
+        sigma_p_1 = moments[0].sigma
+        sigma_p_2 = moments[1].sigma
+        sigma_p_3 = moments[2].sigma
+        sigma_p_tot = boxstats.merge(moments).sigma
         print("sigma(rho)=", sigma_p_tot, sigma_p_1, sigma_p_2, sigma_p_3)
-        # take exponential of each field
-        np.exp(p1, p1)
-        np.exp(p2, p2)
-        np.exp(p3, p3)
+        if args.sampler == 'legacy':
+            # take exponential of each field
+            np.exp(p1, p1)
+            np.exp(p2, p2)
+            np.exp(p3, p3)
         if rsd:
             print("Reading velocity boxes...")
-            vx = fitsio.read(args.indir+"/vx-{}.fits".format(i_slice), ext=0)
-            vy = fitsio.read(args.indir+"/vy-{}.fits".format(i_slice), ext=0)
-            vz = fitsio.read(args.indir+"/vz-{}.fits".format(i_slice), ext=0)
+            vx = boxio.BoxReader(args.indir, "vx").read_slice(i_slice, Nslice)
+            vy = boxio.BoxReader(args.indir, "vy").read_slice(i_slice, Nslice)
+            vz = boxio.BoxReader(args.indir, "vz").read_slice(i_slice, Nslice)
 
     LX = NX * DX
     LX_fullbox = NX_fullbox * DX
@@ -214,10 +246,10 @@ def main():
     z_of_R = cosmo_fid.r_2_z
 
     R0 = h * R_of_z(z0)
-    x_axis = (sp.arange(NX)+0.5)*DX + (2*i_slice-Nslice) * LX_fullbox/(2*Nslice)
-    y_axis = (sp.arange(NY)+0.5)*DY - LY/2
-    z_axis = (sp.arange(NZ)+0.5)*DZ + R0 - LZ/2     # Z at cell center
-    z_edges = sp.arange(NZ+1)*DZ + R0 - LZ/2        # Z at edges
+    x_axis = (np.arange(ix0, ix0+NX)+0.5)*DX - LX_fullbox/2
+    y_axis = (np.arange(NY)+0.5)*DY - LY/2
+    z_axis = (np.arange(NZ)+0.5)*DZ + R0 - LZ/2     # Z at cell center
+    z_edges = np.arange(NZ+1)*DZ + R0 - LZ/2        # Z at edges
     dz = z_of_R(z_edges[1:]/h) - z_of_R(z_edges[0:-1]/h)   #  z_of_R[m+1] - z_of_R[m]
 
     # add z dependence
@@ -225,8 +257,9 @@ def main():
     # we build p12 and p23 which are the interpolation of p1, p2 and p2, p3
     # we then build the probability ptot = c*p12 + (1-c)*p23
     # where c is a coefficient, store in etc/qso_lognormal_coef.txt
+    # the fused sampler computes ptot plane by plane, only in the z-blocks
+    # it draws, from 1D tables of the a(z) exponents and interpolation weights
     if not random_cond:
-        print("Computing exp(a(z)*g) for the 3 lognormal fields and interpolating...")
         t3 = time()
         z1 = constant.z_QSO_bias_1
         z2 = constant.z_QSO_bias_2
@@ -234,6 +267,8 @@ def main():
         qso_lognormal_coef = util.qso_lognormal_coef()
         rho_sum = constant.rho_sum
         print("rho_sum = {} ; {} s".format(rho_sum, time()-t3))
+    if not random_cond and args.sampler == 'legacy':
+        print("Computing exp(a(z)*g) for the 3 lognormal fields and interpolating...")
         # apply a(z): P = exp(delta)**a(z) for each lognormal
         z_box = z_of_R(np.sqrt((x_axis**2).reshape(-1,1,1) +
                     (y_axis**2).reshape(-1,1) + z_axis**2)/h)  # (NX,NY,NZ)
@@ -250,6 +285,16 @@ def main():
         gc.collect()
         print("Interpolations done. {} s".format(time() - t3))
 
+    if not random_cond:
+        def density_correction(redshift):
+            '''<ptot> / rho_sum at redshift: z dependence of cond1 due to a(z)'''
+            c = qso_lognormal_coef(redshift)
+            e1 = np.exp((util.qso_a_of_z(redshift, z1)*sigma_p_1)**2/2)
+            e2 = np.exp((util.qso_a_of_z(redshift, z2)*sigma_p_2)**2/2)
+            e3 = np.exp((util.qso_a_of_z(redshift, z3)*sigma_p_3)**2/2)
+            return (c*(e1*(z2-redshift)/(z2-z1) + e2*(redshift-z1)/(z2-z1))
+                    + (1-c)*(e2*(z3-redshift)/(z3-z2) + e3*(redshift-z2)/(z3-z2)))
+
     # margin of dmax cells
     print(LX,LY,LZ,R0,dmax*DX) # prov
     Rmin,Rmax,tanx_max,tany_max = box.box_limit(LX_fullbox,LY,LZ,R0,dmax*DX)
@@ -311,16 +356,7 @@ def main():
 
     mmm = (dz_interp>z_min) & (dz_interp<z_max)
     if not random_cond:
-        mean_rho_interp = dn_cell[mmm] / (
-            qso_lognormal_coef(dz_interp[mmm])*(
-            np.exp((util.qso_a_of_z(dz_interp[mmm], z1)*sigma_p_1)**2/2)*(z2-dz_interp[mmm])/(z2-z1) +
-            np.exp((util.qso_a_of_z(dz_interp[mmm], z2)*sigma_p_2)**2/2)*(dz_interp[mmm]-z1)/(z2-z1)
-            )
-            + (1-qso_lognormal_coef(dz_interp[mmm]))*(
-            np.exp((util.qso_a_of_z(dz_interp[mmm], z2)*sigma_p_2)**2/2)*(z3-dz_interp[mmm])/(z3-z2) +
-            np.exp((util.qso_a_of_z(dz_interp[mmm], z3)*sigma_p_3)**2/2)*(dz_interp[mmm]-z2)/(z3-z2)
-            )
-            )
+        mean_rho_interp = dn_cell[mmm] / density_correction(dz_interp[mmm])
         density_max = np.max(mean_rho_interp)
         density_mean = np.mean(mean_rho_interp)
     else:
@@ -333,7 +369,9 @@ def main():
     print("dN per cell max: {} ;  mean: {}".format(density_max, density_mean))
     dn_cell = np.append(dn_cell, np.zeros(10*NZ))  # artificially increasing dNdz range
 
-    if (drawPlot) :
+    if drawPlot and args.sampler == 'fused':
+        print("drawPlot: no histogram of ptot with the fused sampler, which does not build it")
+    elif (drawPlot) :
         hrho , hh = np.histogram(rho,100)
         plt.plot(hrho)
         plt.hist(ptot.reshape(np.size(ptot)),1000)
@@ -342,7 +380,6 @@ def main():
         plt.show()
 
     if (not random_cond):
-        rho_max = ptot.max()
         # rho_sum = ptot.sum()
         kk = nQSOexp / rho_sum
         norm = nQSOexp / rho_sum    # corresponds to cond1
@@ -362,6 +399,8 @@ def main():
         # gives ~4% more QSO than expected
         # this is due to the fact that the 3 cond are not independent
 
+    if not random_cond and args.sampler == 'legacy':
+        rho_max = ptot.max()
         print("exp(rho) max and sum = ",rho_max,rho_sum)
         print("k exp(rho_max) =",kk*rho_max)
         if (kk*rho_max>1):
@@ -391,115 +430,52 @@ def main():
         names = ["Z", "RA", "DEC", "HDU", "THING_ID", "PLATE", "MJD", "FIBERID", "PMF", "XX", "YY", "ZZ"] # , "XGRID", "YGRID", "ZGRID"]
 
     t4 = time()
-    for mz in range(NZ):
-        XX = x_axis
-        YY = y_axis
-        XY2 = (XX*XX).reshape(-1,1) + YY*YY    # broadcasting -> (NX,NY)
-        ZZ = z_axis[mz]
-        RR = np.sqrt(ZZ*ZZ + XY2)
-        if args.zfix is  None:
-            redshift = z_of_R(RR/h)
-        else:
-            redshift = args.zfix*np.ones_like(RR)
-        delta_z = dz_interp[1] - dz_interp[0]
-        iz = ((redshift - dz_interp[0]) / delta_z).round().astype(int)
-        density = dn_cell[iz]
-        # correct the z dependence in cond1 (due to a(z))
+    if args.sampler == 'fused':
+        # z(R) with R in Mpc/h, a(z) correction of cond1 and dD/dz as 1D tables
+        zR = cosmology.rescale(cosmo_fid.z_table, h)
+        lognormal = None
+        corr = None
+        growth = None
         if not random_cond:
-            density /= (qso_lognormal_coef(redshift)*(
-            np.exp((util.qso_a_of_z(redshift, z1)*sigma_p_1)**2/2)*(z2-redshift)/(z2-z1) +
-            np.exp((util.qso_a_of_z(redshift, z2)*sigma_p_2)**2/2)*(redshift-z1)/(z2-z1)
-            )
-            + (1-qso_lognormal_coef(redshift))*(
-            np.exp((util.qso_a_of_z(redshift, z2)*sigma_p_2)**2/2)*(z3-redshift)/(z3-z2) +
-            np.exp((util.qso_a_of_z(redshift, z3)*sigma_p_3)**2/2)*(redshift-z2)/(z3-z2)
-            )
-            )
-
-        # ==> should correct for the fact that   rnd1 < exp(rho)   not always true
-        #  use reproducible random <==
-        rnd1 = sp.random.ranf(size=(NX,NY))        #  float64
-        if (not random_cond):
-            cond1 = rnd1 < norm * ptot[:, :, mz]  # (NX,NY)
-            # should be a Poisson of norm * np.exp(rho)  <==
-            # sometime get 2 QSO in a cell
-            nnQSO += np.size(np.where(cond1)[0])
-        else:
-            cond1 = rnd1 > (1. - constant.rand_qso_nb)
-
-        cond2 = density_max * sp.random.ranf(size=(NX,NY)) < density    # (NX,NY)
-
-        # Draw random xyz in the cell
-        XX = XX + np.random.uniform(-DX/2, DX/2, size=len(XX))
-        YY = YY + np.random.uniform(-DY/2, DY/2, size=len(YY))
-
-        XXX = XX.reshape(-1, 1) * np.ones(NY)  # (NX, NY)
-        YYY = np.ones(NX).reshape(-1, 1) * YY
-        ZZZ = ZZ + np.random.uniform(-DZ/2, DZ/2, size=[len(XX), len(YY)])
-        ra, dec, RR = box.ComputeRaDecR2(XXX, YYY, ZZZ, np.radians(ra0), np.radians(dec0))
-        ra = np.degrees(ra)
-        dec = np.degrees(dec)
-        if args.zfix is None:
-            redshift = z_of_R(RR/h)
+            lognormal = qso.lognormal_table(z1, z2, z3)
+            corr = qso.tabulate(density_correction, 0, 10)
+            growth = qso.tabulate(lambda z: Dgrowth.interp(z)/dgrowth0, Dgrowth.zmin, Dgrowth.zmax)
+        zfix = args.zfix
+        sampler = qso.QSOSampler(x_axis, y_axis, z_axis, DX, DY, DZ, ra0, dec0, dra, ddec,
+                                 z_min, z_max, zR, dn_cell, dz_interp[0], dz_interp[1] - dz_interp[0],
+                                 density_max, seed, lognormal=lognormal, corr=corr, growth=growth, H0=H0,
+                                 zfix=zfix, R_zfix=R_of_z(zfix)*h if zfix is not None else 0.,
+                                 random_cond=random_cond, rand_nb=constant.rand_qso_nb,
+                                 full_box=fullBox, nblock=args.nzblock,
+                                 poisson=(args.draw == 'poisson'), sparse=args.sparse,
+                                 footprint=desi_footprint if desi else None,
+                                 full_stats=util.str2bool(args.full_stats))
+        if random_cond:
+            cat = sampler.sample()
         else:
-            redshift = args.zfix*np.ones_like(RR)
-        if redshift.min() > z_max +1.: continue
-        if not random_cond and rsd:
-            vpar = (XXX*vx[:, :, mz]
-                  + YYY*vy[:, :, mz]
-                  + ZZZ*vz[:, :, mz]) / RR
-            msk = redshift < z_max + 1.  # dont' go above z=5
-            if args.zfix is None:
-                RR_RSD = RR.copy()
+            sampler.norm = norm
+            sampler.sat_norm = kk
+            if rsd:
+                cat = sampler.sample((p1, p2, p3), vx, vy, vz)
             else:
-                RR_RSD = R_of_z(redshift)*h
-            RR_RSD[msk] += vpar[msk] * (1+redshift[msk]) * Dgrowth.interp(redshift[msk]) / (dgrowth0 * H0)
-            redshift_RSD = z_of_R(RR_RSD/h)
-
-        if rsd and not random_cond:
-            cond3 = (util.diffmod(ra,ra0,360)<dra) * (util.diffmod(dec,dec0,180)<ddec) * (redshift_RSD>z_min) * (redshift_RSD<z_max)    # check norm still ok <==
-        else:
-            cond3 = (util.diffmod(ra,ra0,360)<dra) * (util.diffmod(dec,dec0,180)<ddec) * (redshift>z_min) * (redshift<z_max)    # check norm still ok <==
-
-        if (fullBox):
-            iqso = sp.where(cond1)
-        else:
-            iqso = sp.where(cond1 * cond2 * cond3)  # tuple (2,N_QSO)  ([iqso],[jqso])
-            #            iqso = sp.where( cond1 * cond3 ) # prov
+                cat = sampler.sample((p1, p2, p3))
+            nnQSO = sampler.nnQSO
+            rho_max = sampler.rho_max
+            if sampler.nstats < sampler.ncells:
+                print("statistics of exp(rho) in {} cells out of {} (planes drawn by geometric skipping excluded, see -full_stats)".format(
+                    sampler.nstats, sampler.ncells))
+            print("exp(rho) max and sum = ",rho_max,rho_sum)
+            print("k exp(rho_max) =",kk*rho_max)
+            if (kk*rho_max>1):
+                print("k exp(rho) > 1 in ", sampler.n_saturated,"cells")
+                print("sum min(k exp(rho) , 1) =", sampler.sum_saturated)
+        sampler.print_timings()
+        # the desi footprint is selected in the sampler
+        XX, YY, ZZ, ra, dec, zzz, zzz_RSD = cat.T
+        nQSO = len(zzz)
         if drawPlot:
-            xx = x_axis[iqso[0]]
-            yy = y_axis[iqso[1]]
-            plt.plot(xx, yy, ls='none', marker='s')
-            # plt.show()
-
-        XX = XX[iqso[0]]
-        YY = YY[iqso[1]]
-        ZZ = ZZZ[iqso]
-        RR = RR[iqso]
-        # zzz = z_of_R(RR/h)
-        zzz = redshift[iqso]
-        if RR.size == 0: continue
-        if rsd and not random_cond:
-            RR_RSD = RR_RSD[iqso]
-            zzz_RSD = redshift_RSD[iqso]
-        else:
-            zzz_RSD = zzz
-
-        ra = ra[iqso]
-        dec = dec[iqso]
-
-        # Select desi footprint
-        if desi:
-            msk = desi_footprint.selection(ra,dec)
-            ra = ra[msk]
-            dec = dec[msk]
-            zzz = zzz[msk]
-            XX = XX[msk]
-            YY = YY[msk]
-            ZZ = ZZ[msk]
-            zzz_RSD = zzz_RSD[msk]
-
-        nQSO += len(zzz)
+            # positions in the cells (cell centers in the legacy loop)
+            plt.plot(XX, YY, ls='none', marker='s')
         ra_list.append(ra)
         dec_list.append(dec)
         z_list.append(zzz)
@@ -507,6 +483,115 @@ def main():
         xx_list.append(XX)
         yy_list.append(YY)
         zz_list.append(ZZ)
+    else:
+        for mz in range(NZ):
+            XX = x_axis
+            YY = y_axis
+            XY2 = (XX*XX).reshape(-1,1) + YY*YY    # broadcasting -> (NX,NY)
+            ZZ = z_axis[mz]
+            RR = np.sqrt(ZZ*ZZ + XY2)
+            if args.zfix is  None:
+                redshift = z_of_R(RR/h)
+            else:
+                redshift = args.zfix*np.ones_like(RR)
+            delta_z = dz_interp[1] - dz_interp[0]
+            iz = ((redshift - dz_interp[0]) / delta_z).round().astype(int)
+            density = dn_cell[iz]
+            # correct the z dependence in cond1 (due to a(z))
+            if not random_cond:
+                density /= density_correction(redshift)
+
+            # ==> should correct for the fact that   rnd1 < exp(rho)   not always true
+            #  use reproducible random <==
+            rnd1 = np.random.random_sample(size=(NX,NY))        #  float64
+            if (not random_cond):
+                cond1 = rnd1 < norm * ptot[:, :, mz]  # (NX,NY)
+                # should be a Poisson of norm * np.exp(rho)  <==
+                # sometime get 2 QSO in a cell
+                nnQSO += np.size(np.where(cond1)[0])
+            else:
+                cond1 = rnd1 > (1. - constant.rand_qso_nb)
+
+            cond2 = density_max * np.random.random_sample(size=(NX,NY)) < density    # (NX,NY)
+
+            # Draw random xyz in the cell
+            XX = XX + np.random.uniform(-DX/2, DX/2, size=len(XX))
+            YY = YY + np.random.uniform(-DY/2, DY/2, size=len(YY))
+
+            XXX = XX.reshape(-1, 1) * np.ones(NY)  # (NX, NY)
+            YYY = np.ones(NX).reshape(-1, 1) * YY
+            ZZZ = ZZ + np.random.uniform(-DZ/2, DZ/2, size=[len(XX), len(YY)])
+            ra, dec, RR = box.ComputeRaDecR2(XXX, YYY, ZZZ, np.radians(ra0), np.radians(dec0))
+            ra = np.degrees(ra)
+            dec = np.degrees(dec)
+            if args.zfix is None:
+                redshift = z_of_R(RR/h)
+            else:
+                redshift = args.zfix*np.ones_like(RR)
+            if redshift.min() > z_max +1.: continue
+            if not random_cond and rsd:
+                vpar = (XXX*vx[:, :, mz]
+                      + YYY*vy[:, :, mz]
+                      + ZZZ*vz[:, :, mz]) / RR
+                msk = redshift < z_max + 1.  # dont' go above z=5
+                if args.zfix is None:
+                    RR_RSD = RR.copy()
+                else:
+                    RR_RSD = R_of_z(redshift)*h
+                RR_RSD[msk] += vpar[msk] * (1+redshift[msk]) * Dgrowth.interp(redshift[msk]) / (dgrowth0 * H0)
+                redshift_RSD = z_of_R(RR_RSD/h)
+
+            if rsd and not random_cond:
+                cond3 = (util.diffmod(ra,ra0,360)<dra) * (util.diffmod(dec,dec0,180)<ddec) * (redshift_RSD>z_min) * (redshift_RSD<z_max)    # check norm still ok <==
+            else:
+                cond3 = (util.diffmod(ra,ra0,360)<dra) * (util.diffmod(dec,dec0,180)<ddec) * (redshift>z_min) * (redshift<z_max)    # check norm still ok <==
+
+            if (fullBox):
+                iqso = np.where(cond1)
+            else:
+                iqso = np.where(cond1 * cond2 * cond3)  # tuple (2,N_QSO)  ([iqso],[jqso])
+                #            iqso = np.where( cond1 * cond3 ) # prov
+            if drawPlot:
+                xx = x_axis[iqso[0]]
+                yy = y_axis[iqso[1]]
+                plt.plot(xx, yy, ls='none', marker='s')
+                # plt.show()
+
+            XX = XX[iqso[0]]
+            YY = YY[iqso[1]]
+            ZZ = ZZZ[iqso]
+            RR = RR[iqso]
+            # zzz = z_of_R(RR/h)
+            zzz = redshift[iqso]
+            if RR.size == 0: continue
+            if rsd and not random_cond:
+                RR_RSD = RR_RSD[iqso]
+                zzz_RSD = redshift_RSD[iqso]
+            else:
+                zzz_RSD = zzz
+
+            ra = ra[iqso]
+            dec = dec[iqso]
+
+            # Select desi footprint
+            if desi:
+                msk = desi_footprint.selection(ra,dec)
+                ra = ra[msk]
+                dec = dec[msk]
+                zzz = zzz[msk]
+                XX = XX[msk]
+                YY = YY[msk]
+                ZZ = ZZ[msk]
+                zzz_RSD = zzz_RSD[msk]
+
+            nQSO += len(zzz)
+            ra_list.append(ra)
+            dec_list.append(dec)
+            z_list.append(zzz)
+            z_rsd_list.append(zzz_RSD)
+            xx_list.append(XX)
+            yy_list.append(YY)
+            zz_list.append(ZZ)
 
     # end of loop on qso
     t5 = time()
@@ -564,7 +649,11 @@ def main():
     qsofits.close()
     print("File {} written in {} s".format(out_file, time() - t5))
     print(nQSO, "QSOs drawn")
-    if (not random_cond):
+    if (not random_cond) and args.sampler == 'fused' and sampler.nstats < sampler.ncells:
+        print(nnQSO, "QSOs expected in the {} cells of the z-planes drawn cell by cell".format(sampler.nstats))
+    elif (not random_cond) and args.sampler == 'fused':
+        print(nnQSO, "QSOs expected in the full box")
+    elif (not random_cond):
         print(nnQSO, "QSOs in the full box")  # prov
     print("Took {}s".format(time()-t_init))
 
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Random catalog drawn from the desi footprint and the QSO dN/dz
+# (SaclayMocks.randoms), without reading the boxes: the randoms are drawn
+# by healpix nest pixel at -nside, with a density -mult times the one of the
+# QSO of draw_qso.py. The pixels are shared among -ncpu jobs, and among
+# -nproc processes in each job; the catalog does not depend on the sharing,
+# provided all the jobs have the same -seed.
+# The output has the columns of the randoms of draw_qso.py -random True, so
+# that merge_qso.py -random True can read it (HDU is -1: the randoms are not
+# drawn in a slice of the box). The THING_ID start at
+# randoms.THING_ID_OFFSET + 1, and do not overlap the ones of draw_qso.py.
+import numpy as np
+from fitsio import FITS
+import argparse
+from time import time
+from SaclayMocks import box
+from SaclayMocks import constant
+from SaclayMocks import randoms
+from SaclayMocks import util
+
+
+def main():
+    t_init = time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-outpath", help="directory where the randoms-{i}-{ncpu}.fits file is written")
+    parser.add_argument("-i", type=int, help="index of current job, default 0", default=0)
+    parser.add_argument("-ncpu", type=int, help="total number of jobs, default 1", default=1)
+    parser.add_argument("-nproc", type=int, help="number of processes of the job, default 1", default=1)
+    parser.add_argument("-nside", type=int, help="nside of the healpix nest pixels drawn independently, default 16", default=16)
+    parser.add_argument("-mult", type=float, help="density of the randoms in units of the QSO density of draw_qso.py, default 10", default=10.)
+    parser.add_argument("-zmin", type=float, help="minimal redshift, default 1.8", default=1.8)
+    parser.add_argument("-zmax", type=float, help="maximal redshift, default 3.6", default=3.6)
+    parser.add_argument("-desi", type=str, help="select only objects in desi footprint, default is True", default="True")
+    parser.add_argument("-ra0", type=float, help="center box RA in degrees, default 0", default=0)
+    parser.add_argument("-dec0", type=float, help="center box DEC in degrees, default 0", default=0)
+    parser.add_argument("-dra", type=float, help="|ra-ra0|<dra in degrees, default -1 no cut", default=-1)
+    parser.add_argument("-ddec", type=float, help="|dec-dec0|<ddec in degrees, default -1 no cut", default=-1)
+    parser.add_argument("-seed", type=int, help="specify a seed, the same for all the jobs", default=None)
+    args = parser.parse_args()
+    job = args.i
+    ncpu = args.ncpu
+    nside = args.nside
+    ra0 = args.ra0
+    dec0 = args.dec0
+    dra = args.dra
+    ddec = args.ddec
+    desi = util.str2bool(args.desi)
+    h = constant.h
+
+    print("\n\nBegining of draw_randoms.")
+    seed = args.seed
+    if seed is None:
+        seed = np.random.randint(2**31 -1, size=1)[0]
+        print("Seed has not been specified. Seed is set to {}".format(seed))
+    else:
+        print("Specified seed is {}".format(seed))
+    np.random.seed(seed + job)
+
+    #........................................   density
+    # as draw_qso.py, the QSO density is n_qso_exp*qso_nz_adhoc per deg^2
+    # above z = 2.1, with the dN/dz of etc/nz_qso_desi.dat
+    redshift = randoms.RedshiftDistribution(args.zmin, args.zmax)
+    n_qso = constant.n_qso_exp * constant.qso_nz_adhoc
+    if args.zmax > 2.1:
+        n_qso *= redshift.n_deg2 / redshift.number(max(args.zmin, 2.1), args.zmax)
+    density = args.mult * n_qso
+    print("{} randoms per deg^2 between z = {} and {} ({} x QSO)".format(density, args.zmin, args.zmax, args.mult))
+
+    footprint = util.desi_footprint() if desi else None
+    sampler = randoms.RandomSampler(nside, redshift, density, seed, footprint=footprint)
+    all_pixels = sampler.pixels()
+    npixel = len(all_pixels)
+    if job == ncpu-1:
+        i0, i1 = int(job*npixel/ncpu), npixel
+    else:
+        i0, i1 = int(job*npixel/ncpu), int((job+1)*npixel/ncpu)
+    pixels = all_pixels[i0:i1]
+    # ids from the counts of all the pixels, independent of the jobs
+    offsets = sampler.offsets(all_pixels)[i0:i1]
+    print("Treated healpix pixels: {}".format(list(pixels)))
+
+    #........................................   draw
+    t0 = time()
+    results = sampler.sample_pixels(pixels, args.nproc)
+    ra = np.concatenate([r[0] for r in results])
+    dec = np.concatenate([r[1] for r in results])
+    zzz = np.concatenate([r[2] for r in results])
+    thing_id = np.concatenate([randoms.THING_ID_OFFSET + offset + np.arange(len(r[0])) + 1
+                               for offset, r in zip(offsets, results)]).astype(np.int64)
+    del results
+    if dra > 0 and ddec > 0:
+        msk = (util.diffmod(ra, ra0, 360.) < dra) & (util.diffmod(dec, dec0, 180.) < ddec)
+        ra, dec, zzz, thing_id = ra[msk], dec[msk], zzz[msk], thing_id[msk]
+    nQSO = len(zzz)
+    print("{} randoms drawn in {} pixels. {} s".format(nQSO, len(pixels), time()-t0))
+
+    # positions in Mpc/h in the frame of draw_qso.py, box center at (ra0, dec0)
+    cosmo_fid = util.cosmo(constant.omega_M_0, Ok=constant.omega_k_0, H0=100*h)
+    RR = cosmo_fid.r_comoving(zzz) * h
+    XX, YY, ZZ = box.ComputeXYZ2(np.radians(ra), np.radians(dec), RR, np.radians(ra0), np.radians(dec0))
+
+    #........................................   write
+    t1 = time()
+    out_file = args.outpath+'/randoms-{}-{}.fits'.format(job, ncpu)
+    names = ["Z", "RA", "DEC", "HDU", "THING_ID", "PLATE", "MJD", "FIBERID", "PMF", "XX", "YY", "ZZ"]
+    hdu = -np.ones(nQSO)
+    plate = thing_id
+    mjd = np.random.randint(51608, high=57521, size=nQSO)
+    fiberid = np.random.randint(1,high=1001, size=nQSO)
+    pmf = np.array(["{}-{}-{}".format(p, m, f) for p, m, f in zip(plate.tolist(), mjd.tolist(), fiberid.tolist())], dtype='|S30')
+    array_list = [np.float32(zzz), np.float32(ra), np.float32(dec), np.int32(hdu), thing_id, plate, np.int32(mjd), np.int32(fiberid), pmf, np.float32(XX), np.float32(YY), np.float32(ZZ)]
+    qsofits = FITS(out_file, 'rw', clobber=True)
+    qsofits.write(array_list, names=names)
+    qsofits[1].write_key("seed", np.int32(seed), comment="seed used to generate randoms")
+    qsofits[1].write_key("ra0", ra0, comment="right ascension of the box center")
+    qsofits[1].write_key("dec0", dec0, comment="declination of the box center")
+    qsofits[1].write_key("nside", nside, comment="healpix nside of the pixels drawn")
+    qsofits[1].write_key("mult", args.mult, comment="density in units of the QSO density")
+    qsofits[1].write_key("RA", None, comment="right ascension in degrees")
+    qsofits[1].write_key("DEC", None, comment="declination in degrees")
+    qsofits[1].write_key("Z", None, comment="redshift")
+    qsofits[1].write_key("HDU", None, comment="-1: not drawn in a slice of the box")
+    qsofits[1].write_key("XX", None, comment="position on X axis in Mpc/h")
+    qsofits[1].write_key("YY", None, comment="position on Y axis in Mpc/h")
+    qsofits[1].write_key("ZZ", None, comment="position on Z axis in Mpc/h")
+    qsofits.close()
+    print("File {} written in {} s".format(out_file, time() - t1))
+    print(nQSO, "randoms drawn")
+    print("Took {}s".format(time()-t_init))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Accuracy and timing of the FFTLog transforms of SaclayMocks.powerspectrum
+# against the linear grid sine FFT (method='fft') they replace.
+# The lognormal P(k) of P_ln at the QSO bias redshift z is computed with
+# each method and number of points, and compared to the sine FFT with
+# -ref_nk points (converged above k ~ 1e-2 h/Mpc), in k ranges up to the
+# Nyquist wavenumber of the boxes.
+import os
+import numpy as np
+import fitsio
+import argparse
+import time
+from scipy import interpolate
+from SaclayMocks import powerspectrum
+from SaclayMocks import constant
+from SaclayMocks import util
+
+
+def main():
+    t0 = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-pkfile", help="P(k) fits file, default $SACLAYMOCKS_BASE/etc/PlanckDR12.fits", default=None)
+    parser.add_argument("-z", type=float, help="redshift of the QSO bias and growth, default constant.z_QSO_bias_1", default=constant.z_QSO_bias_1)
+    parser.add_argument("-nk", help="comma separated numbers of FFTLog points, default 1024,2048,4096,8192", default='1024,2048,4096,8192')
+    parser.add_argument("-fft_nk", type=int, help="number of points of the sine FFT compared, default 1048576 (LogNormalP default)", default=1024*1024)
+    parser.add_argument("-ref_nk", type=int, help="number of points of the reference sine FFT, default 4194304", default=4*1024*1024)
+    parser.add_argument("-kmax", type=float, help="largest k compared (h/Mpc), default sqrt(3) pi/2.19", default=np.sqrt(3)*np.pi/2.19)
+    parser.add_argument("-out", help="fits file where the report is saved, default None", default=None)
+
+    args = parser.parse_args()
+    filename = args.pkfile
+    if filename is None:
+        filename = os.path.expandvars("$SACLAYMOCKS_BASE/etc/PlanckDR12.fits")
+
+    # input P(k) of P_ln
+    fits = fitsio.FITS(filename)
+    data = fits[1].read()
+    zref = fits[1].read_header()['ZREF']
+    fits.close()
+    k = np.append([0], data['K'])
+    P = np.append([0], data['PK']) / util.fgrowth(zref, constant.omega_M_0)**2
+    P *= (util.fgrowth(args.z, constant.omega_M_0) * util.bias_qso(args.z))**2
+
+    kmins = [1e-3, 3e-3, 1e-2, 1e-1]
+    kt = np.logspace(np.log10(kmins[0]), np.log10(args.kmax), 500)
+
+    def lognormal(method, nk):
+        t1 = time.time()
+        kln, Pln = powerspectrum.LogNormalP(k, P, nk=nk, method=method)
+        dt = time.time() - t1
+        return interpolate.InterpolatedUnivariateSpline(kln, Pln)(kt), dt
+
+    print("Reference: sine FFT with {} points".format(args.ref_nk))
+    ref, t_ref = lognormal('fft', args.ref_nk)
+
+    #...............................  report
+    rows = []
+    print("{:>7} {:>8} {:>10}".format("method", "nk", "time (s)")
+          + "".join(["{:>14}".format("k>={:g}".format(kmin)) for kmin in kmins]))
+    configs = [('fft', args.fft_nk)] + [('fftlog', int(n)) for n in args.nk.split(",")]
+    for method, nk in configs:
+        Pln, dt = lognormal(method, nk)
+        err = np.abs(Pln/ref - 1)
+        errs = [err[kt >= kmin].max() for kmin in kmins]
+        rows.append((method, nk, dt) + tuple(errs))
+        print("{:>7} {:>8} {:10.4f}".format(method, nk, dt)
+              + "".join(["{:14.3e}".format(e) for e in errs]))
+    print("max relative difference of P_ln(k) to the reference, for k up to {:g} h/Mpc".format(args.kmax))
+
+    if args.out is not None:
+        dtype = [('METHOD', 'S6'), ('NK', 'i8'), ('TIME', 'f8')]
+        dtype += [('ERR_KMIN_{}'.format(i), 'f8') for i in range(len(kmins))]
+        header = {'PKFILE': os.path.basename(filename), 'Z': args.z, 'REF_NK': args.ref_nk, 'KMAX': args.kmax}
+        for i, kmin in enumerate(kmins):
+            header['KMIN_{}'.format(i)] = kmin
+        fitsio.write(args.out, np.array(rows, dtype=dtype), header=header, clobber=True)
+        print("Report written in {}".format(args.out))
+    print("Took {}s".format(time.time()-t0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# Pre-plan or benchmark the FFTs of make_boxes.py
+#   -action plan : plan and save the wisdom of the r2c and c2r transforms of
+#                  an NX*NY*NZ box, for each thread count, with -efforts[0],
+#                  so that production jobs do not spend time planning. The
+#                  transforms are the ones of make_boxes.py with the same
+#                  -inplace and -nproc (slab transforms of each process,
+#                  with the thread counts per process, if -nproc > 1)
+#   -action bench: for each planner effort and thread count, time the
+#                  planning and the execution of these transforms, and print
+#                  the fastest configuration
+# Wisdom is saved by SaclayMocks.wisdom.WisdomManager, per CPU model.
+import argparse
+import time
+from SaclayMocks import slabfft
+from SaclayMocks import util
+from SaclayMocks import wisdom
+
+
+def main():
+    t0 = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-action", help="plan or bench, default plan", default='plan', choices=['plan', 'bench'])
+    parser.add_argument("-NX", type=int, help="number of pixels along x, default 256", default=256)
+    parser.add_argument("-NY", type=int, help="number of pixels along y, default NX", default=None)
+    parser.add_argument("-NZ", type=int, help="number of pixels along z, default NX", default=None)
+    parser.add_argument("-threads", help="comma separated thread counts, default 1", default='1')
+    parser.add_argument("-efforts", help="comma separated planner efforts, default FFTW_MEASURE", default='FFTW_MEASURE')
+    parser.add_argument("-inplace", type=str, help="If True, in-place transforms as make_boxes.py -inplace True, default True", default='True')
+    parser.add_argument("-nproc", type=int, help="number of processes of make_boxes.py: if > 1, plan its slab transforms (plan only), default 1", default=1)
+    parser.add_argument("-nrepeat", type=int, help="number of executions timed in bench, default 3", default=3)
+    parser.add_argument("-wisdomdir", help="wisdom directory, default $SACLAYMOCKS_CACHE/wisdom or $SACLAYMOCKS_BASE/etc/wisdom", default=None)
+
+    args = parser.parse_args()
+    NX = args.NX
+    NY = args.NY if args.NY is not None else NX
+    NZ = args.NZ if args.NZ is not None else NX
+    shape = (NX, NY, NZ)
+    inplace = util.str2bool(args.inplace)
+    threads = [int(n) for n in args.threads.split(",")]
+    efforts = args.efforts.split(",")
+    for effort in efforts:
+        if effort not in wisdom.EFFORTS:
+            raise ValueError("Unknown planner effort {}, should be in {}".format(effort, wisdom.EFFORTS))
+
+    if args.action == 'plan':
+        manager = wisdom.WisdomManager(args.wisdomdir, efforts[0])
+        for n in threads:
+            if args.nproc > 1:
+                print("Planning the slabs of {} with {} threads per process".format(wisdom.shape_str(shape), n))
+                slabfft.preplan(NX, NY, NZ, manager, n)
+            else:
+                print("Planning {} with {} threads".format(wisdom.shape_str(shape), n))
+                manager.preplan(shape, n, inplace=inplace)
+        print("Took {}s".format(time.time()-t0))
+        return
+
+    #...............................  bench
+    rows = []
+    for effort in efforts:
+        manager = wisdom.WisdomManager(args.wisdomdir, effort)
+        for n in threads:
+            t1 = time.time()
+            fft_r2c, fft_c2r = manager.preplan(shape, n, inplace=inplace)
+            t_plan = time.time() - t1
+            t_r2c = 0
+            t_c2r = 0
+            for i in range(args.nrepeat):
+                # the plans destroy their input; the output of r2c is the
+                # input of c2r
+                fft_r2c.input_array[:] = 1
+                t1 = time.time()
+                fft_r2c.execute()
+                t_r2c += time.time() - t1
+                t1 = time.time()
+                fft_c2r.execute()
+                t_c2r += time.time() - t1
+            rows.append((effort, n, t_plan, t_r2c/args.nrepeat, t_c2r/args.nrepeat))
+
+    print("{:>16} {:>7} {:>10} {:>10} {:>10}".format("effort", "threads", "plan (s)", "r2c (s)", "c2r (s)"))
+    for effort, n, t_plan, t_r2c, t_c2r in rows:
+        print("{:>16} {:>7} {:10.4f} {:10.4f} {:10.4f}".format(effort, n, t_plan, t_r2c, t_c2r))
+    best = min(rows, key=lambda r: r[3]+r[4])
+    print("Fastest: -fftw_effort {} with {} threads ({:.4f} s per r2c+c2r)".format(best[0], best[1], best[3]+best[4]))
+    print("Took {}s".format(time.time()-t0))
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,13 @@ import subprocess
 from SaclayMocks import powerspectrum
 from SaclayMocks import constant
 from SaclayMocks import util
+from SaclayMocks import slabfft
+from SaclayMocks import grf
+from SaclayMocks import boxfields
+from SaclayMocks import manifest as checkpoint
+from SaclayMocks import boxio
+from SaclayMocks import boxstats
+from SaclayMocks import wisdom
 import gc
 
 
@@ -35,94 +42,164 @@ import gc
 # use_pool = True
 
 
+#********************************************************************
+def inplace_buffer(NX, NY, NZ):
+# padded (NX,NY,2*(NZ//2+1)) float32 buffer of an in-place r2c / c2r FFT,
+# returns its real (NX,NY,NZ) and complex (NX,NY,NZ//2+1) views
+  buf = pyfftw.empty_aligned((NX, NY, 2*(NZ//2+1)), dtype='float32')
+  return buf[:, :, :NZ], buf.view(np.complex64)
+
+
 #********************************************************************
 #@profile
-def DrawGRF_boxk(NX,NY,NZ, ncpu, wisdomFile, box_null=False):
+def DrawGRF_boxk(NX,NY,NZ, ncpu, kspace=False, boxk=None):
 #        Draw GRF box in k space in numpy.fft format
-# later we will directly draw boxk, with appropriate symetries
-# and with var(delta_k)=NX*NY*NZ(see cahier simu FFT normalization)
+# with var(delta_k)=NX*NY*NZ(see cahier simu FFT normalization)
+# if kspace, boxk is directly drawn in k space, with appropriate symetries,
+# otherwise a real space box is drawn and FFTed
+# boxk can be a preallocated k space array (e.g. a memmap), only used if kspace
+# or with slab_fft, where the FFT is done in place in the memmap boxk
   t0 = time.time()
+  if kspace:
+    boxk = grf.draw_boxk(NX, NY, NZ, seed, threads=ncpu, boxk=boxk)
+    print(boxk.nbytes/1024/1024, " Mbytes boxk drawn in k space", time.time()-t0, " s")
+    return boxk
   # box = np.float32(np.random.normal(size=[NX, NY, NZ]))
-  box = np.zeros((NX,NY,NZ),dtype=np.float32)
-  for iz in range(NZ):
-    box[:,:,iz] =  np.float32(np.random.normal(size=[NX, NY]))
+  if slab_fft is None:
+    if inplace:
+      # boxk overwrites box
+      box, boxk = inplace_buffer(NX, NY, NZ)
+    else:
+      box = pyfftw.empty_aligned((NX,NY,NZ), dtype='float32')
+      boxk = pyfftw.empty_aligned((NX,NY,NZ//2+1), dtype='complex64')
+    # plan before drawing: planning without wisdom overwrites the arrays
+    myfft = wisdom_manager.plan(box, boxk, (0,1,2), 'FFTW_FORWARD', ncpu)
+    t0 = time.time()
+  else:
+    box = slab_fft.real_buffer()  # shared memory-mapped box
+  if legacy_rng:
+    # sequential draw of older versions, to reproduce their boxes
+    for iz in range(NZ):
+      box[:,:,iz] =  np.float32(np.random.normal(size=[NX, NY]))
+  else:
+    grf.draw_box(NX, NY, NZ, seed, threads=ncpu, box=box)
   t1 = time.time()
   print(box.nbytes/1024/1024, " Mbytes box drawn",  t1-t0, " s")
   print(box.dtype)
-  boxk = np.zeros([NX,NY,NZ//2+1],dtype=np.complex64)
-  myfft = pyfftw.FFTW(box,boxk,axes=(0,1,2),threads=ncpu, flags=('FFTW_DESTROY_INPUT',))
-  myfft.execute()
+  if slab_fft is None:
+    myfft.execute()
+  else:
+    # no copy: boxk stays the memory map, the full box is never in RAM
+    if boxk is None:
+      boxk = slab_fft.complex_buffer()
+    boxk = slab_fft.forward(box, boxk)
+  del box
   t2 =time.time()
   print("FFT", t2-t1, " s")
 
-  # Next lines is a test of the FFT:
-  # if the produced box is null, then try to save wisdom and redo FFT once again
-  # using flag box_null = True : this will call DrawGRF_boxk a second time,
-  # with the wisdom file previously saved, a try another FFT. If the box is still
-  # null, then exit the code.
-  if (not np.any(boxk)) or (np.any(np.isnan(boxk))):
-    sp.save(wisdomFile, pyfftw.export_wisdom())
-    if box_null:
-      raise ValueError("/!\ boxk is null /!\ \n    Wisdom saved before exiting.")
-    print("/!\ Boxk was null. Wisdom has been saved, trying again FFTW...")
-    pyfftw.import_wisdom(sp.load(wisdomFile))
-    del boxk
-    boxk = DrawGRF_boxk(NX, NY, NZ, ncpu, wisdomFile, True)
+  # test of the FFT, block by block as boxk can be a memmap
+  nonzero = False
+  for ix0 in range(0, NX, 16):
+    blk = boxk[ix0:ix0+16]
+    if np.any(np.isnan(blk)):
+      raise ValueError("/!\ boxk is null /!\ ")
+    nonzero = nonzero or np.any(blk)
+  if not nonzero:
+    raise ValueError("/!\ boxk is null /!\ ")
 
   return boxk
 
 
 #********************************************************************
 # @profile
-def FFTandStore(Dcell, nHDU, boxfilename, ncpu, wisdomFile, box_null=False):
+def FFTandStore(scratch, Dcell, nHDU, boxfilename, todo=None, manifest=None,
+                pk_source=None, writer=None, precision='float32', ibuf=0):
 #.............................  FFT
-    global boxk   # use global variable boxk
-    t0=time.time()
+# scratch holds the k space field, it is destroyed by the FFT
+# todo is the list of the output files to write (default all of them),
+# they are recorded in manifest once written
+# if writer (boxio.SlabWriter) is given, the files are written asynchronously
+# from its output buffer ibuf, while the next fields are computed
+# precision is the storage of the box: float32, float16 or int16 (see SaclayMocks.boxio)
     t2 = time.time()
-    NX = boxk.shape[0]
-    NY = boxk.shape[1]
-    NZ = boxk.shape[2]
-    # box = np.zeros([NX,NY,2*(NZ-1)],dtype=np.float32)
-    box = pyfftw.empty_aligned((NX, NY, 2*(NZ-1)), dtype='float32')
-    pyfftw.FFTW(boxk,box,axes=(0,1,2),direction='FFTW_BACKWARD',threads=ncpu, flags=('FFTW_DESTROY_INPUT',)).execute()
-    del boxk
-    box /= NX*NY*2*(NZ-1)
+    NX = scratch.shape[0]
+    NY = scratch.shape[1]
+    NZ = scratch.shape[2]
+    if slab_fft is None:
+      # the plans and their output boxes are made once for all the fields
+      backward_fft[ibuf].execute()
+      box = backward_fft[ibuf].output_array
+      src = ibuf
+    else:
+      # slab-decomposed FFT, scratch is the shared k space buffer
+      box = slab_fft.backward(scratch, slab_fft.real_buffer(ibuf))
+      src = box.filename
+    # normalisation and moments of each x-plane, in one pass over the box
+    planes = boxstats.plane_moments(box, NX*NY*2*(NZ-1))
+    moments = boxstats.merge(planes)
+    sigma = moments.sigma
+    if slab_fft is not None:
+      box.flush()
     t3 = time.time()
     print("FFT done", t3-t2, "s")
-    sigma = np.std(box)
     print("sigma = {}".format(sigma))
 
-    # Next lines is a test of the FFT:
-    # if the produced box is null, then try to save wisdom and redo FFT once again
-    # using flag box_null = True : this will call FFTandStore a second time,
-    # with the wisdom file previously saved, a try another FFT. If the box is still
-    # null, then exit the code.
-    if (not np.any(box)) or (np.any(np.isnan(box))):
-      sp.save(wisdomFile, pyfftw.export_wisdom())
-      if box_null:
-        raise ValueError("/!\ box is null /!\ \n    Box name: {}\nWisdom saved before exiting.".format(boxfilename))
-      print("/!\ Box was null. Wisdom has been saved, trying again FFTW...")
-      box_null = True
+    # test of the FFT
+    t4 = t3
+    if (not moments.not_null) or moments.has_nan:
+      raise ValueError("/!\ box is null /!\ \n    Box name: {}".format(boxfilename))
     else:
       #...............................      write to fits file
-      if box_null:
-        print("Box is not null this time. Continuing...")
-      for i in np.arange(0, nHDU):
-        fits = FITS(boxfilename+'-{}.fits'.format(i),'rw',clobber=True)
-        hdict = {'DX': Dcell, 'DY': Dcell, 'DZ':Dcell, 'NX':NX, 'NY':NY, 'NZ':(NZ-1)*2}
-        fits.write(box[i*NX//nHDU:(i+1)*NX//nHDU],header=hdict)
-        if i == 0:
-          fits[0].write_key("sigma", np.float32(sigma), comment="std of the box")
-          fits[0].write_key("seed", np.int32(seed), comment="seed used to generate randoms")
-        fits.close()
-      t4 = time.time()
-      print(boxfilename, "written", t4-t3,"s")
+      if todo is None:
+        todo = range(nHDU)
+      hdict = {'DX': Dcell, 'DY': Dcell, 'DZ':Dcell, 'NX':NX, 'NY':NY, 'NZ':(NZ-1)*2}
+      keys0 = [("sigma", np.float32(sigma), "std of the box"),
+               ("seed", np.int32(seed), "seed used to generate randoms")]
+      tasks = []
+      if store_options is None:
+        # nHDU fits files, with the moments of their slab
+        nfile = nHDU
+        options = {'precision': precision}
+        for i in todo:
+          keys = []
+          if i == 0:
+            keys = list(keys0)
+          slab = boxstats.merge(planes[i*NX//nHDU:(i+1)*NX//nHDU])
+          keys += [("SLABMEAN", slab.mean, "mean of this slab"),
+                   ("SLABVAR", slab.var, "variance of this slab")]
+          tasks.append((i, boxfilename+'-{}.fits'.format(i), i*NX//nHDU, (i+1)*NX//nHDU, hdict, keys, options))
+      else:
+        # one chunked hdf5 file, with the moments of each chunk
+        nfile = 1
+        options = dict(store_options, precision=precision)
+        chunks = [boxstats.merge(planes[c0:c0+options['chunk']]) for c0 in range(0, NX, options['chunk'])]
+        keys = keys0 + [("SLABMEAN", np.array([c.mean for c in chunks]), "mean of each chunk"),
+                        ("SLABVAR", np.array([c.var for c in chunks]), "variance of each chunk")]
+        tasks.append((0, boxfilename+'.h5', 0, NX, hdict, keys, options))
+
+      name = os.path.basename(boxfilename)
+      def record(results):
+        if manifest is None:
+          return
+        for i, filename, crc in results:
+          manifest.record(name, pk_source, nfile, i, filename, crc)
+
+      if writer is None:
+        for t in tasks:
+          # recorded one by one, for the readers waiting for the slabs
+          record([(t[0], t[1], boxio.write_slab(box, *t[1:]))])
+        t4 = time.time()
+        print(boxfilename, "written", t4-t3,"s")
+      else:
+        writer.submit(ibuf, src, tasks, record)
+        t4 = time.time()
+        print(boxfilename, "queued for writing")
       # if t4-t3 > 1500:
       #   print("I/O is very slow, exiting.")
       #   sys.exit(1)
 
     del box
-    return box_null
+    return t3-t2, t4-t3
 
 
 #********************************************************************
@@ -141,11 +218,28 @@ def main() :
   parser.add_argument("-NZ", type=int, help="number of pixels along z, default = NX", default=-1)
   parser.add_argument("-nHDU", type=int, help="number of HDU box.fits, default 1", default=1)
   parser.add_argument("-ncpu", type=int, default=2)
+  parser.add_argument("-nproc", type=int, help="number of processes of the slab-decomposed FFT, default 1 (single process FFTW)", default=1)
+  parser.add_argument("-fftdir", help="directory of the shared FFT buffers for -nproc > 1 (e.g. /dev/shm), default outDir", default=None)
+  parser.add_argument("-inplace", type=str, help="If True, the FFTs are done in place in padded buffers, which saves one real space box of memory, default True", default='True')
+  parser.add_argument("-nwriter", type=int, help="number of processes writing the box files while the next boxes are computed (needs memory for 2 real space boxes), default 0: boxes are written after their FFT", default=0)
+  parser.add_argument("-fftw_effort", help="FFTW planner effort: FFTW_ESTIMATE, FFTW_MEASURE, FFTW_PATIENT or FFTW_EXHAUSTIVE, default FFTW_MEASURE", default='FFTW_MEASURE', choices=wisdom.EFFORTS)
+  parser.add_argument("-wisdomdir", help="directory of the FFTW wisdom files, default $SACLAYMOCKS_CACHE/wisdom or $SACLAYMOCKS_BASE/etc/wisdom", default=None)
   parser.add_argument("-PkDir", help="directory of Pk fits file")
+  parser.add_argument("-pkgrid", type=str, help="If True, read the sqrt(P/Vcell) grids from PkDir/P<NX>.fits (see interpolate_pk.py), if False evaluate them on the fly from etc/PlanckDR12.fits and PkDir is not used, default True", default='True')
   parser.add_argument("-seed", type=int, help="specify a seed", default=None)
   parser.add_argument("-rsd", type=str, help="If True, rsd are added, default True", default='True')
   parser.add_argument("-dgrowthfile", help="dD/dz file, default etc/dgrowth.fits", default=None)
+  parser.add_argument("-rsdfields", help="boxes stored for the rsd: 'eta' (eta_ij and vx, vy, vz) or 'velocity' (vx, vy, vz only, make_spectra.py derives eta_par from the velocity gradient), default eta", default='eta', choices=['eta', 'velocity'])
   parser.add_argument("-outDir", help="directory where the box are saved")
+  parser.add_argument("-mmap", type=str, help="If True, keep boxk out of core as a memory map of boxk.npy and read P(k) by blocks (always the case with -nproc > 1), default False", default='False')
+  parser.add_argument("-boxformat", help="format of the boxes: 'fits' (nHDU or NX fits files per box) or 'hdf5' (one chunked <box>.h5 file per box), default fits", default='fits', choices=['fits', 'hdf5'])
+  parser.add_argument("-chunk", type=int, help="number of x planes per hdf5 chunk, default 1", default=1)
+  parser.add_argument("-compression", help="compression of the hdf5 boxes: none, lzf or gzip, default none", default='none', choices=['none', 'lzf', 'gzip'])
+  parser.add_argument("-precision", help="storage of the eta and velocity boxes: float32, float16 or int16 (with a scale and offset per file or chunk), default float32. See bin/precision_report.py for the induced errors", default='float32', choices=['float32', 'float16', 'int16'])
+  parser.add_argument("-verify", type=str, help="If True, check the checksum of the already produced files listed in manifest.json before skipping them, default False", default='False')
+  parser.add_argument("-run_id", help="identifier of the run written in manifest.json, for the readers of the boxes waiting for this run (draw_qso.py and make_spectra.py -wait True -run_id), default host, pid and start time", default=None)
+  parser.add_argument("-rng", help="random generator of the white noise: 'philox' (counter based, the planes are drawn independently) or 'legacy' (sequential numpy.random of older versions, with -kspace False it reproduces their boxes of a seed), default philox", default='philox', choices=['philox', 'legacy'])
+  parser.add_argument("-kspace", type=str, help="If True, draw the white noise directly in k space, default False", default='False')
 
   args = parser.parse_args()
   rsd = util.str2bool(args.rsd)
@@ -160,7 +254,10 @@ def main() :
   else:
     NZ = args.NZ
 
-  global seed
+  global seed, legacy_rng
+  legacy_rng = (args.rng == 'legacy')
+  if legacy_rng and util.str2bool(args.kspace):
+    raise ValueError("-rng legacy is only available for the real space draw (-kspace False)")
   seed = args.seed
   if seed is None:
     seed = np.random.randint(2**31 -1, size=1)[0]
@@ -175,6 +272,26 @@ def main() :
   PkDir = args.PkDir
   outDir = args.outDir
 
+  global slab_fft, backward_fft, store_options, inplace
+  inplace = util.str2bool(args.inplace)
+  store_options = None  # fits boxes
+  if args.boxformat == 'hdf5':
+    store_options = {'chunk': args.chunk, 'compression': None}
+    if args.compression != 'none':
+      store_options['compression'] = args.compression
+  #...............................    get wisdom to save time on FFT
+  global wisdom_manager
+  wisdom_manager = wisdom.WisdomManager(args.wisdomdir, args.fftw_effort)
+
+  slab_fft = None
+  backward_fft = {}  # backward FFTW plans, by output buffer
+  if args.nproc > 1:
+    fftdir = args.fftdir
+    if fftdir is None:
+      fftdir = outDir
+    slab_fft = slabfft.SlabFFT(NX, NY, NZ, args.nproc, fftdir, threads=max(ncpu//args.nproc, 1),
+                               wisdom_manager=wisdom_manager)
+
   PI = np.pi
   k_ny = PI / Dcell
   nCell  = NX * NY * NZ
@@ -183,256 +300,195 @@ def main() :
   print("volume = ",volume)
 
   # Reading power spectra
-  if (NY==NX and NZ==NX):
-    Pfilename = PkDir+"/P"+str(NX)+".fits"
-  else :
-    Pfilename = PkDir+"/P"+str(NX)+"-"+str(NY)+"-"+str(NZ)+".fits"
-
-  #...............................    get wisdom to save time on FFT
-  wisdom_path = os.path.expandvars("$SACLAYMOCKS_BASE/etc/")
-  if (NY==NX and NZ==NX):
-    wisdomFile = wisdom_path+"wisdom."+str(NX)+"."+str(ncpu)+".npy"
-  else :
-    wisdomFile = wisdom_path+"wisdom."+str(NX)+"-"+str(NY)+"-"+str(NZ)+"."+str(ncpu)+".npy"
-
-  if os.path.isfile(wisdomFile) :
-    pyfftw.import_wisdom(sp.load(wisdomFile))
-    save_wisdom = False
-  else :
-    print(wisdomFile," wisdomfile not found !!! set save_wisdom = true")
-    save_wisdom = True
+  # with -pkgrid False, sqrt(P/Vcell) is a function of |k| tabulated once
+  # and evaluated block by block: no P(k) grid is read
+  radial = None
+  if util.str2bool(args.pkgrid):
+    if (NY==NX and NZ==NX):
+      Pfilename = PkDir+"/P"+str(NX)+".fits"
+    else :
+      Pfilename = PkDir+"/P"+str(NX)+"-"+str(NY)+"-"+str(NZ)+".fits"
+  else:
+    Pfilename = os.path.expandvars("$SACLAYMOCKS_BASE/etc/PlanckDR12.fits")
+    radial = boxfields.RadialPk(powerspectrum.box_pk(Dcell, Pfilename), Dcell, NX, NY, NZ)
 
   #............................. Draw GRF in k space
+  # with -mmap True, boxk stays on disk as a memory map of boxk.npy and the
+  # P(k) grids are read block by block: only the scratch buffer is in RAM.
+  # With -nproc > 1 (slab FFT), the FFT is done in boxk.npy, always mapped
+  mmap = util.str2bool(args.mmap) or slab_fft is not None
+  kspace = util.str2bool(args.kspace)
   boxkfile = outDir + "/boxk.npy"
-  global boxk
   boxk_exist = False
   if os.path.isfile(boxkfile):
     print("{} already exists ! Reading boxk.npy file to compute density and velocity boxes...".format(boxkfile))
     boxk_exist = True
-    boxk = np.load(boxkfile)
+    if mmap:
+      boxk = np.load(boxkfile, mmap_mode='r')
+    else:
+      boxk = np.load(boxkfile)
     try:
       seed = np.load(outDir+"/seed_boxk.npy")
     except:
       print("WARNING: didn't find {}/seed_boxk.npy".format(outDir))
     print("Done.")
-    sigma = boxk.std()
+    sigma = boxfields.blockwise_std(boxk)
     if sigma > 70*NX:
+      # boxk.npy used to be saved multiplied by P0(k)
       print("Sigma of boxk is {} > 70*{}:".format(sigma,NX))
       print("dividing boxk by P0(k) and saving...")
       t0 = time.time()
-      boxk /= fitsio.read(Pfilename, ext='P0')
-      boxk[0,0,0] = 0j
-      np.save(boxkfile, boxk)
+      if mmap:
+        boxk = np.load(boxkfile, mmap_mode='r+')
+      boxfields.FieldPlan(boxk, Pfilename, Dcell, NZ, stream=mmap, radial=radial).divide_pk('P0')
+      if mmap:
+        boxk = np.load(boxkfile, mmap_mode='r')
+      else:
+        np.save(boxkfile, boxk)
       print("Done. {} s".format(time.time()-t0))
     else:
       print("Sigma of boxk is {} < 70*{}".format(sigma,NX))
   else:
     t0 = time.time()
     print(NX,NY,NZ)
-    boxk = DrawGRF_boxk(NX,NY,NZ, ncpu, wisdomFile)
-    t1 = time.time()
-    np.save(boxkfile,boxk)
+    # boxk.npy holds the white noise only: it is not multiplied by P0(k)
+    # any more (older files where it was are detected above)
+    if mmap and (kspace or slab_fft is not None):
+      # draw (or FFT) directly into boxk.npy
+      boxk = np.lib.format.open_memmap(boxkfile, mode='w+', dtype=np.complex64,
+                                       shape=(NX, NY, NZ//2+1))
+      DrawGRF_boxk(NX,NY,NZ, ncpu, kspace=kspace, boxk=boxk)
+      t1 = time.time()
+      boxk.flush()
+    else:
+      boxk = DrawGRF_boxk(NX,NY,NZ, ncpu, kspace=kspace)
+      t1 = time.time()
+      np.save(boxkfile,boxk)
     np.save(outDir+"/seed_boxk.npy", seed)
     t2 = time.time()
     print("boxk produced and saved:",t1-t0,t2-t1," s ")
-
-  #............................. multiply by sqrt(P/Vcell), FFT and store
-  print("Computing delta boxes...")
-  # First lognormal
-  boxfile = outDir+'/boxln_1'
-  command = "ls -l {}* | wc -l".format(boxfile)
-  if nHDU == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-    print("{} files already exist ! Skiping this step.".format(boxfile))
-  else:
-    boxk *= fitsio.read(Pfilename, ext='Pln1')
-    box_null = FFTandStore(Dcell, nHDU, boxfile, ncpu, wisdomFile)
-    # This box_null thing is in case the FFT went bad with the wisdom file
-    if box_null:
-      print("Starting again FFTandStore...")
-      print("Loading wisdom {}".format(wisdomFile))
-      pyfftw.import_wisdom(sp.load(wisdomFile))
-      boxk = np.load(boxkfile)
-      boxk *= fitsio.read(Pfilename, ext=0)
-      FFTandStore(Dcell, nHDU, boxfile, ncpu, wisdomFile, box_null)
-
-  # Second lognormal
-  boxfile = outDir+'/boxln_2'
-  command = "ls -l {}* | wc -l".format(boxfile)
-  if nHDU == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-    print("{} files already exist ! Skiping this step.".format(boxfile))
-  else:
-    boxk = np.load(boxkfile)
-    boxk *= fitsio.read(Pfilename, ext='Pln2')
-    FFTandStore(Dcell, nHDU, boxfile, ncpu, wisdomFile)
-  # Third lognormal
-  boxfile = outDir+'/boxln_3'
-  command = "ls -l {}* | wc -l".format(boxfile)
-  if nHDU == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-    print("{} files already exist ! Skiping this step.".format(boxfile))
-  else:
-    boxk = np.load(boxkfile)
-    boxk *= fitsio.read(Pfilename, ext='Pln3')
-    FFTandStore(Dcell, nHDU, boxfile, ncpu, wisdomFile)
-  # Density field
-  nHDU_bis = NX   # we want 1 HDU per ix
-  boxfile = outDir+'/box'
-  command = "ls -l {}-* | wc -l".format(boxfile)
-  if nHDU_bis == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-    print("{} files already exist ! Skiping this step.".format(boxfile))
-    print("Reading and multiplying boxk by P0(k), and saving...")
-    t0 = time.time()
-    boxk = np.load(boxkfile)
-    boxk *= fitsio.read(Pfilename, ext='P0')
-    np.save(boxkfile, boxk)
-    print("Done. {} s".format(time.time() - t0))
-  else:
-    boxk=np.load(boxkfile)
-    boxk *= fitsio.read(Pfilename, ext='P0')
-    np.save(boxkfile, boxk)
-    FFTandStore(Dcell, nHDU_bis, boxfile, ncpu, wisdomFile)
-
+    if mmap:
+      del boxk
+      boxk = np.load(boxkfile, mmap_mode='r')
+
+  #............................. fields to produce
+  H0 = constant.H0
+  Om = constant.omega_M_0
+  dgrowth0 = None
   if rsd:
-    # ............................ Compute eta
-    H0 = constant.H0
-    Om = constant.omega_M_0
-    print("Computing eta boxes:")
-    kx = np.fft.fftfreq(NX) * 2 * k_ny  # rfftfreq 0 -> 0.5   (NX)
-    ky = np.fft.fftfreq(NY) * 2 * k_ny   # (NY)
-    kz = np.fft.rfftfreq(NZ) * 2 * k_ny   # (NZ/2+1)        fftw has no rfftfreq function
-    kz = np.float32(kz)
-    ky = np.float32(ky.reshape(-1, 1))        # (NY,1)
-    kx = np.float32(kx.reshape(-1, 1, 1))        # (NX,1,1)
-    kk = kx*kx + ky*ky + kz*kz  # shape = (NX, NY, NZ/2+1)
-    kk[0, 0, 0] = 1  # avoid dividing by 0
     if args.dgrowthfile is None:
         filename = os.path.expandvars("$SACLAYMOCKS_BASE/etc/dgrowth.fits")
+    else:
+        filename = args.dgrowthfile
     if Om != fitsio.read_header(filename, ext=1)['OM']:
       raise ValueError("Omega_M_0 in SaclayMocks.constant ({}) != OM in {}".format(Om,
                             fitsio.read_header(filename, ext=1)['OM']))
-
     dgrowth0 = fitsio.read(filename, ext=1)['dD/dz'][0]  # value for z=0
-
-    # etak_xx
-    boxfile = outDir+'/eta_xx'
-    command = "ls -l {}* | wc -l".format(boxfile)
-    if nHDU_bis == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-      print("{} files already exist ! Skiping this step.".format(boxfile))
+  fields = boxfields.field_plan(nHDU, NX, rsd, H0, dgrowth0, eta=(args.rsdfields == 'eta'))
+  # slabs already produced from this boxk, see SaclayMocks.manifest
+  verify = util.str2bool(args.verify)
+  manifest = checkpoint.Manifest(outDir, seed)
+  if not boxk_exist:
+    manifest.reset()
+  # files of each field to (re)do: they are removed from the manifest before
+  # the plan of this run is written, so that its readers (wait_slice with
+  # -run_id) only see valid files
+  todos = {}
+  for field in fields:
+    pk_source = "{}[{}]".format(os.path.basename(Pfilename), field.pk_ext)
+    if radial is not None:
+      pk_source += " radial"
+    precision = 'float32'
+    if field.reducible and args.precision != 'float32':
+      precision = args.precision
+      pk_source += " " + precision  # so that a change of precision redoes the field
+    nfile = field.nHDU
+    if store_options is not None:
+      nfile = 1
+    if (boxk_exist and field.name not in manifest.fields and store_options is None
+        and precision == 'float32' and radial is None):
+      # slabs of older versions, made before manifest.json existed
+      adopted = manifest.adopt(field.name, pk_source, nfile,
+                               {'DX': Dcell, 'DY': Dcell, 'DZ': Dcell, 'NX': NX, 'NY': NY, 'NZ': NZ})
+      if len(adopted) > 0:
+        print("{}: {} files of an older version adopted".format(field.name, len(adopted)))
+    todo = manifest.missing(field.name, pk_source, nfile, verify)
+    manifest.forget(field.name, todo)
+    todos[field.name] = (pk_source, precision, nfile, todo)
+  plan = boxfields.FieldPlan(boxk, Pfilename, Dcell, NZ, stream=mmap, radial=radial)
+
+  # asynchronous writing of the boxes
+  writer = None
+  if args.nwriter > 0:
+    if slab_fft is None:
+      writer = boxio.SlabWriter(args.nwriter, shape=(NX, NY, 2*(boxk.shape[2]-1)), inplace=inplace)
     else:
-      print("eta_xx...")
-      t0 = time.time()
-      boxk = np.load(boxkfile)
-      boxk *= kx*kx / kk
-      FFTandStore(Dcell, nHDU_bis, boxfile, ncpu, wisdomFile)
-      print("Done. {} s".format(time.time() -t0))
-
-    # etak_yy
-    boxfile = outDir+'/eta_yy'
-    command = "ls -l {}* | wc -l".format(boxfile)
-    if nHDU_bis == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-      print("{} files already exist ! Skiping this step.".format(boxfile))
-    else:
-      print("eta_yy...")
-      t0 = time.time()
-      boxk = np.load(boxkfile)
-      boxk *= ky*ky / kk
-      FFTandStore(Dcell, nHDU_bis, boxfile, ncpu, wisdomFile)
-      print("Done. {} s".format(time.time() -t0))
-
-    # etak_zz
-    boxfile = outDir+'/eta_zz'
-    command = "ls -l {}* | wc -l".format(boxfile)
-    if nHDU_bis == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-      print("{} files already exist ! Skiping this step.".format(boxfile))
-    else:
-      print("eta_zz...")
-      t0 = time.time()
-      boxk = np.load(boxkfile)
-      boxk *= kz*kz / kk
-      FFTandStore(Dcell, nHDU_bis, boxfile, ncpu, wisdomFile)
-      print("Done. {} s".format(time.time() -t0))
-
-    # etak_xy
-    boxfile = outDir+'/eta_xy'
-    command = "ls -l {}* | wc -l".format(boxfile)
-    if nHDU_bis == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-      print("{} files already exist ! Skiping this step.".format(boxfile))
-    else:
-      print("eta_xy...")
-      t0 = time.time()
-      boxk = np.load(boxkfile)
-      boxk *= kx*ky / kk
-      FFTandStore(Dcell, nHDU_bis, boxfile, ncpu, wisdomFile)
-      print("Done. {} s".format(time.time() -t0))
-
-    # etak_xz
-    boxfile = outDir+'/eta_xz'
-    command = "ls -l {}* | wc -l".format(boxfile)
-    if nHDU_bis == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-      print("{} files already exist ! Skiping this step.".format(boxfile))
-    else:
-      print("eta_xz...")
-      t0 = time.time()
-      boxk = np.load(boxkfile)
-      boxk *= kx*kz / kk
-      FFTandStore(Dcell, nHDU_bis, boxfile, ncpu, wisdomFile)
-      print("Done. {} s".format(time.time() -t0))
-
-    # etak_yz
-    boxfile = outDir+'/eta_yz'
-    command = "ls -l {}* | wc -l".format(boxfile)
-    if nHDU_bis == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-      print("{} files already exist ! Skiping this step.".format(boxfile))
-    else:
-      print("eta_yz...")
-      t0 = time.time()
-      boxk = np.load(boxkfile)
-      boxk *= ky*kz / kk
-      FFTandStore(Dcell, nHDU_bis, boxfile, ncpu, wisdomFile)
-      print("Done. {} s".format(time.time() -t0))
-
-    print("Computing velocity boxes:")
-    # vx
-    boxfile = outDir+'/vx'
-    command = "ls -l {}* | wc -l".format(boxfile)
-    if nHDU == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-      print("{} files already exist ! Skiping this step.".format(boxfile))
-    else:
-      print("vx...")
-      t0 = time.time()
-      boxk = np.load(boxkfile)
-      boxk *= -1j*kx / kk * H0 * dgrowth0
-      FFTandStore(Dcell, nHDU, boxfile, ncpu, wisdomFile)
-      print("Done. {} s".format(time.time() -t0))
-
-    # vy
-    boxfile = outDir+'/vy'
-    command = "ls -l {}* | wc -l".format(boxfile)
-    if nHDU == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-      print("{} files already exist ! Skiping this step.".format(boxfile))
-    else:
-      print("vy...")
-      t0 = time.time()
-      boxk = np.load(boxkfile)
-      boxk *= -1j*ky / kk * H0 * dgrowth0
-      FFTandStore(Dcell, nHDU, boxfile, ncpu, wisdomFile)
-      print("Done. {} s".format(time.time() -t0))
-
-    # vz
-    boxfile = outDir+'/vz'
-    command = "ls -l {}* | wc -l".format(boxfile)
-    if nHDU == int(subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('UTF-8')[:-1]) and boxk_exist:
-      print("{} files already exist ! Skiping this step.".format(boxfile))
-    else:
-      print("vz...")
-      t0 = time.time()
-      boxk = np.load(boxkfile)
-      boxk *= -1j*kz / kk * H0 * dgrowth0
-      FFTandStore(Dcell, nHDU, boxfile, ncpu, wisdomFile)
-      print("Done. {} s".format(time.time() -t0))
+      writer = boxio.SlabWriter(args.nwriter)
+
+  # k space scratch buffers, reused for every field, and backward FFT plans
+  # from them to each output box, made before the scratch buffers are filled.
+  # In place, each output box is the real view of its scratch buffer
+  scratches = {}
+  if slab_fft is None:
+    for ibuf in range(1 if writer is None else writer.nbuf):
+      if inplace and writer is None:
+        box, scratches[ibuf] = inplace_buffer(NX, NY, 2*(boxk.shape[2]-1))
+      elif inplace:
+        box = writer.buffers[ibuf]
+        scratches[ibuf] = writer.kbuffers[ibuf]
+      else:
+        if ibuf == 0:
+          scratches[ibuf] = pyfftw.empty_aligned(boxk.shape, dtype='complex64')
+        else:
+          scratches[ibuf] = scratches[0]
+        if writer is None:
+          box = pyfftw.empty_aligned((NX, NY, 2*(boxk.shape[2]-1)), dtype='float32')
+        else:
+          box = writer.buffers[ibuf]
+      backward_fft[ibuf] = wisdom_manager.plan(scratches[ibuf], box, (0,1,2), 'FFTW_BACKWARD', ncpu)
+    del box
+  else:
+    scratches[0] = slab_fft.complex_buffer()
 
+  #............................. multiply by sqrt(P/Vcell), FFT and store
+  print("Computing delta, eta and velocity boxes...")
+  manifest.set_plan([field.name for field in fields], NX, args.run_id)
+  # the readers of the run stop waiting if it fails, see manifest.wait_slice
+  try:
+    for field in fields:
+      boxfile = outDir+'/'+field.name
+      pk_source, precision, nfile, todo = todos[field.name]
+      if len(todo) == 0:
+        print("{} files already exist ! Skiping this step.".format(boxfile))
+        continue
+      if len(todo) < nfile:
+        print("{}: redoing {} missing or invalid files out of {}".format(field.name, len(todo), nfile))
+      print("{}...".format(field.name))
+      t0 = time.time()
+      ibuf = 0
+      if writer is not None:
+        # wait for the slabs previously written from this output buffer
+        ibuf = writer.next_buffer()
+      t_wait = time.time() - t0
+      scratch = scratches.get(ibuf, scratches[0])
+      t_fill = plan.fill(field, scratch)
+      t_fft, t_write = FFTandStore(scratch, Dcell, field.nHDU, boxfile, todo=todo, manifest=manifest,
+                                   pk_source=pk_source, writer=writer, precision=precision, ibuf=ibuf)
+      t_write += t_wait
+      plan.add_timing(field.name, t_fill, t_fft, t_write)
+      print("Done. {} s".format(t_fill + t_fft + t_write))
+
+    if writer is not None:
+      print("Waiting for the last boxes to be written...")
+      print("Done. {} s".format(writer.close()))
+  except BaseException:
+    manifest.finish('failed')
+    raise
+  manifest.finish('done')
+  plan.print_timings()
+  if slab_fft is not None:
+    slab_fft.close()
   print("NX=", NX,"nCPU=", ncpu)  #, "use_pool=",  use_pool
-  if (save_wisdom):
-    sp.save(wisdomFile, pyfftw.export_wisdom())
 
   print("Took {}s".format(time.time()-t_init))
 
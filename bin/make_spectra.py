@@ -7,7 +7,9 @@
 #    applies Gunn Peterson to make Lya forest
 from __future__ import division, print_function
 from SaclayMocks import box
+from SaclayMocks import boxio
 from SaclayMocks import constant
+from SaclayMocks import manifest
 #from SaclayMocks import powerspectrum
 from SaclayMocks import util
 import fitsio
@@ -87,13 +89,14 @@ def main():
 
     #*************************************************************
     #   @jit + python -m cProfile -s tottime fails
-    @jit('Tuple((float64[:],float64[:],float64[:]))(float32[:],int64,int64,int64,float64[:],float64[:],float64[:],float64[:], float64[:,:],int64[:,:],float64,float64,float64,float64,float64,float64,float64,int64,int64,float32[:],float32[:],float32[:],float32[:],float32[:],float32[:],float32[:],float32[:],float32[:],int64,int64)',nopython=True)
-    def ReadSpec(fullrho,nx,ny,nz,Xvec, XvecSlice, Yvec, Zvec, grid,cells,LX,LY,LZ,DX,DY,DZ,R0,rsd,dla, eta_xx,eta_yy, eta_zz, eta_xy,eta_xz, eta_yz, velo_x,velo_y,velo_z,imin=0, imax=sys.maxsize):
+    @jit('Tuple((float64[:],float64[:],float64[:]))(float32[:],int64,int64,int64,float64[:],float64[:],float64[:],float64[:], float64[:,:],int64[:,:],float64,float64,float64,float64,float64,float64,float64,int64,int64,int64,float32[:],float32[:],float32[:],float32[:],float32[:],float32[:],float32[:],float32[:],float32[:],int64,int64)',nopython=True)
+    def ReadSpec(fullrho,nx,ny,nz,Xvec, XvecSlice, Yvec, Zvec, grid,cells,LX,LY,LZ,DX,DY,DZ,R0,rsd,velo,eta, eta_xx,eta_yy, eta_zz, eta_xy,eta_xz, eta_yz, velo_x,velo_y,velo_z,imin=0, imax=sys.maxsize):
         # reads spectrum for (Xvec, Yvec, Zvec)
         # XvecSlice is in [-LX/2, -LX/2 + LX/NSlice]
         # cells is the list of indices used for G.S. around (0,0,0),
         # and grid its value in Mpc/h, both shapes are (343,3)
         # imin imax are the indices delimiting the lya forest
+        # if rsd, eta_par is computed if eta, and vpar if velo
         # function also uses cosntants LX,LY,LZ,DX,DY,DZ
 
         spectrum = -1000000 * sp.ones_like(XvecSlice) # so that exp(-a(exp(b*g))) = 1
@@ -112,22 +115,23 @@ def main():
             spectrum[icell] = computeRho(myrho,weight)
             if rsd:
                 RR = Xtrue**2+Y**2+Z**2
-                myeta_xx = eta_xx[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
-                myeta_yy = eta_yy[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
-                myeta_zz = eta_zz[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
-                myeta_xy = eta_xy[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
-                myeta_xz = eta_xz[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
-                myeta_yz = eta_yz[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
-                myeta_xx_ = computeRho(myeta_xx, weight)
-                myeta_yy_ = computeRho(myeta_yy, weight)
-                myeta_zz_ = computeRho(myeta_zz, weight)
-                myeta_xy_ = computeRho(myeta_xy, weight)
-                myeta_xz_ = computeRho(myeta_xz, weight)
-                myeta_yz_ = computeRho(myeta_yz, weight)
-                eta_par[icell] = (Xtrue*myeta_xx_*Xtrue + Y*myeta_yy_*Y
-                                  + Z*myeta_zz_*Z + 2*Xtrue*myeta_xy_*Y
-                                 + 2*Xtrue*myeta_xz_*Z + 2*Y*myeta_yz_*Z) / RR
-                if dla:
+                if eta:
+                    myeta_xx = eta_xx[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
+                    myeta_yy = eta_yy[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
+                    myeta_zz = eta_zz[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
+                    myeta_xy = eta_xy[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
+                    myeta_xz = eta_xz[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
+                    myeta_yz = eta_yz[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
+                    myeta_xx_ = computeRho(myeta_xx, weight)
+                    myeta_yy_ = computeRho(myeta_yy, weight)
+                    myeta_zz_ = computeRho(myeta_zz, weight)
+                    myeta_xy_ = computeRho(myeta_xy, weight)
+                    myeta_xz_ = computeRho(myeta_xz, weight)
+                    myeta_yz_ = computeRho(myeta_yz, weight)
+                    eta_par[icell] = (Xtrue*myeta_xx_*Xtrue + Y*myeta_yy_*Y
+                                      + Z*myeta_zz_*Z + 2*Xtrue*myeta_xy_*Y
+                                     + 2*Xtrue*myeta_xz_*Z + 2*Y*myeta_yz_*Z) / RR
+                if velo:
                     vx = velo_x[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
                     vy = velo_y[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
                     vz = velo_z[ny*nz*lcells[:,0] +nz*lcells[:,1] +lcells[:,2]]
@@ -149,7 +153,7 @@ def main():
     parser.add_argument("-zmin", type=float, help="min redshift. Default is 1.3", default=1.3)
     parser.add_argument("-zmax", type=float, help="max redshift. Default is 3.6", default=3.6)
     parser.add_argument("-QSOfile", help="QSO fits file")
-    parser.add_argument("-boxdir", help="path to box fits files")
+    parser.add_argument("-boxdir", help="path to box fits (or hdf5) files")
     parser.add_argument("-outDir", help="dir for spectra fits file")
     parser.add_argument("-i", type=int, help="index of treated slice")
     parser.add_argument("-N", type=int, help="total number of slices")
@@ -158,6 +162,9 @@ def main():
     parser.add_argument("-rsd", help="If True, rsd are added, default True", default='True')
     parser.add_argument("-dla", help="If True, store delta and growth skewers, default False", default='False')
     parser.add_argument("-dgrowthfile", help="dD/dz file, default etc/dgrowth.fits", default=None)
+    parser.add_argument("-wait", type=str, help="If True, wait for make_boxes.py to write the boxes of the slice (see SaclayMocks.manifest), default False", default='False')
+    parser.add_argument("-wait_timeout", type=float, help="maximum waiting time in s with -wait True, default None: no limit", default=None)
+    parser.add_argument("-run_id", help="with -wait True, only read the boxes of the make_boxes.py run with this -run_id, default None: any run", default=None)
     args = parser.parse_args()
 
     iSlice = args.i
@@ -172,6 +179,8 @@ def main():
     Om = constant.omega_M_0
     if args.dgrowthfile is None:
         filename = os.path.expandvars("$SACLAYMOCKS_BASE/etc/dgrowth.fits")
+    else:
+        filename = args.dgrowthfile
     if Om == fitsio.read_header(filename, ext=1)['OM']:
         Dgrowth = util.InterpFitsTable(filename, 'Z', 'dD/dz')
     else:
@@ -190,25 +199,30 @@ def main():
     Ok = constant.omega_k_0
     z0 = constant.z0
 
+    #...............................   wait for the boxes
+    wait = util.str2bool(args.wait)
+    if wait:
+        boxes_manifest = manifest.Manifest(boxdir)
+        names = ['box']
+        if rsd:
+            names += ['eta_xx', 'eta_yy', 'eta_zz', 'eta_xy', 'eta_xz', 'eta_yz']
+        boxes_manifest.wait_slice(names, iSlice, NSlice, dmax, timeout=args.wait_timeout, run=args.run_id)
+
     #...............................   read box file
     print("Reading delta box...")
     t0 = time.time()
-    head = fitsio.read_header(boxdir+"/box-0.fits", ext=0)
-    DX = head["DX"]
-    DY = head["DY"]
-    DZ = head["DZ"]
-    NZ = head["NAXIS1"]
-    NY = head["NAXIS2"]
-    NX = head["NAXIS3"]
-    nHDU = head["NX"]
+    # boxes are read from the fits files or the hdf5 store, see SaclayMocks.boxio
+    rho_box = boxio.BoxReader(boxdir, "box")
+    DX = rho_box.DX
+    DY = rho_box.DY
+    DZ = rho_box.DZ
+    NZ = rho_box.NZ
+    NY = rho_box.NY
+    nHDU = rho_box.NX
     LX = DX * nHDU
     LY = DY * NY
     LZ = DZ * NZ
 
-    if (NX != 1):
-        print("NX=", NX, " != 1  => abort !")
-        exit(1)
-
     if (iSlice >= NSlice):
         print('iSlice=',iSlice,">= NSlice =" , NSlice , "=> abort !")
         exit(1)
@@ -219,60 +233,38 @@ def main():
 
     iXmin = np.maximum((iSlice * nHDU)//NSlice -dmax,0)
     iXmax = np.minimum(((iSlice+1) * nHDU)//NSlice +dmax,nHDU)
-    fullrho = []
-    for iX in np.arange(iXmin,iXmax):
-        fullrho.append(fitsio.read(boxdir+"/box-{}.fits".format(iX), ext=0))
-
-    fullrho = np.concatenate(fullrho)
+    fullrho = rho_box.read(iXmin, iXmax)
     NX=fullrho.shape[0]
     print("Done. {} s".format(time.time() - t0))
 
+    # without eta boxes (make_boxes.py -rsdfields velocity), eta_par is
+    # derived from the gradient of v_par along the line of sight
+    if wait:
+        velgrad = rsd and "eta_xx" not in boxes_manifest.plan
+        if dla or velgrad:
+            boxes_manifest.wait_slice(['vx', 'vy', 'vz'], iSlice, NSlice, dmax, timeout=args.wait_timeout, run=args.run_id)
+    else:
+        velgrad = rsd and not boxio.exists(boxdir, "eta_xx")
     if rsd:
-        print("Reading eta boxes...")
-        t1 = time.time()
-        eta_xx = []
-        eta_yy = []
-        eta_zz = []
-        eta_xy = []
-        eta_xz = []
-        eta_yz = []
-        for iX in np.arange(iXmin, iXmax):
-            eta_xx.append(fitsio.read(boxdir+"/eta_xx-{}.fits".format(iX), ext=0))
-            eta_yy.append(fitsio.read(boxdir+"/eta_yy-{}.fits".format(iX), ext=0))
-            eta_zz.append(fitsio.read(boxdir+"/eta_zz-{}.fits".format(iX), ext=0))
-            eta_xy.append(fitsio.read(boxdir+"/eta_xy-{}.fits".format(iX), ext=0))
-            eta_xz.append(fitsio.read(boxdir+"/eta_xz-{}.fits".format(iX), ext=0))
-            eta_yz.append(fitsio.read(boxdir+"/eta_yz-{}.fits".format(iX), ext=0))
-
-        print("Concatenating... {} s".format(time.time()-t1))
-        eta_xx = np.concatenate(eta_xx)
-        eta_yy = np.concatenate(eta_yy)
-        eta_zz = np.concatenate(eta_zz)
-        eta_xy = np.concatenate(eta_xy)
-        eta_xz = np.concatenate(eta_xz)
-        eta_yz = np.concatenate(eta_yz)
-        print("Done. {} s".format(time.time()-t1))
+        if velgrad:
+            print("No eta boxes, eta_par is computed from the velocity boxes")
+        else:
+            print("Reading eta boxes...")
+            t1 = time.time()
+            eta_xx = boxio.BoxReader(boxdir, "eta_xx").read(iXmin, iXmax)
+            eta_yy = boxio.BoxReader(boxdir, "eta_yy").read(iXmin, iXmax)
+            eta_zz = boxio.BoxReader(boxdir, "eta_zz").read(iXmin, iXmax)
+            eta_xy = boxio.BoxReader(boxdir, "eta_xy").read(iXmin, iXmax)
+            eta_xz = boxio.BoxReader(boxdir, "eta_xz").read(iXmin, iXmax)
+            eta_yz = boxio.BoxReader(boxdir, "eta_yz").read(iXmin, iXmax)
+            print("Done. {} s".format(time.time()-t1))
 
-        if dla:
+        if dla or velgrad:
             print("Reading velocity boxes...")
             t1 = time.time()
-            velo_x = []
-            velo_y = []
-            velo_z = []
-            i = int(iXmin*NSlice/nHDU)
-            j = np.minimum(int(iXmax*NSlice/nHDU + 1), NSlice)
-            for iX in np.arange(i , j):
-                velo_x.append(fitsio.read(boxdir+"/vx-{}.fits".format(iX), ext=0))
-                velo_y.append(fitsio.read(boxdir+"/vy-{}.fits".format(iX), ext=0))
-                velo_z.append(fitsio.read(boxdir+"/vz-{}.fits".format(iX), ext=0))
-
-            print("Concatenating... {} s".format(time.time()-t1))
-            ii = int(iXmin % (nHDU / NSlice))
-            jj = int(((j-i-1)*nHDU/NSlice + dmax))
-            if iSlice == NSlice-1: jj=int((j-i)*nHDU/NSlice)
-            velo_x = np.concatenate(velo_x)[ii:jj]
-            velo_y = np.concatenate(velo_y)[ii:jj]
-            velo_z = np.concatenate(velo_z)[ii:jj]
+            velo_x = boxio.BoxReader(boxdir, "vx").read(iXmin, iXmax)
+            velo_y = boxio.BoxReader(boxdir, "vy").read(iXmin, iXmax)
+            velo_z = boxio.BoxReader(boxdir, "vz").read(iXmin, iXmax)
             print("Done. {} s".format(time.time()-t1))
 
     # printout rho cells to check <==
@@ -283,13 +275,14 @@ def main():
     print (",  due to dmax=",dmax,"requires", iXmin,"<= ix <",iXmax,fullrho.shape,"   ")
     fullrho = fullrho.ravel()
     if rsd:
-        eta_xx = eta_xx.ravel()
-        eta_yy = eta_yy.ravel()
-        eta_zz = eta_zz.ravel()
-        eta_xy = eta_xy.ravel()
-        eta_xz = eta_xz.ravel()
-        eta_yz = eta_yz.ravel()
-        if dla:
+        if not velgrad:
+            eta_xx = eta_xx.ravel()
+            eta_yy = eta_yy.ravel()
+            eta_zz = eta_zz.ravel()
+            eta_xy = eta_xy.ravel()
+            eta_xz = eta_xz.ravel()
+            eta_yz = eta_yz.ravel()
+        if dla or velgrad:
             velo_x = velo_x.ravel()
             velo_y = velo_y.ravel()
             velo_z = velo_z.ravel()
@@ -310,9 +303,11 @@ def main():
 
     npixeltot = int((Rmax - Rmin) /DeltaR +0.5)
     R_vec = Rmin + np.arange(npixeltot) * DeltaR
-    lambda_vec = lya * (1 + z_of_R(R_vec/h))
+    z_vec = z_of_R(R_vec/h)
+    lambda_vec = lya * (1 + z_vec)
     cut = (lambda_vec > lambda_min)  # cut pixel bellow 3530 A
     R_vec = R_vec[cut]
+    z_vec = z_vec[cut]
     lambda_vec = lambda_vec[cut]
     print("z0 =",z0, "=> R0=",R0,"and", Rmin,"<R<", Rmax,"thetax,y <",tanx_max, tany_max)
     print("   ",z_low,"< z <",z_high,";   ",(1+z_low)*lya,"< lambda <",(1+z_high)*lya,"  =>",npixeltot,"pixels")
@@ -443,10 +438,11 @@ def main():
         cut = (R_vec * X_QSO/R_QSO > xSlicemin) # Xvec > xSlicemin
         Rvec=R_vec[cut]
         mylambda = lambda_vec[cut]
+        redshift = z_vec[cut]
         cut = (Rvec * X_QSO/R_QSO <= xSlicemax) #  Xvec < xSlicemax
         Rvec=Rvec[cut]
         mylambda = mylambda[cut]
-        redshift = z_of_R(Rvec/h)
+        redshift = redshift[cut]
         Xvec = Rvec * X_QSO/R_QSO
         Yvec = Rvec * Y_QSO/R_QSO
         Zvec = Rvec * Z_QSO/R_QSO
@@ -473,25 +469,27 @@ def main():
         iqso += 1
 
         # Read boxes along l.o.s and apply smoothing
-        if (rsd==False):
+        if (rsd==False) or velgrad:
             eta_xx = np.array([],dtype=np.float32)
             eta_yy = np.array([],dtype=np.float32)
             eta_zz = np.array([],dtype=np.float32)
             eta_xy = np.array([],dtype=np.float32)
             eta_xz = np.array([],dtype=np.float32)
             eta_yz = np.array([],dtype=np.float32)
-            velo_x = np.array([],dtype=np.float32)
-            velo_y = np.array([],dtype=np.float32)
-            velo_z = np.array([],dtype=np.float32)
-        if (dla==False):
+        if (rsd==False) or (dla==False and velgrad==False):
             velo_x = np.array([],dtype=np.float32)
             velo_y = np.array([],dtype=np.float32)
             velo_z = np.array([],dtype=np.float32)
         try:
-            delta_l, eta_par, velo_par = ReadSpec(fullrho,NX,NY,NZ,Xvec, XvecSlice, Yvec, Zvec, grid,cells,LX,LY,LZ,DX,DY,DZ,R0,int(rsd),int(dla), eta_xx, eta_yy, eta_zz, eta_xy,eta_xz, eta_yz, velo_x,velo_y,velo_z, imin=imin, imax=imax)
+            delta_l, eta_par, velo_par = ReadSpec(fullrho,NX,NY,NZ,Xvec, XvecSlice, Yvec, Zvec, grid,cells,LX,LY,LZ,DX,DY,DZ,R0,int(rsd),int(dla or velgrad),int(not velgrad), eta_xx, eta_yy, eta_zz, eta_xy,eta_xz, eta_yz, velo_x,velo_y,velo_z, imin=imin, imax=imax)
         except:
             print("***WARNING ReadSpec:\n    ID {}***".format(QSOid))
             continue
+        if velgrad:
+            # eta_ij = d_j v_i / (H0 dD/dz(z=0)) so eta_par = d v_par / dr / (H0 dD/dz(z=0)), r in Mpc/h
+            eta_par = np.zeros_like(velo_par)
+            if imax - imin > 1:
+                eta_par[imin:imax] = np.gradient(velo_par[imin:imax], Rvec[imin:imax]) / (constant.H0 * dgrowth0)
 
         lrf =  mylambda/(1+zQSO)
         cut = ((lrf<lya) & (lrf>lylimit))
@@ -28,6 +28,7 @@ def main():
     parser.add_argument("-nest", help="If True, healpix scheme is nest. Default True", default='True')
     parser.add_argument("-prod", help="True: use mock prod architecture ; False: use a special directory. Default is True", default='True')
     parser.add_argument("-dla", help="If True, store delta and growth skewers, default False", default='False')
+    parser.add_argument("-desi", help="If True, share among the jobs only the healpix pixels that overlap the desi footprint, default False", default='False')
     args = parser.parse_args()
 
     overwrite = True
@@ -35,16 +36,24 @@ def main():
     npixel = hp.nside2npix(nside)
     nest_option = util.str2bool(args.nest)
     dla_cond = util.str2bool(args.dla)
+    desi = util.str2bool(args.desi)
     if nest_option:
         nest_val = 'T'
     outDir = args.outDir
     prod = util.str2bool(args.prod)
     job = args.job
     ncpu = args.ncpu
+    all_pixels = np.arange(npixel)
+    if desi:
+        # the footprint mask is nest ordered: coverage at nside is a reshape
+        all_pixels = np.flatnonzero(util.desi_footprint().coverage(nside) > 0)
+        if not nest_option:
+            all_pixels = np.sort(hp.nest2ring(nside, all_pixels))
+        npixel = len(all_pixels)
     if job == ncpu-1:
-        pixels = range(int(job*npixel/ncpu), npixel)
+        pixels = list(all_pixels[int(job*npixel/ncpu):])
     else:
-        pixels = range(int(job*npixel/ncpu), int((job+1)*npixel/ncpu))
+        pixels = list(all_pixels[int(job*npixel/ncpu):int((job+1)*npixel/ncpu)])
 
     print("Treated healpix pixels: {}".format(pixels))
 
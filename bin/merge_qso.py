@@ -4,7 +4,7 @@ import numpy as np
 import argparse
 import time
 import os
-from SaclayMocks import util, constant
+from SaclayMocks import util, constant, footprint
 import glob
 # import cosmolopy.distance as dist
 
@@ -23,12 +23,14 @@ def main():
     parser.add_argument("-zmin", type=float, help="minimal redshift for drawing QSO, default is 1.8", default=1.8)
     parser.add_argument("-zmax", type=float, help="maximal redshift for drawing QSO, default is 3.6", default=3.6)
     parser.add_argument("-dgrowthfile", help="dD/dz file, default etc/dgrowth.fits", default=None)
+    parser.add_argument("-desi", type=str, help="If True, keep only the objects in the desi footprint (same mask as draw_qso). Default: False", default='False')
 
     args = parser.parse_args()
     nside = args.nside
     nest_option = util.str2bool(args.nest)
     random_cond = util.str2bool(args.random)
     prod = util.str2bool(args.prod)
+    desi = util.str2bool(args.desi)
     outDir = args.outDir
     print("Reading QSO fits files...")
 
@@ -91,7 +93,20 @@ def main():
     fiber = np.concatenate(fiber)
     pmf = np.concatenate(pmf)
     mockid = THING_ID
-    pix = util.radec2pix(nside, ra, dec, nest=nest_option)
+    if desi:
+        msk = util.desi_footprint().mask(ra, dec)
+        print("{} objects out of {} in the desi footprint".format(msk.sum(), len(msk)))
+        ra, dec, hdu, THING_ID, plate, mjd, fiber, pmf = ra[msk], dec[msk], hdu[msk], THING_ID[msk], plate[msk], mjd[msk], fiber[msk], pmf[msk]
+        mockid = THING_ID
+        if not random_cond:
+            zzz_norsd = zzz_norsd[msk]
+            zzz_rsd = zzz_rsd[msk]
+        else:
+            zzz = zzz[msk]
+    if nest_option:
+        pix = footprint.radec2pix_array(nside, ra, dec)
+    else:
+        pix = util.radec2pix(nside, ra, dec, nest=False)
     print("Reading done. {} s".format(time.time()-t_init))
     if not random_cond:
         array_list = [np.float32(zzz_norsd), np.float32(zzz_rsd), np.float32(ra), np.float32(dec), np.int32(hdu), THING_ID, plate, np.int32(mjd), np.int32(fiber), pmf, np.int32(pix), mockid]
@@ -5,8 +5,7 @@ import numpy as np
 import scipy as sp
 import argparse
 import time
-from SaclayMocks import util, constant
-import pyfftw
+from SaclayMocks import util, constant, wisdom
 import pyfftw.interfaces.numpy_fft as fft
 import glob
 # import matplotlib.pyplot as plt
@@ -39,6 +38,7 @@ def main():
     parser.add_argument("-seed", type=int, help="specify a seed", default=None)
     parser.add_argument("--check-id", help="If True, check if the spectra ID matches the QSO ID by looking at (ra,dec), default True", default='True')
     parser.add_argument("-ncpu", type=int, help="number of cpu, default = 2", default=2)
+    parser.add_argument("-fftw_effort", help="FFTW planner effort of the small scales FFTs, default FFTW_ESTIMATE", default='FFTW_ESTIMATE', choices=wisdom.EFFORTS)
     args = parser.parse_args()
 
     inpath = args.inDir
@@ -221,15 +221,12 @@ def main():
     print("IDs read - {} s".format(time.time()-t_init))
 
     #...............................    get wisdom to save time on FFT
-    wisdom_path = os.path.expandvars("$SACLAYMOCKS_BASE/etc/")
-    wisdomFile = wisdom_path+"wisdom1D_"+str(ncpu)+".npy"
-
-    if os.path.isfile(wisdomFile) :
-        pyfftw.import_wisdom(sp.load(wisdomFile))
-        save_wisdom = False
-    else :
-        print("{f} file not found. Saving wisdom file to {f}".format(f=wisdomFile))
-        save_wisdom = True
+    # the 1D FFTs of the small scales have various sizes, they share one wisdom file
+    wisdom_manager = wisdom.WisdomManager(effort=args.fftw_effort)
+    wisdom_key = ('numpy_fft', ('1d',), np.float64, ncpu)
+    save_wisdom = not wisdom_manager.load(*wisdom_key) and wisdom_manager.effort != 'FFTW_ESTIMATE'
+    if save_wisdom:
+        print("{f} file not found. Saving wisdom file to {f}".format(f=wisdom_manager.filename(*wisdom_key)))
 
     # .......... Merge spectra
     print("Merging spectra...")
@@ -308,7 +305,7 @@ def main():
                         nz = 256
                         while (nz < len(wav_tmp)+50) : nz *= 2  # +50 pixels (10 Mpc/h) is to avoid correlations from edge to edge of the forest
                         delta_s = np.random.normal(size=nz)   # latter, produce directly in k space
-                        delta_sk = fft.rfftn(delta_s, threads=ncpu)
+                        delta_sk = fft.rfftn(delta_s, threads=ncpu, planner_effort=wisdom_manager.effort)
                         k = np.fft.rfftfreq(nz) * 2 * k_ny
                         zeff = z[mmm].mean()
                         # zeff = z_0[mmm].mean()  # prov
@@ -318,7 +315,7 @@ def main():
                             pmis = p1dmiss(zeff, k)
                             pmis[pmis<0] = 0
                         delta_sk *= np.sqrt(pmis/pixsize)
-                        delta_s = fft.irfftn(delta_sk, threads=ncpu)
+                        delta_s = fft.irfftn(delta_sk, threads=ncpu, planner_effort=wisdom_manager.effort)
                         delta_s = delta_s[0:len(wav_tmp)]
                         if not fit_p1d:  # correct the z dependence
                             delta_s *= sigma_s_interp(z) / sigma_s_interp(zeff)
@@ -409,8 +406,7 @@ def main():
     print("Merging and writting done. {} s".format(time.time() - t2))
     # Save wisdom
     if save_wisdom:
-        print("Saving wisdom file in {}".format(wisdomFile))
-        sp.save(wisdomFile, pyfftw.export_wisdom())
+        wisdom_manager.save(*wisdom_key)
         save_wisdom = False
     print("Spectra merged and fits file saved.")
     print("{} initial forests.".format(cpt1))
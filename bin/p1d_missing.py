@@ -14,27 +14,34 @@ def P_RSD(k_par,k_perp,P, beta):
     mu = k_par/np.maximum(k,1E-15)
     return (1+beta*mu**2)**2 * P(k)
 
-def D_Prats(k,mu,P,zref,Growth):
-    # if (abs(zref-3.0)<0.0001):
-    if zref >= 2.9999:
-        q1 = 0.792; q2=0; k_p = 17.1; k_v = 1.16; a_v = 0.578; b_v = 1.63 # Planck Tab 7 
-    if (abs(zref-2.8)<0.0001):
-        q1 = 0.773; q2=0; k_p = 19.2; k_v = 1.16; a_v = 0.608; b_v = 1.65 # Planck Tab 7 
-    if (abs(zref-2.6)<0.0001):
-        q1 = 0.781; q2=0; k_p = 21.1; k_v = 1.15; a_v = 0.611; b_v = 1.64 # Planck Tab 7 
-    if (abs(zref-2.4)<0.0001):
-        q1 = 0.851; q2=0; k_p = 19.5; k_v = 1.06; a_v = 0.548; b_v = 1.61 # Planck Tab 7 
-        #q1 = -0.0020; q2=0.623; k_p = 10.9; k_v = 0.517; a_v = 0.152; b_v = 1.62 # Planck Tab 5 
-    # if (abs(zref-2.2)<0.0001):
-    if zref <= 2.2001:
-        q1 = 0.867; q2=0; k_p = 19.4; k_v = 1.06; a_v = 0.514; b_v = 1.60 # Planck Tab 7 
-    Delta2 = k**3 * P(k) * Growth * Growth /2/np.pi**2
+# D_NL of Arinyo-i-Prats et al. 2015, Planck Tab 7, for z = 2.2, ..., 3.0.
+# Between these redshifts the parameters are linearly interpolated; below 2.2
+# and above 3.0 they are those of z = 2.2 and z = 3.0
+PRATS_Z = np.array([2.2, 2.4, 2.6, 2.8, 3.0])
+PRATS_Q1 = np.array([0.867, 0.851, 0.781, 0.773, 0.792])
+PRATS_Q2 = np.array([0, 0, 0, 0, 0])
+PRATS_KP = np.array([19.4, 19.5, 21.1, 19.2, 17.1])
+PRATS_KV = np.array([1.06, 1.06, 1.15, 1.16, 1.16])
+PRATS_AV = np.array([0.514, 0.548, 0.611, 0.608, 0.578])
+PRATS_BV = np.array([1.60, 1.61, 1.64, 1.65, 1.63])
+#q1 = -0.0020; q2=0.623; k_p = 10.9; k_v = 0.517; a_v = 0.152; b_v = 1.62 # Planck Tab 5 at z=2.4
+
+def D_Prats(k,mu,Pk,zref,Growth):
+    # Pk = P(k)
+    q1 = np.interp(zref, PRATS_Z, PRATS_Q1)
+    q2 = np.interp(zref, PRATS_Z, PRATS_Q2)
+    k_p = np.interp(zref, PRATS_Z, PRATS_KP)
+    k_v = np.interp(zref, PRATS_Z, PRATS_KV)
+    a_v = np.interp(zref, PRATS_Z, PRATS_AV)
+    b_v = np.interp(zref, PRATS_Z, PRATS_BV)
+    Delta2 = k**3 * Pk * Growth * Growth /2/np.pi**2
     return np.exp ( (q1 * Delta2 + q2 * Delta2**2) * (1-(k/k_v)**a_v * mu**b_v ) - (k/k_p)**2 )
 
 def P_RSD_Prats(k_par,k_perp,P, beta,zref,Growth):
     k=np.sqrt(k_par*k_par+k_perp*k_perp)
     mu = k_par/np.maximum(k,1E-15)
-    return (1+beta*mu**2)**2 * P(k) * D_Prats(k,mu,P,zref,Growth)
+    Pk = P(k)
+    return (1+beta*mu**2)**2 * Pk * D_Prats(k,mu,Pk,zref,Growth)
 
 
 # def PW2(k, DX) :
@@ -72,8 +79,9 @@ parser.add_argument("--beta", type=float, required=True,
 parser.add_argument("--voxel-size", type=float, default=2.19, required=False,
     help="value of voxel-size (delta large scale)")
 
-parser.add_argument("--zref", type=float, default=2.2, required=False,
-    help="value of redshift")
+parser.add_argument("--zref", type=float, nargs='+', default=[2.2], required=False,
+    help="value(s) of redshift. With several values, the (z,k) table of "
+    "etc/pkmiss_interp.fits.gz (HDUs z, k, pk, sigma) is written")
 
 parser.add_argument("--k-max", type=float, default=20., required=False,
     help="kmax to compute the missing 1D power spectrum")
@@ -81,6 +89,19 @@ parser.add_argument("--k-max", type=float, default=20., required=False,
 parser.add_argument("--dk", type=float, default=0.001, required=False,
     help="dk to compute the missing 1D power spectrum")
 
+parser.add_argument("--block", type=int, default=256, required=False,
+    help="number of k_par evaluated at once in the RSD projections")
+
+parser.add_argument("--n-gauss", type=int, default=0, required=False,
+    help="if > 0, integrate over k_perp with n-gauss Gauss-Legendre points "
+    "per segment of width --gauss-width instead of the dk grid")
+
+parser.add_argument("--gauss-width", type=float, default=0.05, required=False,
+    help="width of the Gauss-Legendre segments in k_perp")
+
+parser.add_argument("--pixel", type=float, default=0.2, required=False,
+    help="pixel size of the spectra, for the sigma HDU of the (z,k) table")
+
 parser.add_argument("--plot-p1d", action='store_true', required=False,
     help="plot the missing 1D power spectrum")
 
@@ -100,13 +121,13 @@ beta = args.beta
 kmax = args.k_max
 dk = args.dk
 linear = args.linear # False if not specified
-zref = args.zref
+zrefs = args.zref
 print("The missing 1D power spectrum will be saved in {}".format(outfile))
 print("It will be computed with "+
 "RSD={} and beta={}; voxcel={}; kmax={}; dk={}".format(RSD, beta, DX, kmax, dk))
 if not linear:
-    print("z_ref = {}".format(zref))
-    if zref > 3 or zref < 2.2:
+    print("z_ref = {}".format(zrefs))
+    if max(zrefs) > 3 or min(zrefs) < 2.2:
         # zref = 3
         # print("Redshift is set to {} for all z > 3".format(zref))
         print("Redshift above 3 will be extrapolated from z=3, bellow 2.2 will be extrapolated from z=2.2")
@@ -121,17 +142,38 @@ kny = PI/DX
 #.................................     compute P1D
 P1Dcamb = powerspectrum.P_1D(kk,Pcamb).P1D(kk)
 
+# The RSD P^3D(k_par, k_perp) are never stored: they are evaluated
+# --block k_par at a time and projected over k_perp block by block
+# (powerspectrum.P1D_RSD_projection)
 if RSD:
     k_par = np.arange(kmax/dk)*dk
-    k_par_t = k_par.reshape(len(k_par),-1)
-    k_perp = np.arange(kmax/dk)*dk
-    k_perp_t = k_perp.reshape(len(k_perp),-1)
+    weights = None
+    if args.n_gauss > 0:
+        edges = np.append(np.arange(0, kmax, args.gauss_width), kmax)
+        def k_perp(k_par_t):
+            # PW2cut is discontinuous at |k| = kny, i.e. at
+            # k_perp = sqrt(kny^2 - k_par^2): one more segment edge there
+            # (an empty segment at 0 for k_par >= kny)
+            kcut = np.sqrt(np.maximum(kny*kny - k_par_t*k_par_t, 0))
+            rows = np.concatenate([np.broadcast_to(edges, (len(k_par_t), len(edges))), kcut], axis=1)
+            return powerspectrum.gauss_legendre(np.sort(rows, axis=1), args.n_gauss)
+        print("k_perp: {} Gauss-Legendre points per k_par".format(len(edges)*args.n_gauss))
+    else:
+        k_perp = np.arange(kmax/dk)*dk
+
+    def P1D_RSD(P):
+        P1D = powerspectrum.P1D_RSD_projection(k_par, k_perp, P, nblock=args.block, weights=weights)
+        return interpolate.InterpolatedUnivariateSpline(k_par, P1D)(kk)
+
+    P1DcambRSD = {}
     if (linear) :
-        PRSD = P_RSD(k_par_t,k_perp,P_camb.P, beta)
-    else :
-        Growth = util.fgrowth(zref, constant.omega_M_0)
-        PRSD = P_RSD_Prats(k_par_t,k_perp,P_camb.P, beta, zref,Growth)
-    P1DcambRSD = powerspectrum.P_1D_RSD(k_par,k_perp,PRSD).P1D(kk)
+        P1DcambRSD_lin = P1D_RSD(lambda k_par_t, k_perp: P_RSD(k_par_t,k_perp,P_camb.P, beta))
+    for zref in zrefs:
+        if (linear) :
+            P1DcambRSD[zref] = P1DcambRSD_lin
+        else :
+            Growth = util.fgrowth(zref, constant.omega_M_0)
+            P1DcambRSD[zref] = P1D_RSD(lambda k_par_t, k_perp: P_RSD_Prats(k_par_t,k_perp,P_camb.P, beta, zref,Growth))
 
 #print ("0")
 #plt.show()
@@ -176,28 +218,43 @@ W = np.exp(- DX*DX*kk_cut*kk_cut/2)
 P1DWcutcamb = powerspectrum.P_1D(kk_cut,Pcamb_cut*W*W).P1D(kk)
 
 if RSD:
-    PRSD = P_RSD(k_par_t,k_perp,PW2cut, beta)
-    P1DWcutcambRSD = powerspectrum.P_1D_RSD(k_par,k_perp,PRSD).P1D(kk)
+    P1DWcutcambRSD = P1D_RSD(lambda k_par_t, k_perp: P_RSD(k_par_t,k_perp,PW2cut, beta))
 
 #.................................      missing P^1D(k)
 P1Dmissing = interpolate.InterpolatedUnivariateSpline(kk, np.maximum(P1Dcamb - P1DWcutcamb, 0))
 
 if RSD:
-    P1DmissingRSD = interpolate.InterpolatedUnivariateSpline(kk, np.maximum(P1DcambRSD - P1DWcutcambRSD, 0))
+    P1DmissingRSD = {}
+    for zref in zrefs:
+        P1DmissingRSD[zref] = interpolate.InterpolatedUnivariateSpline(kk, np.maximum(P1DcambRSD[zref] - P1DWcutcambRSD, 0))
 
 # Write to fits file
 print("P1D computed. Writting file...")
 outfits = fitsio.FITS(outfile, 'rw', clobber=True)
-table = [kk, P1Dmissing(kk)]
-names = ['k', 'P1Dmiss']
-if RSD:
-    table.append(P1DmissingRSD(kk))
-    names.append('P1DmissRSD')
-outfits.write(table, names=names, extname='P1D')
-outfits[-1].write_key('beta', beta)
-outfits[-1].write_key('voxel', DX)
-outfits[-1].write_key('kmax', kmax)
-outfits[-1].write_key('dk', dk)
+if len(zrefs) == 1:
+    table = [kk, P1Dmissing(kk)]
+    names = ['k', 'P1Dmiss']
+    if RSD:
+        table.append(P1DmissingRSD[zrefs[0]](kk))
+        names.append('P1DmissRSD')
+    outfits.write(table, names=names, extname='P1D')
+    outfits[-1].write_key('beta', beta)
+    outfits[-1].write_key('voxel', DX)
+    outfits[-1].write_key('kmax', kmax)
+    outfits[-1].write_key('dk', dk)
+else:
+    # (z,k) table read by util.InterpP1Dmissing
+    pk = []
+    sigma = []
+    for zref in zrefs:
+        p1dmiss = P1DmissingRSD[zref] if RSD else P1Dmissing
+        pk.append(p1dmiss(kk))
+        sigma.append(util.sigma_p1d(p1dmiss=p1dmiss, pixel=args.pixel))
+    hdict = {'beta': beta, 'voxel': DX, 'kmax': kmax, 'dk': dk, 'RSD': RSD, 'pixel': args.pixel}
+    outfits.write(np.array(zrefs), extname='z', header=hdict)
+    outfits.write(kk, extname='k')
+    outfits.write(np.array(pk), extname='pk')
+    outfits.write(np.array(sigma), extname='sigma')
 outfits.close()
 print("Wrote {}".format(outfile))
 
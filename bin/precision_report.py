@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Error induced on ETA_PAR and VELO_PAR by the reduced precision storage of
+# the eta and velocity boxes (make_boxes.py -precision float16 / int16).
+# The float32 boxes of boxdir are encoded and decoded slab by slab as
+# make_boxes would store them, and the line of sight projections
+#   ETA_PAR = sum_ij u_i u_j eta_ij    VELO_PAR = u.v
+# are compared cell by cell, for a random direction u per cell.
+# This is conservative: make_spectra further averages the cells with
+# gaussian weights, which reduces the rounding errors.
+import numpy as np
+import fitsio
+import argparse
+import time
+from SaclayMocks import boxio
+
+
+def main():
+    t0 = time.time()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-boxdir", help="directory of the float32 boxes produced by make_boxes.py")
+    parser.add_argument("-ixmin", type=int, help="first x plane used, default 0", default=0)
+    parser.add_argument("-nx", type=int, help="number of x planes used, default 16", default=16)
+    parser.add_argument("-chunk", type=int, help="x planes per chunk for hdf5 boxes, default 1", default=1)
+    parser.add_argument("-seed", type=int, help="seed of the directions, default 0", default=0)
+    parser.add_argument("-out", help="fits file where the report is saved, default None", default=None)
+
+    args = parser.parse_args()
+    ix0 = args.ixmin
+    ix1 = ix0 + args.nx
+    precisions = ['float16', 'int16']
+
+    def read(name):
+        '''float32 box and its versions stored in each precision'''
+        reader = boxio.BoxReader(args.boxdir, name)
+        data = reader.read(ix0, ix1)
+        if reader.h5:
+            bounds = np.append(np.arange(0, reader.NX, args.chunk), reader.NX)
+        else:
+            bounds = reader.bounds
+        stored = {}
+        for precision in precisions:
+            stored[precision] = np.empty_like(data)
+            i = ix0
+            while i < ix1:
+                # slabs as stored by make_boxes
+                i_end = min(bounds[np.searchsorted(bounds, i, side='right')], ix1)
+                enc, scale, offset = boxio.encode(data[i-ix0:i_end-ix0], precision)
+                stored[precision][i-ix0:i_end-ix0] = boxio.decode(enc, precision, scale, offset)
+                i = i_end
+        return data, stored
+
+    # random isotropic direction in each cell
+    print("Reading eta and velocity boxes {} <= ix < {} in {}".format(ix0, ix1, args.boxdir))
+    eta, eta_stored = read('eta_xx')
+    np.random.seed(args.seed)
+    u = np.random.normal(size=(3,)+eta.shape).astype(np.float32)
+    u /= np.sqrt((u**2).sum(axis=0))
+
+    eta_par = np.zeros(eta.shape, dtype=np.float32)
+    eta_par_stored = {p: np.zeros(eta.shape, dtype=np.float32) for p in precisions}
+    velo_par = np.zeros(eta.shape, dtype=np.float32)
+    velo_par_stored = {p: np.zeros(eta.shape, dtype=np.float32) for p in precisions}
+    for ij in ['xx', 'yy', 'zz', 'xy', 'xz', 'yz']:
+        if ij != 'xx':
+            eta, eta_stored = read('eta_'+ij)
+        i = 'xyz'.index(ij[0])
+        j = 'xyz'.index(ij[1])
+        w = u[i] * u[j]
+        if i != j:
+            w *= 2
+        eta_par += w * eta
+        for p in precisions:
+            eta_par_stored[p] += w * eta_stored[p]
+    for i, x in enumerate('xyz'):
+        v, v_stored = read('v'+x)
+        velo_par += u[i] * v
+        for p in precisions:
+            velo_par_stored[p] += u[i] * v_stored[p]
+
+    #...............................  report
+    rows = []
+    print("{:>9} {:>9} {:>12} {:>12} {:>12} {:>12}".format("quantity", "precision", "rms", "rms error", "max error", "rel rms err"))
+    for name, true, stored in [('ETA_PAR', eta_par, eta_par_stored), ('VELO_PAR', velo_par, velo_par_stored)]:
+        rms = np.sqrt(np.mean(true.astype(np.float64)**2))
+        for p in precisions:
+            err = (stored[p] - true).astype(np.float64)
+            rms_err = np.sqrt(np.mean(err**2))
+            max_err = np.abs(err).max()
+            rows.append((name, p, rms, rms_err, max_err, rms_err/rms))
+            print("{:>9} {:>9} {:12.4e} {:12.4e} {:12.4e} {:12.4e}".format(name, p, rms, rms_err, max_err, rms_err/rms))
+
+    if args.out is not None:
+        table = np.array(rows, dtype=[('QUANTITY', 'S8'), ('PRECISION', 'S7'), ('RMS', 'f8'),
+                                      ('RMS_ERR', 'f8'), ('MAX_ERR', 'f8'), ('REL_RMS_ERR', 'f8')])
+        fitsio.write(args.out, table, header={'BOXDIR': args.boxdir, 'IXMIN': ix0, 'NX': args.nx}, clobber=True)
+        print("Report written in {}".format(args.out))
+    print("Took {}s".format(time.time()-t0))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from __future__ import division, print_function
 import os, sys
+import time
 import argparse
 import subprocess
 import healpy as hp
@@ -378,7 +379,7 @@ def boxes(mock_args, sbatch_args):
     '''
     script = get_header(mock_args, sbatch_args, "boxes")
     script += """echo "Running run_boxes.sh"\n"""
-    script += """echo "command: make_boxes.py -NX {nx} -NY {ny} -NZ {nz} -nHDU {nslice} -PkDir {path_pk} -outDir {path_boxes} -ncpu {threads} -pixel {pixel} -rsd {rsd} {seed} "\n""".format(nx=mock_args['nx'], ny=mock_args['ny'], nz=mock_args['nz'], nslice=mock_args['nslice'], path_pk=mock_args['dir_pk'], threads=sbatch_args['threads_boxes'], path_boxes=mock_args['dir_boxes-{}'.format(mock_args['i_chunk'])], pixel=mock_args['pixel_size'], rsd=mock_args['rsd'], seed=mock_args['seed'])
+    script += """echo "command: make_boxes.py -NX {nx} -NY {ny} -NZ {nz} -nHDU {nslice} -PkDir {path_pk} -outDir {path_boxes} -ncpu {threads} -pixel {pixel} -rsd {rsd} -nproc {nproc} -nwriter {nwriter} -kspace {kspace} -rng {rng} -rsdfields {rsdfields} -pkgrid {pkgrid} -run_id {run_id} {seed} "\n""".format(nx=mock_args['nx'], ny=mock_args['ny'], nz=mock_args['nz'], nslice=mock_args['nslice'], path_pk=mock_args['dir_pk'], threads=sbatch_args['threads_boxes'], path_boxes=mock_args['dir_boxes-{}'.format(mock_args['i_chunk'])], pixel=mock_args['pixel_size'], rsd=mock_args['rsd'], nproc=sbatch_args['nproc_boxes'], nwriter=sbatch_args['nwriter_boxes'], kspace=mock_args['kspace_grf'], rng=mock_args['rng'], rsdfields=mock_args['rsd_fields'], pkgrid=mock_args['pk_grid'], run_id=box_run_id(mock_args, mock_args['i_chunk']), seed=mock_args['seed'])
     if mock_args['use_time']:
         script += """/usr/bin/time -f "%eReal %Uuser %Ssystem %PCPU %M " """
     if mock_args['sbatch']:
@@ -386,7 +387,7 @@ def boxes(mock_args, sbatch_args):
         if mock_args['verbosity'] is not None:
             script += mock_args['verbosity']
         script += " -N 1 -n 1 -c 64 "
-    script += "make_boxes.py -NX {nx} -NY {ny} -NZ {nz} -nHDU {nslice} -PkDir {path_pk} -outDir {path_boxes} -ncpu {threads} -pixel {pixel} -rsd {rsd} {seed} ".format(nx=mock_args['nx'], ny=mock_args['ny'], nz=mock_args['nz'], nslice=mock_args['nslice'], path_pk=mock_args['dir_pk'], threads=sbatch_args['threads_boxes'], path_boxes=mock_args['dir_boxes-{}'.format(mock_args['i_chunk'])], pixel=mock_args['pixel_size'], rsd=mock_args['rsd'], seed=mock_args['seed'])
+    script += "make_boxes.py -NX {nx} -NY {ny} -NZ {nz} -nHDU {nslice} -PkDir {path_pk} -outDir {path_boxes} -ncpu {threads} -pixel {pixel} -rsd {rsd} -nproc {nproc} -nwriter {nwriter} -kspace {kspace} -rng {rng} -rsdfields {rsdfields} -pkgrid {pkgrid} -run_id {run_id} {seed} ".format(nx=mock_args['nx'], ny=mock_args['ny'], nz=mock_args['nz'], nslice=mock_args['nslice'], path_pk=mock_args['dir_pk'], threads=sbatch_args['threads_boxes'], path_boxes=mock_args['dir_boxes-{}'.format(mock_args['i_chunk'])], pixel=mock_args['pixel_size'], rsd=mock_args['rsd'], nproc=sbatch_args['nproc_boxes'], nwriter=sbatch_args['nwriter_boxes'], kspace=mock_args['kspace_grf'], rng=mock_args['rng'], rsdfields=mock_args['rsd_fields'], pkgrid=mock_args['pk_grid'], run_id=box_run_id(mock_args, mock_args['i_chunk']), seed=mock_args['seed'])
     script += "&> {path}/make_boxes.log \n".format(path=mock_args['logs_dir_chunk-{}'.format(mock_args['i_chunk'])])
     script += """
 if [ $? -ne 0 ]; then
@@ -404,6 +405,30 @@ echo "----- END -----"
     fout.close()
 
 
+def box_run_id(mock_args, cid):
+    '''
+    identifier of the make_boxes.py run of the chunk cid (see SaclayMocks.manifest)
+    '''
+    return "{}-{}".format(mock_args['run_id'], cid)
+
+
+def wait_options(mock_args, sbatch_args, run_boxes, cid):
+    '''
+    options of the codes reading the boxes of the chunk cid while make_boxes.py writes them
+    '''
+    # make_boxes.py is done, or killed, after the time limit of its job
+    days, _, hms = sbatch_args['time_boxes'].rpartition('-')
+    timeout = 0
+    for n in hms.split(":"):
+        timeout = 60*timeout + int(n)
+    timeout += 24*3600*int(days or 0)
+    options = " -wait True -wait_timeout {}".format(timeout)
+    if run_boxes:
+        # the boxes of an older run in the same directory are not read
+        options += " -run_id {}".format(box_run_id(mock_args, cid))
+    return options
+
+
 def chunk(todo, mock_args, sbatch_args):
     '''
     Write a .sh file to submit jobs that produce the different chunks
@@ -548,7 +573,7 @@ fi
         for job in range(sbatch_args['threads_mergechunks']):
             if mock_args['use_time']:
                 script += """/usr/bin/time -f "%eReal %Uuser %Ssystem %PCPU %M " """
-            script += "make_transmissions.py -inDir {inpath} -outDir {outpath} -nside {nside} -nest {nest} -job {job} -ncpu {threads} -dla {dla} ".format(inpath=mock_args['base_dir'], outpath=mock_args['out_dir'], nside=mock_args['nside'], nest=mock_args['nest'], job=job, threads=sbatch_args['threads_mergechunks'], dla=mock_args['dla'])
+            script += "make_transmissions.py -inDir {inpath} -outDir {outpath} -nside {nside} -nest {nest} -job {job} -ncpu {threads} -dla {dla} -desi {desi} ".format(inpath=mock_args['base_dir'], outpath=mock_args['out_dir'], nside=mock_args['nside'], nest=mock_args['nest'], job=job, threads=sbatch_args['threads_mergechunks'], dla=mock_args['dla'], desi=mock_args['desifootprint'])
             script += "&> {path}/make_transmissions-{job}.log &\n".format(path=mock_args['logs_dir_mergechunks'], job=job)
             script += """pids+=" $!"\n"""
         script += get_errors("make_transmissions", 0)
@@ -850,6 +875,8 @@ def make_realisation(imock, mock_args, run_args, sbatch_args):
                 mock_args[k] = mock_args[k].replace(mock_args['mock_dir'], "$DW_PERSISTENT_STRIPED_{name}".format(name=mock_args['bb_name']))
 
     ### Write scripts for each chunks:
+    # all the draw_randoms.py jobs of the realisation need the same seed
+    seed_randoms = mock_args['seed'] or "-seed {}".format(np.random.randint(2**31 - 1))
     if run_args['run_boxes'] or run_args['run_chunks']:
         for i, cid in enumerate(mock_args['chunkid']):
             mock_args['i_chunk'] = cid
@@ -873,24 +900,23 @@ def make_realisation(imock, mock_args, run_args, sbatch_args):
                         mock_args['args_draw_qso'] += " -rsd "+str(mock_args['rsd'])
                         # mock_args['args_draw_qso'] += " "+mock_args['seed']+" "+mock_args['zfix']
                         mock_args['args_draw_qso'] += " "+mock_args['seed']
+                        if mock_args['stream_boxes']:
+                            mock_args['args_draw_qso'] += wait_options(mock_args, sbatch_args, run_args['run_boxes'], cid)
                         run_python_script(node, cid, "draw_qso", mock_args, sbatch_args)
                     if run_args['randoms']:
-                        mock_args['args_draw_qso'] = "-Nslice "+str(mock_args['nslice'])
-                        mock_args['args_draw_qso'] += " -indir "+mock_args['dir_boxes-'+cid]
-                        mock_args['args_draw_qso'] += " -outpath "+mock_args['dir_rand-'+cid]
-                        mock_args['args_draw_qso'] += " -ra0 "+mock_args['ra0'][i]
-                        mock_args['args_draw_qso'] += " -dec0 "+mock_args['dec0'][i]
-                        mock_args['args_draw_qso'] += " -chunk "+cid
-                        mock_args['args_draw_qso'] += " -dra "+mock_args['dra'][i]
-                        mock_args['args_draw_qso'] += " -ddec "+mock_args['ddec'][i]
-                        mock_args['args_draw_qso'] += " -zmin "+str(mock_args['zmin'])
-                        mock_args['args_draw_qso'] += " -zmax "+str(mock_args['zmax'])
-                        mock_args['args_draw_qso'] += " -desi "+str(mock_args['desifootprint'])
-                        mock_args['args_draw_qso'] += " -rsd "+str(mock_args['rsd'])
-                        # mock_args['args_draw_qso'] += " "+mock_args['seed']+" "+mock_args['zfix']
-                        mock_args['args_draw_qso'] += " "+mock_args['seed']
-                        mock_args['args_draw_qso'] += " -random True "
-                        run_python_script(node, cid, "draw_qso", mock_args, sbatch_args, "randoms")
+                        # drawn from the footprint and dN/dz, without the boxes
+                        mock_args['args_draw_randoms'] = "-ncpu "+str(mock_args['nslice'])
+                        mock_args['args_draw_randoms'] += " -outpath "+mock_args['dir_rand-'+cid]
+                        mock_args['args_draw_randoms'] += " -ra0 "+mock_args['ra0'][i]
+                        mock_args['args_draw_randoms'] += " -dec0 "+mock_args['dec0'][i]
+                        mock_args['args_draw_randoms'] += " -dra "+mock_args['dra'][i]
+                        mock_args['args_draw_randoms'] += " -ddec "+mock_args['ddec'][i]
+                        mock_args['args_draw_randoms'] += " -zmin "+str(mock_args['zmin'])
+                        mock_args['args_draw_randoms'] += " -zmax "+str(mock_args['zmax'])
+                        mock_args['args_draw_randoms'] += " -desi "+str(mock_args['desifootprint'])
+                        mock_args['args_draw_randoms'] += " -mult "+str(mock_args['randoms_mult'])
+                        mock_args['args_draw_randoms'] += " "+seed_randoms
+                        run_python_script(node, cid, "draw_randoms", mock_args, sbatch_args, "randoms")
                     if run_args['make_spectra']:
                         mock_args['args_make_spectra'] = "-QSOfile "+mock_args['dir_qso-'+cid]+"/QSO-"
                         mock_args['args_make_spectra'] += " -boxdir "+mock_args['dir_boxes-'+cid]
@@ -900,6 +926,8 @@ def make_realisation(imock, mock_args, run_args, sbatch_args):
                         mock_args['args_make_spectra'] += " -zmax "+str(mock_args['zmax'])
                         mock_args['args_make_spectra'] += " -rsd "+str(mock_args['rsd'])
                         mock_args['args_make_spectra'] += " -dla "+str(mock_args['dla'])
+                        if mock_args['stream_boxes']:
+                            mock_args['args_make_spectra'] += wait_options(mock_args, sbatch_args, run_args['run_boxes'], cid)
                         run_python_script(node, cid, "make_spectra", mock_args, sbatch_args)
                     if run_args['merge_spectra']:
                         mock_args['args_merge_spectra'] = "-inDir "+mock_args['dir_spectra-'+cid]
@@ -982,9 +1010,15 @@ def submit(mock_args, run_args):
             if run_args['run_chunks']:
                 script += "run_chunk_{i}=$(sbatch --parsable ".format(i=cid)
                 if run_args['run_boxes'] or ((run_args['run_create'] or run_args['run_stagein']) and mock_args['burst_buffer']):
-                    script += "-d afterok:"
+                    if run_args['run_boxes'] and mock_args['stream_boxes']:
+                        # the chunk reads the boxes as they are written
+                        script += "-d after:$run_boxes_{i}".format(i=cid)
+                        if mock_args['burst_buffer'] and (run_args['run_create'] or run_args['run_stagein']):
+                            script += ",afterok:"
+                    else:
+                        script += "-d afterok:"
                     afterok = ""
-                    if run_args['run_boxes']:
+                    if run_args['run_boxes'] and not mock_args['stream_boxes']:
                         afterok += "$run_boxes_{i},".format(i=cid)
                     if mock_args['burst_buffer']:
                         if run_args['run_create']:
@@ -1150,6 +1184,8 @@ def main():
     sbatch_args['name_boxes'] = "boxes_saclay"
     sbatch_args['threads_boxes'] = 64  # default 64
     sbatch_args['nodes_boxes'] = 1  # default 1
+    sbatch_args['nproc_boxes'] = 1  # processes of the slab-decomposed FFT, 1 is single process FFTW
+    sbatch_args['nwriter_boxes'] = 0  # processes writing the boxes during the next FFTs, 0 is synchronous writing
     # Parameters for chunk jobs:
     sbatch_args['time_chunk'] = "00:30:00"  # default "00:30:00"
     sbatch_args['queue_chunk'] = "regular"  # default "regular"
@@ -1183,9 +1219,16 @@ def main():
     # mock options:
     mock_args['seed'] = ""  # "-seed 10" to specify a seed, "" to specify nothing
     mock_args['desifootprint'] = True  # If True, cut QSO outside desi footprint
+    mock_args['randoms_mult'] = 10  # density of the randoms in units of the QSO density (draw_randoms.py)
     mock_args['NQSO'] = -1  # If >0, limit the number of QSO treated in make_spectra
     mock_args['small_scales'] = True  # If True, add small scales in FGPA
     mock_args['rsd'] = True  # If True, add RSD
+    mock_args['kspace_grf'] = False  # If True, draw the GRF white noise directly in k space
+    mock_args['rng'] = 'philox'  # GRF white noise generator; 'legacy' (with kspace_grf False) reproduces the boxes of a seed of the versions before the philox one
+    mock_args['stream_boxes'] = False  # If True, run_chunk starts with run_boxes and each slice waits for its boxes
+    mock_args['run_id'] = "{}-{}".format(int(time.time()), os.getpid())  # identifies the make_boxes.py runs of this submission, for the slices waiting for their boxes
+    mock_args['pk_grid'] = True  # If False, make_boxes evaluates P(k) on the fly from 1D tables and run_pk is not needed
+    mock_args['rsd_fields'] = 'eta'  # 'eta' or 'velocity': only store vx, vy, vz and derive eta_par from the velocity gradient
     mock_args['dla'] = True  # If True, add DLA
     mock_args['nmin'] = 17.2  # log(N_HI) min for DLA
     mock_args['nmax'] = 22.5  # log(N_HI) max for DLA
@@ -1209,7 +1252,7 @@ def main():
     # chunks:
     run_args['run_chunks'] = False  # produce chunks
     run_args['draw_qso'] = False  # run draw_qso.py
-    run_args['randoms'] = False  # run draw_qso.py for randoms
+    run_args['randoms'] = False  # run draw_randoms.py
     run_args['make_spectra'] = False  # run make_spectra.py
     run_args['merge_spectra'] = True  # run merge_spectra.py
     # merge chunks:
@@ -1288,6 +1331,10 @@ def main():
         run_args['merge_spectra'] = True
         run_args['run_mergechunks'] = False
 
+    if run_args['run_pk'] and not mock_args['pk_grid']:
+        print("Warning: pk_grid is False, make_boxes does not read the Pk grids: run_pk is skipped.")
+        run_args['run_pk'] = False
+
     ### Define sbatch options
     if not mock_args['sbatch']:
         print("Warning: the jobs will not be sent to cori nodes, they will be executed here.")
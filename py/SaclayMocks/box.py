@@ -1,6 +1,5 @@
 import scipy as sp
 import numpy as np
-from scipy import random
 PI = np.pi
 
 
@@ -0,0 +1,212 @@
+# Plan of the boxes derived from the white noise boxk in make_boxes.py
+# Each field is boxk * sqrt(P(k)/Vcell) * k-space factor, inverse FFTed.
+# The pristine boxk stays resident (possibly as a read-only memmap) and
+# each field is built x-block by x-block into one reusable scratch buffer,
+# so the multi-GB boxk.npy is read once instead of once per field.
+# With stream=True the P(k) grids are also read block by block from the
+# fits file, so boxk can stay out of core and at most one full k-space grid
+# (the scratch buffer) is resident. With a RadialPk, the P(k) grids are
+# not read at all but evaluated block by block from 1D tables of |k|.
+import time
+import numpy as np
+import fitsio
+
+
+#********************************************************************
+class Field():
+    '''One derived box: name of the output files, P(k) extension in the
+    P(k) fits file, optional k-space factor and number of output files.
+    reducible fields can be stored in reduced precision (make_boxes -precision)'''
+    def __init__(self, name, pk_ext, factor=None, nHDU=1, reducible=False):
+        self.name = name
+        self.pk_ext = pk_ext
+        self.factor = factor   # None or a (kx, ky, kz, kk) -> array function
+        self.nHDU = nHDU
+        self.reducible = reducible
+
+
+def eta_factor(i, j):
+    '''k_i k_j / k^2, i and j in 'xyz' '''
+    def factor(kx, ky, kz, kk):
+        kv = {'x': kx, 'y': ky, 'z': kz}
+        return kv[i]*kv[j] / kk
+    return factor
+
+
+def velocity_factor(i, H0, dgrowth0):
+    '''-i k_i / k^2 H0 dD/dz(z=0)'''
+    def factor(kx, ky, kz, kk):
+        kv = {'x': kx, 'y': ky, 'z': kz}
+        return -1j*kv[i] / kk * H0 * dgrowth0
+    return factor
+
+
+def field_plan(nHDU, NX, rsd=True, H0=None, dgrowth0=None, eta=True):
+    '''List of the fields produced by make_boxes.py, in production order.
+    The velocities are produced before the eta boxes, so that draw_qso.py,
+    which needs boxln_* and v*, can run while the eta boxes are produced.
+    If not eta, the six eta_ij boxes are not produced: since
+    eta_ij = d_j v_i / (H0 dD/dz(z=0)), make_spectra.py gets
+    eta_par = d v_par / dr / (H0 dD/dz(z=0)) along each line of sight'''
+    nHDU_bis = NX  # we want 1 HDU per ix for box and eta
+    fields = [Field('boxln_1', 'Pln1', nHDU=nHDU),
+              Field('boxln_2', 'Pln2', nHDU=nHDU),
+              Field('boxln_3', 'Pln3', nHDU=nHDU),
+              Field('box', 'P0', nHDU=nHDU_bis)]
+    if rsd:
+        for i in 'xyz':
+            fields.append(Field('v'+i, 'P0', velocity_factor(i, H0, dgrowth0), nHDU, reducible=True))
+    if rsd and eta:
+        for ij in ['xx', 'yy', 'zz', 'xy', 'xz', 'yz']:
+            fields.append(Field('eta_'+ij, 'P0', eta_factor(ij[0], ij[1]), nHDU_bis, reducible=True))
+    return fields
+
+
+def blockwise_std(boxk, nblock=16):
+    '''np.std(boxk) computed block by block along x, without full-size
+    temporaries (boxk can be a memmap)'''
+    NX = boxk.shape[0]
+    s1 = 0j
+    s2 = 0.
+    for ix0 in range(0, NX, nblock):
+        blk = boxk[ix0:ix0+nblock]
+        s1 += blk.sum(dtype=np.complex128)
+        s2 += (blk.real.astype(np.float64)**2 + blk.imag.astype(np.float64)**2).sum()
+    n = float(boxk.size)
+    return np.sqrt(max(s2/n - abs(s1/n)**2, 0))
+
+
+#********************************************************************
+class RadialPk():
+    '''sqrt(P/Vcell) blocks evaluated on the fly from functions of |k|
+    (powerspectrum.box_pk) instead of being read from the P(k) fits file.
+    For a cubic box, |k|^2 = dk^2 (ix^2 + iy^2 + iz^2) with integer ix, iy, iz:
+    each function is tabulated once on these integers and the blocks are
+    looked up. Otherwise, it is tabulated on a fine regular |k| grid and the
+    blocks are linearly interpolated, the grid index being computed directly.'''
+    def __init__(self, functions, Dcell, NX, NY, NZ, ntable=2**20):
+        self.functions = functions
+        self.tables = {}
+        k_ny = np.pi / Dcell
+        self.cubic = (NX == NY == NZ)
+        if self.cubic:
+            self.dk = 2 * k_ny / NX
+            self.ix2 = (np.fft.fftfreq(NX) * NX).astype(np.int32)**2  # (NX)
+            self.iy2 = self.ix2.reshape(-1, 1)  # (NY,1)
+            self.iz2 = self.ix2[:NZ//2+1].copy()  # (NZ/2+1)
+            self.iz2[-1] = (NZ//2)**2  # rfftfreq: the last kz is +k_ny
+            self.ktable = np.sqrt(np.arange(3*(NX//2)**2+1)) * self.dk
+        else:
+            self.kx = np.float32(np.fft.fftfreq(NX) * 2 * k_ny)  # (NX)
+            self.ky = np.float32(np.fft.fftfreq(NY) * 2 * k_ny).reshape(-1, 1)  # (NY,1)
+            self.kz = np.float32(np.fft.rfftfreq(NZ) * 2 * k_ny)  # (NZ/2+1)
+            # up to sqrt(3) k_ny, with one more point so that i+1 is always valid
+            self.dk = np.sqrt(3) * k_ny / (ntable - 1)
+            self.ktable = np.arange(ntable+1) * self.dk
+
+    def table(self, ext):
+        if ext not in self.tables:
+            self.tables[ext] = self.functions[ext](self.ktable)
+        return self.tables[ext]
+
+    def block(self, ext, ix0, ix1):
+        '''sqrt(P/Vcell)[ix0:ix1], float32'''
+        table = self.table(ext)
+        if self.cubic:
+            n = self.ix2[ix0:ix1].reshape(-1, 1, 1) + self.iy2 + self.iz2
+            return table[n]
+        kx = self.kx[ix0:ix1].reshape(-1, 1, 1)
+        u = np.sqrt(kx*kx + self.ky*self.ky + self.kz*self.kz)
+        u *= np.float32(1 / self.dk)
+        i = u.astype(np.int32)
+        u -= i  # weight of table[i+1]
+        P = table[i+1] - table[i]
+        P *= u
+        P += table[i]
+        return P
+
+
+#********************************************************************
+class FieldPlan():
+    '''Fill a scratch buffer with boxk * sqrt(P/Vcell) * factor for each field.
+    The P(k) grids are read once per extension; P0, used by 10 fields, is cached.
+    If stream, the P(k) grids are read x-block by x-block and never cached.
+    If radial (a RadialPk) is given, the P(k) grids are evaluated block by
+    block and Pfilename is not read.'''
+    def __init__(self, boxk, Pfilename, Dcell, NZ, nblock=16, stream=False, radial=None):
+        self.boxk = boxk
+        self.Pfilename = Pfilename
+        self.radial = radial
+        NX = boxk.shape[0]
+        NY = boxk.shape[1]
+        k_ny = np.pi / Dcell
+        self.kx = np.float32(np.fft.fftfreq(NX) * 2 * k_ny)  # (NX)
+        self.ky = np.float32(np.fft.fftfreq(NY) * 2 * k_ny).reshape(-1, 1)  # (NY,1)
+        self.kz = np.float32(np.fft.rfftfreq(NZ) * 2 * k_ny)  # (NZ/2+1)
+        self.nblock = nblock
+        self.stream = stream
+        self.pk_cache = {}
+        self.timings = []
+
+    def pk(self, ext):
+        if ext in self.pk_cache:
+            return self.pk_cache[ext]
+        P = fitsio.read(self.Pfilename, ext=ext)
+        if ext == 'P0':
+            self.pk_cache[ext] = P
+        return P
+
+    def pk_blocks(self, ext):
+        '''Iterate over (ix0, ix1, P[ix0:ix1])'''
+        NX = self.boxk.shape[0]
+        if self.radial is not None:
+            for ix0 in range(0, NX, self.nblock):
+                ix1 = min(ix0+self.nblock, NX)
+                yield ix0, ix1, self.radial.block(ext, ix0, ix1)
+        elif self.stream:
+            fits = fitsio.FITS(self.Pfilename)
+            for ix0 in range(0, NX, self.nblock):
+                ix1 = min(ix0+self.nblock, NX)
+                yield ix0, ix1, fits[ext][ix0:ix1, :, :]
+            fits.close()
+        else:
+            P = self.pk(ext)
+            for ix0 in range(0, NX, self.nblock):
+                ix1 = min(ix0+self.nblock, NX)
+                yield ix0, ix1, P[ix0:ix1]
+
+    def fill(self, field, scratch):
+        '''scratch = boxk * P * factor, block by block along kx.
+        The products are done in the same order and precision as the
+        former in place `boxk *= P; boxk *= factor` '''
+        t0 = time.time()
+        for ix0, ix1, P in self.pk_blocks(field.pk_ext):
+            blk = scratch[ix0:ix1]
+            blk[:] = self.boxk[ix0:ix1]
+            blk *= P
+            if field.factor is not None:
+                kx = self.kx[ix0:ix1].reshape(-1, 1, 1)  # (nblock,1,1)
+                kk = kx*kx + self.ky*self.ky + self.kz*self.kz
+                if ix0 == 0:
+                    kk[0, 0, 0] = 1  # avoid dividing by 0
+                blk *= field.factor(kx, self.ky, self.kz, kk)
+        return time.time() - t0
+
+    def divide_pk(self, ext):
+        '''boxk /= P, block by block, in place (boxk can be a r+ memmap).
+        Used to recover the white noise from the old boxk.npy files that
+        were saved multiplied by P0'''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for ix0, ix1, P in self.pk_blocks(ext):
+                self.boxk[ix0:ix1] /= P
+        self.boxk[0, 0, 0] = 0j
+        if isinstance(self.boxk, np.memmap):
+            self.boxk.flush()
+
+    def add_timing(self, name, t_fill, t_fft, t_write):
+        self.timings.append((name, t_fill, t_fft, t_write))
+
+    def print_timings(self):
+        print("{:>10} {:>10} {:>10} {:>10}".format("field", "k-mult(s)", "FFT(s)", "write(s)"))
+        for name, t_fill, t_fft, t_write in self.timings:
+            print("{:>10} {:10.2f} {:10.2f} {:10.2f}".format(name, t_fill, t_fft, t_write))
@@ -0,0 +1,333 @@
+# Writing and reading of the boxes produced by make_boxes.py
+# Each field is either written as nHDU fits files <field>-<i>.fits (default),
+# or as one chunked hdf5 file <field>.h5 (dataset 'box', chunks of a few
+# x-planes, optionally compressed), see write_slab. BoxReader reads x-ranges
+# of a field from whichever of the two is present. Files are written under a
+# temporary name and renamed, so that a reader never sees a partial file.
+#
+# SlabWriter writes them from forked worker processes (fitsio holds the
+# GIL), reading the output box from memory shared with the main process,
+# so that the writing of a field overlaps the k space multiply and FFT of
+# the next ones. The output boxes are double buffered: a buffer is reused
+# only once all its slabs are on disk, which bounds the memory to nbuf boxes.
+import os
+import glob
+import mmap
+import time
+import multiprocessing
+import numpy as np
+import fitsio
+from fitsio import FITS
+from SaclayMocks import manifest
+from SaclayMocks import boxstats
+
+
+_buffers = []   # shared output boxes, inherited by the forked writers
+
+
+#********************************************************************
+def shared_array(shape, dtype=np.float32):
+    '''Array in shared anonymous memory, seen by the processes forked
+    afterwards. It is page aligned, so it can be used by FFTW'''
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return np.frombuffer(mmap.mmap(-1, nbytes), dtype=dtype).reshape(shape)
+
+
+#********************************************************************
+# Reduced precision storage (opt-in, for the eta and velocity boxes):
+#   'float16': half precision floats. fits has no such type, so they are
+#              stored as their int16 bit pattern, with ENCODING = 'float16'
+#   'int16'  : round((data - OFFSET) / SCALE), SCALE and OFFSET being
+#              computed per slab (per fits file, per chunk in hdf5)
+def encode(data, precision='float32'):
+    '''Return (stored, scale, offset) of data in the given precision'''
+    if precision == 'float32':
+        return data, 1., 0.
+    if precision == 'float16':
+        return data.astype(np.float16), 1., 0.
+    if precision == 'int16':
+        dmin = float(data.min())
+        dmax = float(data.max())
+        offset = (dmax + dmin) / 2
+        scale = (dmax - dmin) / 65534
+        if scale == 0:
+            scale = 1.
+        stored = np.round((data - np.float32(offset)) / np.float32(scale)).astype(np.int16)
+        return stored, scale, offset
+    raise ValueError("Unknown precision {}".format(precision))
+
+
+def decode(stored, encoding='float32', scale=1., offset=0.):
+    '''Return the float32 data stored with encode. For fits files,
+    float16 data are read as their int16 bit pattern'''
+    if encoding == 'float16':
+        if stored.dtype != np.float16:
+            stored = stored.astype(np.int16).view(np.float16)
+        return stored.astype(np.float32)
+    if encoding == 'int16':
+        return stored.astype(np.float32) * np.float32(scale) + np.float32(offset)
+    return stored
+
+
+#********************************************************************
+def write_slab(box, filename, i0, i1, hdict, keys=(), options=None):
+    '''Write box[i0:i1] in filename, with the header hdict and the extra
+    keys [(name, value, comment)]. Return the crc32 of the stored data.
+    options = {'precision': 'float32' (default), 'float16' or 'int16'}
+    If filename ends with .h5, it is written as a chunked hdf5 dataset, with
+    options 'chunk' (number of x-planes per chunk) and 'compression' (None,
+    'lzf' or 'gzip')'''
+    if options is None:
+        options = {}
+    precision = options.get('precision', 'float32')
+    data = np.ascontiguousarray(box[i0:i1])  # box can be the real view of a padded FFT buffer
+    if filename.endswith(".h5"):
+        chunk = min(options.get('chunk', 1), data.shape[0])
+        compression = options.get('compression')
+        if precision == 'float32':
+            stored = data
+        else:
+            # one scale and offset per chunk
+            stored = np.empty(data.shape, dtype={'float16': np.float16, 'int16': np.int16}[precision])
+            scales = []
+            offsets = []
+            for c0 in range(0, data.shape[0], chunk):
+                stored[c0:c0+chunk], scale, offset = encode(data[c0:c0+chunk], precision)
+                scales.append(scale)
+                offsets.append(offset)
+        import h5py  # only needed by the hdf5 store
+        tmp = filename + ".tmp"
+        with h5py.File(tmp, 'w') as f:
+            dset = f.create_dataset('box', data=stored, chunks=(chunk,)+data.shape[1:],
+                                    compression=compression, shuffle=compression is not None)
+            for key, value in hdict.items():
+                dset.attrs[key] = value
+            for name, value, comment in keys:
+                dset.attrs[name] = value
+            if precision != 'float32':
+                dset.attrs['ENCODING'] = precision
+                dset.attrs['SCALE'] = np.array(scales)
+                dset.attrs['OFFSET'] = np.array(offsets)
+        os.replace(tmp, filename)
+    else:
+        stored, scale, offset = encode(data, precision)
+        if precision == 'float16':
+            stored = stored.view(np.int16)
+        tmp = filename + ".tmp"
+        fits = FITS(tmp, 'rw', clobber=True)
+        fits.write(stored, header=hdict)
+        for name, value, comment in keys:
+            fits[0].write_key(name, value, comment=comment)
+        if precision != 'float32':
+            fits[0].write_key("ENCODING", precision, comment="storage of the box, see SaclayMocks.boxio")
+            fits[0].write_key("SCALE", scale, comment="box = stored * SCALE + OFFSET")
+            fits[0].write_key("OFFSET", offset, comment="box = stored * SCALE + OFFSET")
+        fits.close()
+        os.replace(tmp, filename)
+    return manifest.checksum(stored)
+
+
+def _write_task(args):
+    src, i, filename, i0, i1, hdict, keys, options = args
+    if isinstance(src, str):
+        box = np.load(src, mmap_mode='r')  # memory-mapped box of SlabFFT
+    else:
+        box = _buffers[src]
+    crc = write_slab(box, filename, i0, i1, hdict, keys, options)
+    del box
+    return i, filename, crc
+
+
+#********************************************************************
+class SlabWriter():
+    '''Pool of nproc processes writing the slabs of nbuf output boxes.
+    If shape is given, the nbuf (NX,NY,NZ) float32 boxes are allocated in
+    shared memory (self.buffers), otherwise the boxes are memory-mapped
+    files (SlabFFT) given by their path.
+    If inplace, the buffers are padded to (NX,NY,2*(NZ//2+1)) for in-place
+    r2c FFTs: self.kbuffers are their (NX,NY,NZ//2+1) complex64 views and
+    self.buffers their (NX,NY,NZ) real views, which are written'''
+    def __init__(self, nproc, shape=None, nbuf=2, inplace=False):
+        global _buffers
+        self.nbuf = nbuf
+        self.kbuffers = None
+        if shape is not None:
+            if inplace:
+                NX, NY, NZ = shape
+                padded = [shared_array((NX, NY, 2*(NZ//2+1))) for i in range(nbuf)]
+                self.kbuffers = [buf.view(np.complex64) for buf in padded]
+                _buffers = [buf[:, :, :NZ] for buf in padded]
+            else:
+                _buffers = [shared_array(shape) for i in range(nbuf)]
+        self.buffers = _buffers
+        self.ibuf = -1
+        self.pending = [[] for i in range(nbuf)]
+        self.pool = multiprocessing.get_context('fork').Pool(nproc)
+        print("SlabWriter: {} processes, {} output buffers".format(nproc, nbuf))
+
+    def next_buffer(self):
+        '''Index of the next output buffer, once its previous slabs are written'''
+        self.ibuf = (self.ibuf + 1) % self.nbuf
+        self.wait(self.ibuf)
+        return self.ibuf
+
+    def submit(self, ibuf, src, tasks, callback=None):
+        '''Write the slabs (i, filename, i0, i1, hdict, keys, options) of the output
+        buffer ibuf. src is ibuf, or the path of the memory-mapped box.
+        callback([(i, filename, crc32)]) is called in this process as soon as
+        each slab is written, from the result thread of the pool'''
+        for t in tasks:
+            if callback is None:
+                res = self.pool.apply_async(_write_task, ((src,)+tuple(t),))
+            else:
+                res = self.pool.apply_async(_write_task, ((src,)+tuple(t),),
+                                            callback=lambda result: callback([result]))
+            self.pending[ibuf].append(res)
+
+    def wait(self, ibuf=None):
+        '''Wait for the slabs of buffer ibuf (default all) to be written.
+        Return the time spent waiting'''
+        t0 = time.time()
+        if ibuf is None:
+            ibufs = range(self.nbuf)
+        else:
+            ibufs = [ibuf]
+        for ib in ibufs:
+            for res in self.pending[ib]:
+                # raise the errors of the writers; the slab is recorded by now
+                res.get()
+            self.pending[ib] = []
+        return time.time() - t0
+
+    def close(self):
+        t = self.wait()
+        self.pool.close()
+        self.pool.join()
+        return t
+
+
+#********************************************************************
+def exists(boxdir, name):
+    '''True if the field name was written in boxdir, in either format'''
+    return (os.path.isfile(os.path.join(boxdir, name+".h5"))
+            or os.path.isfile(os.path.join(boxdir, name+"-0.fits")))
+
+
+class BoxReader():
+    '''Read x-ranges of the field name in boxdir, from <name>.h5 if it
+    exists, otherwise from the fits files <name>-<i>.fits.
+    Attributes: DX, DY, DZ, NX (of the full box), NY, NZ'''
+    def __init__(self, boxdir, name):
+        self.h5file = os.path.join(boxdir, name+".h5")
+        self.fitsname = os.path.join(boxdir, name+"-{}.fits")
+        if os.path.isfile(self.h5file):
+            self.h5 = True
+            import h5py  # only needed by the hdf5 store
+            with h5py.File(self.h5file, 'r') as f:
+                head = dict(f['box'].attrs)
+                shape = f['box'].shape
+                chunks = f['box'].chunks
+            self.NX = shape[0]
+            self.nfile = 1
+        else:
+            self.h5 = False
+            first = self.fitsname.format(0)
+            if not os.path.isfile(first):
+                # make_boxes.py is still writing the box, see manifest.wait_slice
+                files = sorted(glob.glob(self.fitsname.format('*')))
+                if len(files) == 0:
+                    raise IOError("No {} box in {}".format(name, boxdir))
+                first = files[0]
+            head = fitsio.read_header(first, ext=0)
+            shape = (head["NAXIS3"], head["NAXIS2"], head["NAXIS1"])
+            self.NX = head["NX"]
+            # the slabs can have different widths: their number is taken from
+            # the manifest of make_boxes.py, or from the files
+            entry = manifest.Manifest(boxdir).fields.get(name)
+            if entry is not None:
+                self.nfile = entry['nHDU']
+            else:
+                self.nfile = len(glob.glob(self.fitsname.format('*')))
+        # file (or hdf5 chunk) i holds the x-planes [bounds[i]:bounds[i+1]],
+        # as written by make_boxes.py
+        if self.h5:
+            self.bounds = np.append(np.arange(0, self.NX, chunks[0]), self.NX)
+        else:
+            self.bounds = np.arange(self.nfile+1) * self.NX // self.nfile
+        self.NY = shape[1]
+        self.NZ = shape[2]
+        self.DX = head["DX"]
+        self.DY = head["DY"]
+        self.DZ = head["DZ"]
+
+    def read(self, ix0, ix1):
+        '''Return the x-planes [ix0:ix1] of the box, as float32'''
+        if self.h5:
+            import h5py
+            with h5py.File(self.h5file, 'r') as f:
+                dset = f['box']
+                data = dset[ix0:ix1]
+                encoding = dset.attrs.get('ENCODING', 'float32')
+                if encoding == 'float32':
+                    return data
+                chunk = dset.chunks[0]
+                ichunk = np.arange(ix0, ix0+data.shape[0]) // chunk
+                scale = dset.attrs['SCALE'][ichunk].reshape(-1, 1, 1)
+                offset = dset.attrs['OFFSET'][ichunk].reshape(-1, 1, 1)
+            return decode(data, encoding, scale, offset)
+        i0, i1 = self.slabs(ix0, ix1)
+        data = []
+        for i in range(i0, i1):
+            stored, head = fitsio.read(self.fitsname.format(i), ext=0, header=True)
+            encoding = head.get("ENCODING", 'float32')
+            data.append(decode(stored, encoding, head.get("SCALE", 1.), head.get("OFFSET", 0.)))
+        if len(data) == 1:
+            data = data[0]
+        else:
+            data = np.concatenate(data)
+        return data[ix0-self.bounds[i0]:ix1-self.bounds[i0]]
+
+    def slabs(self, ix0, ix1):
+        '''Range [i0, i1) of the files (hdf5 chunks) holding the x-planes [ix0:ix1]'''
+        i0 = np.searchsorted(self.bounds, ix0, side='right') - 1
+        i1 = np.searchsorted(self.bounds, ix1, side='left')
+        return int(i0), int(i1)
+
+    def read_slice(self, i, nslice):
+        '''Return the x-slice i out of nslice'''
+        return self.read(i*self.NX//nslice, (i+1)*self.NX//nslice)
+
+    def moments(self, ix0, ix1):
+        '''boxstats.Moments of the x-planes [ix0:ix1] from the SLABMEAN and
+        SLABVAR of the headers, without reading the data. None if [ix0:ix1]
+        is not made of whole slabs (chunks in hdf5) or if the box has no
+        slab moments'''
+        if self.h5:
+            import h5py
+            with h5py.File(self.h5file, 'r') as f:
+                dset = f['box']
+                if 'SLABMEAN' not in dset.attrs:
+                    return None
+                means = dset.attrs['SLABMEAN']
+                variances = dset.attrs['SLABVAR']
+        else:
+            means = None
+        if ix0 not in self.bounds or ix1 not in self.bounds:
+            return None
+        total = boxstats.Moments()
+        i0, i1 = self.slabs(ix0, ix1)
+        for i in range(i0, i1):
+            if means is None:
+                head = fitsio.read_header(self.fitsname.format(i), ext=0)
+                if "SLABMEAN" not in head:
+                    return None
+                mean, var = head["SLABMEAN"], head["SLABVAR"]
+            else:
+                mean, var = means[i], variances[i]
+            n = (self.bounds[i+1] - self.bounds[i]) * self.NY * self.NZ
+            total = total + boxstats.Moments(n, mean, var*n, True)
+        return total
+
+    def slice_moments(self, i, nslice):
+        '''moments of the x-slice i out of nslice'''
+        return self.moments(i*self.NX//nslice, (i+1)*self.NX//nslice)
@@ -0,0 +1,102 @@
+# Single pass statistics of the boxes
+# plane_moments reads a box once, x-plane by x-plane, and returns for each
+# plane its count, mean and sum of squared deviations (shifted sums, in float64),
+# and whether it has non-zero or NaN values; it can normalise the box in the
+# same pass. The planes are then merged (Chan et al.) into the moments of
+# any slab of the box. make_boxes.py writes the moments of each slab in its
+# header (SLABMEAN, SLABVAR), so that the readers get the moments of any
+# x-range of whole slabs without reading the data (BoxReader.moments).
+import numpy as np
+from numba import jit
+
+
+#********************************************************************
+class Moments():
+    '''Count, mean and sum of squared deviations of a set of values,
+    and whether it has non-zero or NaN values. Moments add up.'''
+    def __init__(self, n=0, mean=0., m2=0., not_null=False, has_nan=False):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.not_null = not_null
+        self.has_nan = has_nan
+
+    def __add__(self, other):
+        n = self.n + other.n
+        if n == 0:
+            return Moments()
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.n / n
+        m2 = self.m2 + other.m2 + delta**2 * self.n * other.n / n
+        return Moments(n, mean, m2, self.not_null or other.not_null,
+                       self.has_nan or other.has_nan)
+
+    @property
+    def var(self):
+        if self.n == 0:
+            return 0.
+        return self.m2 / self.n
+
+    @property
+    def sigma(self):
+        return np.sqrt(self.var)
+
+
+def merge(moments):
+    '''Sum of a list of Moments'''
+    total = Moments()
+    for m in moments:
+        total = total + m
+    return total
+
+
+#********************************************************************
+@jit(nopython=True)
+def _plane_moments(box, norm, count, mean, m2, not_null, has_nan):
+    for ix in range(box.shape[0]):
+        # sums of x - shift, shift being a value of the plane, so that
+        # m2 = s2 - s1**2/n does not suffer from cancellation
+        shift = 0.
+        n = 0
+        s1 = 0.
+        s2 = 0.
+        nz = False
+        nan = False
+        for iy in range(box.shape[1]):
+            for iz in range(box.shape[2]):
+                if norm != 1:
+                    box[ix, iy, iz] /= norm
+                x = box[ix, iy, iz]
+                if x != x:
+                    nan = True
+                    continue
+                if x != 0:
+                    nz = True
+                if n == 0:
+                    shift = x
+                d = np.float64(x) - shift
+                n += 1
+                s1 += d
+                s2 += d * d
+        count[ix] = n
+        if n > 0:
+            mean[ix] = shift + s1 / n
+            m2[ix] = max(s2 - s1 * s1 / n, 0.)
+        not_null[ix] = nz
+        has_nan[ix] = nan
+
+
+def plane_moments(box, norm=1.):
+    '''Moments of each x-plane of box (any 3D float array, also a memmap or
+    a strided view), read once. If norm != 1, box is first divided in
+    place by norm, in float32 as box /= norm would.
+    NaN values are flagged and left out of the mean and variance.'''
+    NX = box.shape[0]
+    count = np.zeros(NX, dtype=np.int64)
+    mean = np.zeros(NX)
+    m2 = np.zeros(NX)
+    not_null = np.zeros(NX, dtype=np.bool_)
+    has_nan = np.zeros(NX, dtype=np.bool_)
+    _plane_moments(box, box.dtype.type(norm), count, mean, m2, not_null, has_nan)
+    return [Moments(int(count[ix]), mean[ix], m2[ix], bool(not_null[ix]), bool(has_nan[ix]))
+            for ix in range(NX)]
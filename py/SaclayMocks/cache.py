@@ -0,0 +1,14 @@
+# Directory of the on disk caches of the production (lognormal P(k) tables,
+# cosmology tables, footprint bitmaps, FFTW wisdom): $SACLAYMOCKS_CACHE/<name>
+# if SACLAYMOCKS_CACHE is set (e.g. a scratch directory, when
+# $SACLAYMOCKS_BASE is not writable or shared by several productions),
+# otherwise $SACLAYMOCKS_BASE/etc/<name>.
+import os
+
+
+def directory(name):
+    '''Directory of the cache name'''
+    root = os.environ.get("SACLAYMOCKS_CACHE")
+    if not root:
+        root = os.path.expandvars("$SACLAYMOCKS_BASE/etc")
+    return os.path.join(root, name)
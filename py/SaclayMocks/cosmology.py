@@ -0,0 +1,171 @@
+# Fiducial cosmology of the mocks as regular 1D tables
+# The comoving distance is integrated once on a regular z grid (same grid
+# and trapezoidal rule as picca.constants.cosmo), and z(r) is tabulated on
+# a regular r grid, so that every lookup is a linear interpolation whose
+# index is computed directly instead of searched.
+# The tables of a set of parameters are built once per process and cached
+# on disk in cache.directory("cosmo_cache") ($SACLAYMOCKS_CACHE or
+# $SACLAYMOCKS_BASE/etc).
+# Each table is also exposed as a (x0, 1/dx, values) tuple that compiled
+# numba code can use with lerp, e.g. lerp(R, *cosmo.z_table) in a kernel.
+# Distances are in Mpc, not in Mpc/h.
+import os
+import numpy as np
+from numba import jit
+from SaclayMocks import constant
+from SaclayMocks import cache
+
+
+#********************************************************************
+@jit(nopython=True, cache=True)
+def lerp(x, x0, inv_dx, table):
+    '''Linear interpolation in a regular table, constant beyond its ends'''
+    u = (x - x0) * inv_dx
+    if u <= 0:
+        return table[0]
+    i = int(u)
+    if i >= len(table) - 1:
+        return table[-1]
+    u -= i
+    return table[i] + u * (table[i+1] - table[i])
+
+
+@jit(nopython=True, cache=True)
+def lerp_array(x, x0, inv_dx, table, out):
+    for i in range(len(x)):
+        out[i] = lerp(x[i], x0, inv_dx, table)
+
+
+def rescale(table, scale):
+    '''Table of f(x/scale) from the table of f(x), e.g. z of R in Mpc/h
+    from z of R in Mpc with scale = h'''
+    x0, inv_dx, values = table
+    return x0 * scale, inv_dx / scale, values
+
+
+def fgrowth(z, Om0=constant.omega_M_0, unnormed=False):
+    # Assume flat lambda CDM cosmo, with only Om and Ol
+    # Comes from cosmolopy.perturbation
+    Om = 1 / (1 + (1 - Om0)/(Om0*(1+z)**3))
+    Ol = 1 - Om
+    a = 1 / (1+z)
+    if unnormed:
+        norm = 1.0
+    else:
+        norm = 1.0 / fgrowth(0.0, Om0, unnormed=True)
+    return (norm * (5./2.) * a * Om /
+            (Om**(4./7.) - Ol + (1. + Om/2.) * (1. + Ol/70.)))
+
+
+#********************************************************************
+_cosmo_tables = {}
+
+
+def cache_filename(Om, Ok, Or, wl, H0, nbins, zmax, nr, directory=None):
+    if directory is None:
+        directory = cache.directory("cosmo_cache")
+    return os.path.join(directory, "cosmo.{:.17g}.{:.17g}.{:.17g}.{:.17g}.{:.17g}.{}.{:.17g}.{}.npz".format(
+        Om, Ok, Or, wl, H0, nbins, zmax, nr))
+
+
+def compute_tables(Om, Ok, Or, wl, H0, nbins, zmax, nr):
+    '''hubble, chi, dm on the regular z grid and z on the regular chi grid'''
+    c = constant.c
+    Ol = 1.-Ok-Om-Or
+    dz = zmax/nbins
+    z = np.arange(nbins)*dz
+    hubble = H0*np.sqrt( Ol*(1.+z)**(3.*(1.+wl)) + Ok*(1.+z)**2 + Om*(1.+z)**3 + Or*(1.+z)**4 )
+    chi = np.zeros(nbins)
+    chi[1:] = np.cumsum(c*(1./hubble[:-1]+1./hubble[1:])/2.*dz)
+    ### dm here is the comoving angular diameter distance
+    if Ok==0.:
+        dm = chi
+    elif Ok<0.:
+        dm = np.sin(H0*np.sqrt(-Ok)/c*chi)/(H0*np.sqrt(-Ok)/c)
+    elif Ok>0.:
+        dm = np.sinh(H0*np.sqrt(Ok)/c*chi)/(H0*np.sqrt(Ok)/c)
+    r = np.linspace(0, chi[-1], nr)
+    z_of_r = np.interp(r, chi, z)
+    return {'hubble': hubble, 'chi': chi, 'dm': dm, 'z_of_r': z_of_r}
+
+
+def tables(Om, Ok=0., Or=0., wl=-1., H0=100., nbins=10000, zmax=10., nr=2**17, directory=None):
+    '''compute_tables, read from the cache if available, computed and saved otherwise'''
+    cachefile = cache_filename(Om, Ok, Or, wl, H0, nbins, zmax, nr, directory)
+    if cachefile in _cosmo_tables:
+        return _cosmo_tables[cachefile]
+    if os.path.isfile(cachefile):
+        with np.load(cachefile) as f:
+            t = {key: f[key] for key in f.files}
+    else:
+        t = compute_tables(Om, Ok, Or, wl, H0, nbins, zmax, nr)
+        try:
+            os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+            # unique temporary name: several jobs can fill the cache at once
+            tmp = cachefile + ".{}.tmp.npz".format(os.getpid())
+            np.savez(tmp, **t)
+            os.replace(tmp, cachefile)
+        except OSError as e:
+            print("WARNING: cosmology tables not cached in {}: {}".format(cachefile, e))
+    _cosmo_tables[cachefile] = t
+    return t
+
+
+#********************************************************************
+class Cosmology():
+    '''r_comoving(z), r_2_z(r), hubble(z), dist_hubble(z), dm(z), dist_v(z)
+    and growth(z) as in picca.constants.cosmo (interp1d on the same z grid),
+    by linear interpolation in regular tables. As interp1d, the methods
+    raise a ValueError outside the tables.
+    The (x0, 1/dx, values) tuples r_table, z_table, hubble_table,
+    dist_hubble_table, dm_table and growth_table are for lerp in numba code.
+    growth is util.fgrowth(z, Om): it assumes a flat LCDM cosmology.'''
+    def __init__(self, Om, Ok=0., Or=0., wl=-1., H0=100., nbins=10000, zmax=10., nr=2**17):
+        ### Ignore evolution of neutrinos from matter to radiation
+        ### H0 in km/s/Mpc
+        t = tables(Om, Ok, Or, wl, H0, nbins, zmax, nr)
+        c = constant.c
+        dz = zmax/nbins
+        z = np.arange(nbins)*dz
+        self.z = z
+        self.r_table = (0., 1./dz, t['chi'])
+        self.z_table = (0., (nr-1)/t['chi'][-1], t['z_of_r'])
+        self.hubble_table = (0., 1./dz, t['hubble'])
+        self.dist_hubble_table = (0., 1./dz, c/t['hubble'])
+        self.dm_table = (0., 1./dz, t['dm'])
+        self.growth_table = (0., 1./dz, fgrowth(z, Om))
+        ### D_V
+        y = np.power(z*t['dm']**2*c/t['hubble'], 1./3.)
+        self.dist_v_table = (0., 1./dz, y)
+
+    @staticmethod
+    def interp(x, table):
+        x0, inv_dx, values = table
+        xmax = x0 + (len(values)-1) / inv_dx
+        x = np.asarray(x, dtype=np.float64)
+        if x.size > 0 and (x.min() < x0 or x.max() > xmax):
+            raise ValueError("A value in x_new is out of the interpolation range [{}, {}].".format(x0, xmax))
+        out = np.empty(x.size)
+        lerp_array(x.ravel(), x0, inv_dx, values, out)
+        return out.reshape(x.shape)
+
+    def r_comoving(self, z):
+        return self.interp(z, self.r_table)
+
+    def r_2_z(self, r):
+        return self.interp(r, self.z_table)
+
+    def hubble(self, z):
+        return self.interp(z, self.hubble_table)
+
+    def dist_hubble(self, z):
+        return self.interp(z, self.dist_hubble_table)
+
+    def dm(self, z):
+        return self.interp(z, self.dm_table)
+
+    def dist_v(self, z):
+        return self.interp(z, self.dist_v_table)
+
+    def growth(self, z):
+        return self.interp(z, self.growth_table)
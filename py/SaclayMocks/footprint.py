@@ -0,0 +1,205 @@
+# DESI footprint as a packed boolean healpix map
+# The weights map (etc/desi-healpix-weights.fits) is read and ud_graded once,
+# thresholded, and the resulting nest ordered mask is kept as a bitmap (1 bit
+# per pixel, np.packbits with bitorder='little': pixel p is bit p & 7 of
+# byte p >> 3), 8 kB at nside 256.
+# The bitmap of a (weights file, nside, threshold) is built once per process
+# and cached on disk in cache.directory("footprint_cache") ($SACLAYMOCKS_CACHE
+# or $SACLAYMOCKS_BASE/etc), keyed by the sha1 of the weights file. In memory,
+# it is keyed by the path, modification time and size of the file, which is
+# only hashed the first time.
+# radec2pix is a numba port of healpix ang2pix in the nest scheme (same
+# pixels as healpy), so that the footprint can be tested in compiled code,
+# e.g. contains(ra, dec, nside, bits) in a kernel.
+# In the nest scheme, the pixel p at nside contains the pixels
+# [p*4**k, (p+1)*4**k) at nside*2**k: coverage gives the fraction of each
+# pixel of a coarser map (e.g. the nside 16 pixels of the outputs) that is
+# in the footprint.
+import os
+import hashlib
+import numpy as np
+import healpy as hp
+import fitsio
+from numba import jit, prange
+from SaclayMocks import cache
+
+
+#********************************************************************
+@jit(nopython=True, cache=True)
+def spread_bits(v):
+    '''Bits of v at the even positions of the result'''
+    v = np.int64(v)
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+@jit(nopython=True, cache=True)
+def fmodulo(v1, v2):
+    '''v1 modulo v2 in [0, v2) (healpix fmodulo)'''
+    if v1 >= 0:
+        return v1 if v1 < v2 else np.fmod(v1, v2)
+    r = np.fmod(v1, v2) + v2
+    return 0. if r == v2 else r
+
+
+@jit(nopython=True, cache=True)
+def ang2pix(nside, theta, phi):
+    '''healpix nest pixel of (theta, phi) in radians, nside a power of 2
+    (healpix_base loc2pix)'''
+    z = np.cos(theta)
+    za = abs(z)
+    phi = fmodulo(phi, 2*np.pi)  # as healpy, which normalizes the pointing
+    tt = fmodulo(phi * 0.6366197723675813430755350534900574, 4.)  # 2/pi as healpix
+    if za <= 2./3.:
+        temp1 = nside * (0.5 + tt)
+        temp2 = nside * (z * 0.75)
+        jp = int(temp1 - temp2)  # index of ascending edge line
+        jm = int(temp1 + temp2)  # index of descending edge line
+        ifp = jp // nside
+        ifm = jm // nside
+        if ifp == ifm:
+            face = ifp | 4
+        elif ifp < ifm:
+            face = ifp
+        else:
+            face = ifm + 8
+        ix = jm & (nside - 1)
+        iy = nside - (jp & (nside - 1)) - 1
+    else:
+        ntt = min(3, int(tt))
+        tp = tt - ntt
+        if za >= 0.99 and (theta < 0.01 or theta > 3.14159 - 0.01):
+            tmp = nside * np.sin(theta) / np.sqrt((1. + za) / 3.)
+        else:
+            tmp = nside * np.sqrt(3. * (1. - za))
+        jp = min(int(tp * tmp), nside - 1)
+        jm = min(int((1. - tp) * tmp), nside - 1)
+        if z >= 0:
+            face = ntt
+            ix = nside - jm - 1
+            iy = nside - jp - 1
+        else:
+            face = ntt + 8
+            ix = jp
+            iy = jm
+    return face * nside * nside + spread_bits(ix) + (spread_bits(iy) << 1)
+
+
+@jit(nopython=True, cache=True)
+def radec2pix(nside, ra, dec):
+    '''healpix nest pixel of (ra, dec) in degrees, as util.radec2pix'''
+    return ang2pix(nside, np.pi/2 - dec*np.pi/180, ra*np.pi/180)
+
+
+@jit(nopython=True, cache=True)
+def contains(ra, dec, nside, bits):
+    '''True if (ra, dec) in degrees is in the footprint bitmap bits'''
+    p = radec2pix(nside, ra, dec)
+    return (bits[p >> 3] >> (p & 7)) & 1 == 1
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _radec2pix_array(nside, ra, dec, out):
+    for i in prange(len(ra)):
+        out[i] = radec2pix(nside, ra[i], dec[i])
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _contains_array(ra, dec, nside, bits, out):
+    for i in prange(len(ra)):
+        out[i] = contains(ra[i], dec[i], nside, bits)
+
+
+def radec2pix_array(nside, ra, dec):
+    '''healpix nest pixels of the arrays ra, dec in degrees'''
+    ra = np.ascontiguousarray(ra, dtype=np.float64).ravel()
+    dec = np.ascontiguousarray(dec, dtype=np.float64).ravel()
+    out = np.empty(len(ra), dtype=np.int64)
+    _radec2pix_array(nside, ra, dec, out)
+    return out
+
+
+#********************************************************************
+_footprint_masks = {}
+
+
+def cache_filename(filename, nside, threshold, directory=None):
+    if directory is None:
+        directory = cache.directory("footprint_cache")
+    with open(filename, 'rb') as f:
+        sha1 = hashlib.sha1(f.read()).hexdigest()
+    return os.path.join(directory, "footprint.{}.{}.{!r}.npy".format(sha1, nside, threshold))
+
+
+def compute_bitmap(filename, nside, threshold):
+    '''Packed nest mask of the pixels of the ud_graded weights above threshold'''
+    pixmap = fitsio.read(filename, ext=0)
+    npix = len(pixmap)
+    truenside = hp.npix2nside(npix)
+    if truenside < nside:
+        print("Warning downsampling is fuzzy...Passed nside={}, but file {} is stored at nside={}".format(truenside, filename, nside))
+    healpix_weight = hp.pixelfunc.ud_grade(pixmap, nside, order_in='NESTED', order_out='NESTED')
+    return np.packbits(healpix_weight > threshold, bitorder='little')
+
+
+def bitmap(filename, nside, threshold, directory=None):
+    '''compute_bitmap, read from the cache if available, computed and saved otherwise'''
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_mtime_ns, st.st_size, nside, threshold)
+    if key in _footprint_masks:
+        return _footprint_masks[key]
+    cachefile = cache_filename(filename, nside, threshold, directory)
+    if os.path.isfile(cachefile):
+        bits = np.load(cachefile)
+    else:
+        bits = compute_bitmap(filename, nside, threshold)
+        try:
+            os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+            # unique temporary name: several jobs can fill the cache at once
+            tmp = cachefile + ".{}.tmp.npy".format(os.getpid())
+            np.save(tmp, bits)
+            os.replace(tmp, cachefile)
+        except OSError as e:
+            print("WARNING: footprint bitmap not cached in {}: {}".format(cachefile, e))
+    _footprint_masks[key] = bits
+    return bits
+
+
+#********************************************************************
+class Footprint():
+    '''Pixels of the weights map at nside with a weight above threshold.
+    bits is the packed nest mask, for contains(ra, dec, nside, bits) in numba
+    code.'''
+    def __init__(self, filename=None, nside=256, threshold=0.99, directory=None):
+        if filename is None:
+            filename = "$SACLAYMOCKS_BASE/etc/desi-healpix-weights.fits"
+        filename = os.path.expandvars(filename)
+        self.filename = filename
+        self.nside = nside
+        self.threshold = threshold
+        self.bits = bitmap(filename, nside, threshold, directory)
+
+    def mask(self, ra=None, dec=None):
+        '''Boolean array of the objects (ra, dec in degrees) in the footprint,
+        or nest mask of the pixels if ra and dec are None'''
+        if ra is None:
+            return np.unpackbits(self.bits, bitorder='little').astype(bool)
+        ra = np.ascontiguousarray(ra, dtype=np.float64)
+        dec = np.ascontiguousarray(dec, dtype=np.float64)
+        out = np.empty(ra.size, dtype=np.bool_)
+        _contains_array(ra.ravel(), dec.ravel(), self.nside, self.bits, out)
+        return out.reshape(ra.shape)
+
+    def selection(self, ra, dec):
+        '''Indices of the objects in the footprint'''
+        return np.where(self.mask(ra, dec))[0]
+
+    def coverage(self, nside):
+        '''Fraction of each nest pixel at nside (<= self.nside) in the footprint'''
+        if nside > self.nside:
+            raise ValueError("coverage: nside {} > footprint nside {}".format(nside, self.nside))
+        return self.mask().reshape(hp.nside2npix(nside), -1).mean(axis=1)
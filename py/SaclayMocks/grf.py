@@ -0,0 +1,98 @@
+# Gaussian random field helpers for make_boxes.py
+# White noise is drawn directly in k-space, in the numpy.fft.rfftn / FFTW
+# r2c layout (NX, NY, NZ//2+1), with the normalisation of the forward FFT
+# of a real N(0,1) box: <|delta_k|^2> = NX*NY*NZ (see cahier simu FFT normalization)
+# The random numbers come from a counter-based generator (Philox) keyed by the
+# seed: the numbers drawn for the x-plane ix are a pure function of (seed, ix),
+# so the planes can be drawn in any order and by any thread. In real space,
+# the white noise of a slab only depends on its planes. In k space, the
+# Hermitian symmetry of the kz=0 and kz=NZ/2 planes mixes the modes of the
+# x-planes ix and (NX-ix) % NX: a slab of boxk also depends on the draws of
+# its mirror planes.
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+#********************************************************************
+def hermitian_plane(plane):
+    '''Impose delta(-kx,-ky) = delta*(kx,ky) on a (NX,NY) plane, in place.
+    Used for the kz=0 and kz=NZ/2 planes of the r2c layout.
+    (a + conj(a_sym))/sqrt(2) keeps the variance of the paired modes and
+    gives real self-conjugate modes with twice the variance, as the FFT of
+    a real white noise does.'''
+    sym = np.roll(plane[::-1, ::-1], 1, axis=(0, 1))
+    plane += np.conj(sym)
+    plane /= np.sqrt(2)
+    return plane
+
+
+#********************************************************************
+# counter[3] of the generators: one stream per use of the seed
+KSPACE = 0
+REALSPACE = 1
+QSO = 2  # z-planes of SaclayMocks.qso
+RANDOMS = 3  # healpix pixels of SaclayMocks.randoms
+
+
+def plane_generator(seed, ix, domain=KSPACE):
+    '''Generator of the white noise of the x-plane ix: Philox keyed by seed,
+    with its counter starting at (0, 0, ix, domain). Each plane has 2**64
+    blocks of 4 random integers of its own.'''
+    return np.random.Generator(np.random.Philox(key=int(seed), counter=[0, 0, ix, domain]))
+
+
+def draw_planes(out, ix0, ix1, seed, domain=KSPACE, sigma=1.):
+    '''Fill the x-planes out[ix0:ix1] with N(0,sigma) white noise.
+    out is float32 (real space) or complex64 (k space, real and imaginary
+    parts drawn independently). Non contiguous planes (e.g. the real view of
+    a padded in-place FFT buffer) get the same numbers as contiguous ones'''
+    for ix in range(ix0, ix1):
+        plane = out[ix]
+        if np.iscomplexobj(plane):
+            plane = plane.view(np.float32)
+        generator = plane_generator(seed, ix, domain)
+        if plane.flags.c_contiguous:
+            generator.standard_normal(out=plane, dtype=np.float32)
+        else:
+            plane[:] = generator.standard_normal(size=plane.shape, dtype=np.float32)
+        if sigma != 1:
+            out[ix] *= sigma
+
+
+def _draw_parallel(out, seed, domain, sigma, threads):
+    NX = out.shape[0]
+    nblock = max(1, NX // (4*threads))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        jobs = [pool.submit(draw_planes, out, ix0, min(ix0+nblock, NX), seed, domain, sigma)
+                for ix0 in range(0, NX, nblock)]
+        for job in jobs:
+            job.result()
+    return out
+
+
+#********************************************************************
+def draw_box(NX, NY, NZ, seed, threads=1, box=None):
+    '''Draw a N(0,1) real space white noise box, plane by plane along x.
+    The result does not depend on the number of threads.
+    box can be a preallocated (NX,NY,NZ) float32 array (e.g. a memmap)'''
+    if box is None:
+        box = np.empty((NX, NY, NZ), dtype=np.float32)
+    return _draw_parallel(box, seed, REALSPACE, 1., threads)
+
+
+def draw_boxk(NX, NY, NZ, seed, threads=1, boxk=None):
+    '''Draw a white noise box directly in k-space, with Hermitian symmetry.
+    The result does not depend on the number of threads. The kz=0 and
+    kz=NZ/2 modes of the plane ix depend on the draws of the planes ix and
+    (NX-ix) % NX.
+    boxk can be a preallocated (NX,NY,NZ//2+1) complex64 array (e.g. a memmap)'''
+    NZk = NZ//2 + 1
+    if boxk is None:
+        boxk = np.empty((NX, NY, NZk), dtype=np.complex64)
+    sigma = np.float32(np.sqrt(NX*NY*NZ/2.))  # real and imaginary parts
+    _draw_parallel(boxk, seed, KSPACE, sigma, threads)
+    # kz=0 and kz=NZ/2 (NZ even) planes are their own mirror
+    boxk[:, :, 0] = hermitian_plane(np.array(boxk[:, :, 0]))
+    if NZ % 2 == 0:
+        boxk[:, :, -1] = hermitian_plane(np.array(boxk[:, :, -1]))
+    return boxk
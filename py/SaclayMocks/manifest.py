@@ -0,0 +1,243 @@
+# Checkpoint manifest of the boxes produced by make_boxes.py
+# manifest.json, in the output directory of the chunk, records for each
+# field the P(k) it was made from and, for each output slab, its file size
+# and the crc32 of its data. A re-run only redoes the fields with missing,
+# truncated or (with verify=True) corrupted slabs, without listing the
+# directory. The slabs of a directory produced before the manifest existed
+# are adopted if their header matches the run (adopt).
+# The manifest also lists the fields make_boxes.py will produce (set_plan),
+# so that draw_qso.py and make_spectra.py -wait True can start a slice as
+# soon as the x-planes it needs are written (wait_slice), while make_boxes
+# is still producing the other fields or x-planes. set_plan also writes the
+# identifier of the run, and the run ends with the state done or failed
+# (finish): a reader given the run identifier ignores the manifest of an
+# older run, and stops waiting if the run failed.
+# The slabs are recorded as they are written by appending one line to
+# manifest.json.log, which is read with manifest.json and merged into it by
+# the next save (set_plan, adopt, finish): recording a slab does not rewrite
+# the whole manifest.
+import os
+import json
+import time
+import zlib
+import socket
+import threading
+import numpy as np
+import fitsio
+
+
+#********************************************************************
+def checksum(data):
+    '''crc32 of the data of a slab, as native float32'''
+    return zlib.crc32(np.ascontiguousarray(data, dtype=np.float32))
+
+
+def read_data(filename):
+    '''Data of a fits or hdf5 box file'''
+    if filename.endswith(".h5"):
+        import h5py  # only needed by the hdf5 store
+        with h5py.File(filename, 'r') as f:
+            return f['box'][:]
+    return fitsio.read(filename, ext=0)
+
+
+#********************************************************************
+class Manifest():
+    '''Book-keeping of the slabs written in outDir.
+    The manifest is reset if it was written for another seed.
+    With seed=None, the manifest is only read (by the box readers)'''
+    def __init__(self, outDir, seed=None, filename="manifest.json"):
+        self.outDir = outDir
+        self.filename = os.path.join(outDir, filename)
+        self.logname = self.filename + ".log"
+        self.seed = seed if seed is None else int(seed)
+        self.fields = {}
+        self.plan = []
+        self.NX = None
+        self.run = None
+        self.state = None
+        # the slabs can be recorded by the result thread of a boxio.SlabWriter
+        self.lock = threading.RLock()
+        if os.path.isfile(self.filename):
+            with open(self.filename) as f:
+                content = json.load(f)
+            if self.seed is None or content['seed'] == self.seed:
+                self.seed = content['seed']
+                self.fields = content['fields']
+                self.plan = content.get('plan', [])
+                self.NX = content.get('NX')
+                self.run = content.get('run')
+                self.state = content.get('state')
+                self._read_log()
+            else:
+                print("WARNING: {} was written for seed {}, it is reset.".format(self.filename, content['seed']))
+
+    def reload(self):
+        '''Read again the manifest, written by another process'''
+        self.__init__(self.outDir, None, os.path.basename(self.filename))
+
+    def reset(self):
+        self.fields = {}
+        self.save()
+
+    def set_plan(self, names, NX, run=None):
+        '''Announce the fields that will be produced, for boxes of NX x-planes,
+        by the run run (default: host, pid and start time)'''
+        if run is None:
+            run = "{}-{}-{}".format(socket.gethostname(), os.getpid(), int(time.time()))
+        self.plan = list(names)
+        self.NX = NX
+        self.run = run
+        self.state = 'running'
+        self.save()
+
+    def finish(self, state='done'):
+        '''End of the run: state is done or failed'''
+        self.state = state
+        self.save()
+
+    def forget(self, name, slabs):
+        '''Remove the slabs of field name that are going to be redone'''
+        entry = self.fields.get(name)
+        if entry is not None:
+            for i in slabs:
+                entry['slabs'].pop(str(i), None)
+
+    def missing(self, name, pk_source, nHDU, verify=False):
+        '''Return the list of slab indices of field name that need to be
+        (re)done: all of them if the field is unknown or was made from
+        another P(k), otherwise the missing, truncated or corrupted ones'''
+        entry = self.fields.get(name)
+        if entry is None or entry['pk'] != pk_source or entry['nHDU'] != nHDU:
+            return list(range(nHDU))
+        todo = []
+        for i in range(nHDU):
+            slab = entry['slabs'].get(str(i))
+            if slab is None:
+                todo.append(i)
+                continue
+            filename = os.path.join(self.outDir, slab['file'])
+            if not os.path.isfile(filename) or os.path.getsize(filename) != slab['size']:
+                todo.append(i)
+            elif verify and checksum(read_data(filename)) != slab['crc32']:
+                print("WARNING: bad checksum for {}".format(filename))
+                todo.append(i)
+        return todo
+
+    def adopt(self, name, pk_source, nHDU, hdict):
+        '''Record the slabs <name>-<i>.fits written before the manifest
+        existed (older make_boxes.py, float32 fits files), if their header
+        has the values of hdict and their data the x-planes of slab i. None
+        is adopted if slab 0 has another seed than the manifest. Their P(k)
+        cannot be checked: it is assumed to be pk_source.
+        Return the indices of the adopted slabs'''
+        adopted = []
+        for i in range(nHDU):
+            filename = os.path.join(self.outDir, "{}-{}.fits".format(name, i))
+            if not os.path.isfile(filename):
+                continue
+            try:
+                data, head = fitsio.read(filename, ext=0, header=True)
+            except (IOError, OSError, ValueError):
+                continue
+            if i == 0 and head.get('SEED') != self.seed:
+                # the other slabs of the field were made with the same seed
+                return []
+            if 'ENCODING' in head or any(head.get(key) != value for key, value in hdict.items()):
+                continue
+            if data.shape[0] != (i+1)*self.NX//nHDU - i*self.NX//nHDU:
+                continue
+            self.record(name, pk_source, nHDU, i, filename, checksum(data))
+            adopted.append(i)
+        if len(adopted) > 0:
+            self.save()
+        return adopted
+
+    def record(self, name, pk_source, nHDU, i, filename, crc32):
+        '''Record slab i of field name, once its file is written, in memory
+        and in the log. crc32 is checksum() of its data'''
+        line = {'field': name, 'pk': pk_source, 'nHDU': nHDU, 'i': i,
+                'file': os.path.basename(filename), 'size': os.path.getsize(filename),
+                'crc32': crc32}
+        with self.lock:
+            self._apply(line)
+            # one write per line: a reader sees whole lines, or an incomplete last one
+            with open(self.logname, 'a') as f:
+                f.write(json.dumps(line) + "\n")
+
+    def _apply(self, line):
+        entry = self.fields.get(line['field'])
+        if entry is None or entry['pk'] != line['pk'] or entry['nHDU'] != line['nHDU']:
+            self.fields[line['field']] = {'pk': line['pk'], 'nHDU': line['nHDU'], 'slabs': {}}
+        self.fields[line['field']]['slabs'][str(line['i'])] = {
+            'file': line['file'], 'size': line['size'], 'crc32': line['crc32']}
+
+    def _read_log(self):
+        '''Slabs recorded since the last save'''
+        if not os.path.isfile(self.logname):
+            return
+        with open(self.logname) as f:
+            for text in f:
+                try:
+                    line = json.loads(text)
+                except ValueError:
+                    break  # being written
+                self._apply(line)
+
+    def save(self):
+        '''Atomic write of the manifest, with the slabs of the log'''
+        with self.lock:
+            tmp = self.filename + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump({'seed': self.seed, 'NX': self.NX, 'plan': self.plan,
+                           'run': self.run, 'state': self.state,
+                           'fields': self.fields}, f, indent=1)
+            os.replace(tmp, self.filename)
+            if os.path.isfile(self.logname):
+                os.remove(self.logname)
+
+    def ready(self, names, ix0, ix1):
+        '''True if the x-planes [ix0:ix1] of the fields names are written.
+        The fields that are not in the plan are ignored'''
+        if self.NX is None:
+            return False
+        for name in names:
+            if name not in self.plan:
+                continue
+            entry = self.fields.get(name)
+            if entry is None:
+                return False
+            # slab i holds the x-planes [bounds[i]:bounds[i+1]], as in boxio.BoxReader
+            bounds = np.arange(entry['nHDU']+1) * self.NX // entry['nHDU']
+            i0 = np.searchsorted(bounds, ix0, side='right') - 1
+            i1 = np.searchsorted(bounds, ix1, side='left')
+            for i in range(i0, i1):
+                if str(i) not in entry['slabs']:
+                    return False
+        return True
+
+    def wait_slice(self, names, islice, nslice, halo=0, timeout=None, poll=10.,
+                   run=None):
+        '''Wait until the x-slice islice out of nslice, extended by halo
+        x-planes on each side, of the fields names is written.
+        If run is given, only the manifest of this run is read (the manifest
+        of an older run in the same directory is ignored), and RuntimeError
+        is raised if the run failed or ended without writing the slice.
+        Raise RuntimeError after timeout seconds (default: wait forever)'''
+        t0 = time.time()
+        print("Waiting for {} slice {}/{} in {}".format(names, islice, nslice, self.filename))
+        while True:
+            self.reload()
+            if self.NX is not None and (run is None or self.run == run):
+                ix0 = max(islice*self.NX//nslice - halo, 0)
+                ix1 = min((islice+1)*self.NX//nslice + halo, self.NX)
+                if self.ready(names, ix0, ix1):
+                    print("x-planes {} to {} ready after {} s".format(ix0, ix1, time.time()-t0))
+                    return
+                if run is not None and self.state in ('done', 'failed'):
+                    raise RuntimeError("{} slice {}/{} not written in {}: make_boxes.py run {} {}".format(
+                        names, islice, nslice, self.outDir, self.run, self.state))
+            if timeout is not None and time.time() - t0 > timeout:
+                raise RuntimeError("{} slice {}/{} not written in {} after {} s".format(
+                    names, islice, nslice, self.outDir, timeout))
+            time.sleep(poll)
@@ -1,32 +1,112 @@
 # get P(k) by reading a file and interpolating
 # P(k) => xi(r) and xi(r) => P(k)
 import os
+import hashlib
 import numpy as np
 import scipy as sp
 from scipy import interpolate, integrate
 import matplotlib.pyplot as plt # prov
 from SaclayMocks import util
 from SaclayMocks import constant
+from SaclayMocks import cache
 import pyfftw.interfaces.numpy_fft as fft
 from fitsio import FITS
 
 
+#********************************************************************
+# 1D projections of P^3D, with integrals over all the grid points at once.
+# Each interval [x_i, x_i+1] is integrated with the trapezoid rule or with
+# the quadratic through 3 neighbouring points (simpson); the integral from
+# each x_i to the end is then a reverse cumulative sum: O(N) instead of one
+# np.trapz per point.
+def interval_integrals(x, f, method='trapz'):
+    '''Integrals of f over each [x_i, x_i+1], along the last axis of f'''
+    h = np.diff(x)
+    if method == 'trapz' or len(x) < 3:
+        return 0.5 * (f[..., 1:] + f[..., :-1]) * h
+    if method != 'simpson':
+        raise ValueError("Unknown method {}, should be trapz or simpson".format(method))
+    h0 = h[:-1]
+    h1 = h[1:]
+    H = h0 + h1
+    f0 = f[..., :-2]
+    f1 = f[..., 1:-1]
+    f2 = f[..., 2:]
+    res = np.empty(f.shape[:-1] + (len(h),))
+    # [x_i, x_i+1] with the quadratic through x_i, x_i+1, x_i+2
+    res[..., :-1] = h0/6 * ((3 - h0/H)*f0 + (3*H - 2*h0)/h1*f1 - h0*h0/(H*h1)*f2)
+    # last interval with the quadratic through the last 3 points
+    h0 = h0[-1]
+    h1 = h1[-1]
+    H = H[-1]
+    res[..., -1] = h1/6 * ((3 - h1/H)*f2[..., -1] + (3*H - 2*h1)/h0*f1[..., -1] - h1*h1/(H*h0)*f0[..., -1])
+    return res
+
+
+def tail_integrals(x, f, method='trapz'):
+    '''int_{x_i}^{x_max} f dx for each x_i, along the last axis of f'''
+    I = interval_integrals(x, f, method)
+    tail = np.zeros(f.shape)
+    tail[..., :-1] = np.cumsum(I[..., ::-1], axis=-1)[..., ::-1]
+    return tail
+
+
+def P1D_projection(k, P, method='trapz'):
+    '''P^1D(k_i) = (1/2PI) int_{k_i}^{k_max} P^3D(k) k dk, for each k_i'''
+    return tail_integrals(k, P*k, method) /2/np.pi
+
+
+def P1D_RSD_projection(k_par, k_perp, P, nblock=256, method='trapz', weights=None):
+    '''P^1D(k_par) = (1/2PI) int P^3D(k_par,k_perp) k_perp dk_perp.
+    P is a (len(k_par), len(k_perp)) array, or a function P(k_par, k_perp)
+    of a column of k_par and of k_perp: it is then evaluated nblock k_par at
+    a time, and each block is reduced before the next one is computed.
+    If weights are given (e.g. gauss_legendre), the integral is
+    sum(weights * k_perp * P) instead of the trapz / simpson rule.
+    k_perp can also be a function of a column of k_par returning the
+    (len(k_par), m) nodes and weights of each k_par, e.g. Gauss-Legendre
+    segments with an edge where P is discontinuous'''
+    P1D = np.zeros(len(k_par))
+    for i0 in range(0, len(k_par), nblock):
+        i1 = min(i0+nblock, len(k_par))
+        kp = k_perp
+        w = weights
+        if callable(k_perp):
+            kp, w = k_perp(k_par[i0:i1].reshape(-1, 1))
+        if callable(P):
+            blk = P(k_par[i0:i1].reshape(-1, 1), kp)
+        else:
+            blk = P[i0:i1]
+        if w is not None:
+            P1D[i0:i1] = (blk * (w*kp)).sum(axis=-1) /2/np.pi
+        else:
+            P1D[i0:i1] = interval_integrals(k_perp, k_perp*blk, method).sum(axis=-1) /2/np.pi
+    return P1D
+
+
+def gauss_legendre(edges, n):
+    '''Nodes and weights of the Gauss-Legendre quadrature with n points in
+    each segment [edges[i], edges[i+1]]. With 2D edges, one row of nodes
+    and weights for each row of edges'''
+    x, w = np.polynomial.legendre.leggauss(n)
+    edges = np.asarray(edges)
+    a = edges[..., :-1, np.newaxis]
+    b = edges[..., 1:, np.newaxis]
+    nodes = (a + b)/2 + (b - a)/2 * x
+    weights = (b - a)/2 * w
+    shape = edges.shape[:-1] + (-1,)
+    return nodes.reshape(shape), weights.reshape(shape)
+
+
 #********************************************************************
 class P_1D() :
     '''Computes P^1D = (1/2PI) int_{k_//}^\infty P^3D(k)kdk  '''
-    def __init__(self,k,P,kmax=-1):
+    def __init__(self,k,P,kmax=-1,method='trapz'):
         if (kmax>0) :
             k=k[np.where(k<=kmax)]
             P=P[np.where(k<=kmax)]
 #        print(k.shape,P.shape)
-        P1D=np.zeros(len(k))
-        for i in np.arange(len(k)) :      #  (1/2PI) int_{k_//}^\infty P(k)kdk
-            P1D[i] = np.trapz((P*k)[i:],k[i:]) /2/np.pi
-        #dk = k[1:]-k[0:-1]
-        #dk = np.append(dk,dk[-1])
-        #P1D = np.cumsum(P*k*dk[-1::-1]) # from last to first, in inverse order
-        #P1D = P1D[-1::-1]
-        #       completely fails ???
+        P1D = P1D_projection(k, P, method)   #  (1/2PI) int_{k_//}^\infty P(k)kdk
         self.pk1DInter=interpolate.InterpolatedUnivariateSpline(k,P1D)
 
     def P1D(self,k):
@@ -36,11 +116,9 @@ class P_1D() :
 #********************************************************************
 class P_1D_RSD() :
     '''Computes P^1D = (1/2PI) int_0^\infty P^3D(k_par,k_perp)k_perp dk_perp  '''
-    def __init__(self,k_par,k_perp,P):  # P(k_par,k_perp) 2D array
-        P1D=np.zeros(len(k_par))
+    def __init__(self,k_par,k_perp,P,method='trapz'):  # P(k_par,k_perp) 2D array or function
                 #  (1/2PI) int_0^\infty P(k_//,k_perp)k_perp dk_perp
-        for i in np.arange(len(k_par)) :
-            P1D[i] = np.trapz(k_perp*P[i,:],k_perp) /2/np.pi
+        P1D = P1D_RSD_projection(k_par, k_perp, P, method=method)
         self.pk1DInter=interpolate.InterpolatedUnivariateSpline(k_par,P1D)
 
     def P1D(self,k):
@@ -79,43 +157,195 @@ class P_0() :
         return np.maximum(self.pkInter(k),0)
 
 
+#********************************************************************
+# On disk cache of the lognormal P(k) tables (kln, Pln) of P_ln, shared by
+# all the jobs of a production (interpolate_pk.py slices, make_boxes.py ...):
+#   <directory>/pln.<sha1 of the P(k) file>.<omega_M_0>.<G_times_bias>.<method>.<nk>.npy
+# directory is cache.directory("pln_cache") by default ($SACLAYMOCKS_CACHE or
+# $SACLAYMOCKS_BASE/etc). The key holds the content of the P(k) file, not its
+# name, so a modified file is recomputed, and constant.omega_M_0, used by
+# read_pk to bring the P(k) to z=0.
+# Tables are also kept in memory for the life of the process.
+_pln_tables = {}
+
+
+def file_hash(filename):
+    '''sha1 of the content of filename'''
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def pln_cache_filename(filename, G_times_bias, method='fftlog', nk=None, directory=None):
+    if directory is None:
+        directory = cache.directory("pln_cache")
+    return os.path.join(directory, "pln.{}.{:.17g}.{:.17g}.{}.{}.npy".format(
+        file_hash(filename), constant.omega_M_0, G_times_bias, method, nk))
+
+
+def lognormal_table(filename, G_times_bias, method='fftlog', nk=None, directory=None):
+    '''kln, Pln = LogNormalP of the P(k) of filename times G_times_bias^2,
+    read from the cache if available, computed and saved otherwise'''
+    if nk is None:
+        nk = 4096 if method == 'fftlog' else 1024*1024  # LogNormalP defaults
+    cachefile = pln_cache_filename(filename, G_times_bias, method, nk, directory)
+    if cachefile in _pln_tables:
+        return _pln_tables[cachefile]
+    if os.path.isfile(cachefile):
+        kln, Pln = np.load(cachefile)
+    else:
+        k_input, P_input = read_pk(filename, G_times_bias)
+        kln, Pln = LogNormalP(k_input,P_input,nk=nk,method=method)
+        try:
+            os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+            # unique temporary name: several jobs can fill the cache at once
+            tmp = cachefile + ".{}.tmp.npy".format(os.getpid())
+            np.save(tmp, np.array([kln, Pln]))
+            os.replace(tmp, cachefile)
+        except OSError as e:
+            print("WARNING: lognormal P(k) not cached in {}: {}".format(cachefile, e))
+    _pln_tables[cachefile] = (kln, Pln)
+    return kln, Pln
+
+
+def read_pk(filename, G_times_bias=1):
+    '''k, P(k) of filename, at z=0 times G_times_bias^2, with k=0 prepended'''
+    fits = FITS(filename)
+    data = fits[1].read()
+    k_input = data['K']
+    P_input = data['PK']
+    zref = fits[1].read_header()['ZREF']
+    fgrowth = util.fgrowth(zref, constant.omega_M_0)
+    P_input /= fgrowth**2  # go to z=0
+    fits.close()
+    zero = np.arange(1)
+    k_input = np.append(zero,k_input)
+    P_input = np.append(zero,P_input)
+    P_input *= G_times_bias**2
+    return k_input, P_input
+
+
 #********************************************************************
 # could be same class as P_0 with
 #       if (logNormal) : k_input,P_input = LogNormalP(k_input,P_input)
 class P_ln() :
-    '''Read P(k) from a file, compute the lognormal P(k), interpolate it'''
-    def __init__(self,filename=None,G_times_bias=1):
-          #     read filename skiping skiprows lines
-          #     k in column colk and p in colp
+    '''Read P(k) from a file, compute the lognormal P(k), interpolate it.
+    If cache, the lognormal P(k) is read from / saved in the cache of
+    lognormal_table'''
+    def __init__(self,filename=None,G_times_bias=1,cache=True):
         if filename is None:
             filename = os.path.expandvars("$SACLAYMOCKS_BASE/etc/PlanckDR12.fits")
-        fits = FITS(filename)
-        data = fits[1].read()
-        k_input = data['K']
-        P_input = data['PK']
-        zref = fits[1].read_header()['ZREF']
-        fgrowth = util.fgrowth(zref, constant.omega_M_0)
-        P_input /= fgrowth**2  # go to z=0
-        fits.close()
-        zero = np.arange(1)
-        k_input = np.append(zero,k_input)
-        P_input = np.append(zero,P_input)
-        P_input *= G_times_bias**2
+        if cache:
+            kln, Pln = lognormal_table(filename, G_times_bias)
+        else:
+            k_input, P_input = read_pk(filename, G_times_bias)
 
-        # # Add Gaussian smearingxb
-        # DX = 2.19
-        # P_input *= np.exp(-k_input**2 * DX**2)
+            # # Add Gaussian smearingxb
+            # DX = 2.19
+            # P_input *= np.exp(-k_input**2 * DX**2)
 
-        kln, Pln = LogNormalP(k_input,P_input)
+            kln, Pln = LogNormalP(k_input,P_input)
         self.pkInter=interpolate.InterpolatedUnivariateSpline(kln,Pln)
     def P(self,k):
         return np.maximum(self.pkInter(k),0)
 
 
+#********************************************************************
+def box_pk(Dcell, filename=None):
+    '''sqrt(P(k)/Vcell) functions of |k| for each extension of the
+    P(k) fits file of make_boxes.py (Pln1, Pln2, Pln3 and P0), computed
+    as interpolate_pk.py does, so that the 3D grids can be evaluated on the fly'''
+    if filename is None:
+        filename = os.path.expandvars("$SACLAYMOCKS_BASE/etc/PlanckDR12.fits")
+    Vcell = np.float32(Dcell**3)
+    functions = {}
+    for ext, z in [('Pln1', constant.z_QSO_bias_1), ('Pln2', constant.z_QSO_bias_2),
+                   ('Pln3', constant.z_QSO_bias_3)]:
+        G_times_bias = util.fgrowth(z, constant.omega_M_0) * util.bias_qso(z)
+        pk = P_ln(filename, G_times_bias=G_times_bias)
+        functions[ext] = lambda k, pk=pk: np.float32(np.sqrt(np.float32(pk.P(k))/Vcell))
+    pk = P_0(filename)
+    functions['P0'] = lambda k, pk=pk: np.float32(np.sqrt(np.float32(pk.P(k))/Vcell))
+    return functions
+
+
 #********************************************************************
 #def P_1D(k) :
 # should be part of class P_0 with an initialization and then interpolation
 
+#********************************************************************
+#  FFTLog (Hamilton 2000): xi(r) <=> P(k) on log spaced grids
+#********************************************************************
+# G(y) = \int_0^\infty F(x) j_0(xy) dx/x, with x log spaced and y = 1/x[::-1].
+# F(x) x^{-q} is expanded in Fourier series of ln(x), then each term
+# x^{q+iw} is transformed analytically with the Mellin transform of j_0:
+#   U(s) = \int_0^\infty t^{s-1} j_0(t) dt = 2^{s-2} sqrt(pi) Gamma(s/2) / Gamma((3-s)/2)
+# valid for 0 < q < 2. It costs two FFTs of N points, and a few thousand
+# points spanning many decades are enough where the linear grid of the
+# sine FFT needs ~1M points to sample the low k.
+# xi(r) = 1/(2pi^2) \int k^3 P(k) j_0(kr) dk/k
+# P(k) = 4pi \int r^3 xi(r) j_0(kr) dr/r
+_fftlog_kernels = {}
+
+
+def fftlog_kernel(N, dlnx, q=1.5):
+    '''Fourier coefficients of the j_0 transform of N log spaced points
+    separated by dlnx, for the output grid y = 1/x[::-1]. Cached.'''
+    key = (N, dlnx, q)
+    if key in _fftlog_kernels:
+        return _fftlog_kernels[key]
+    w = 2 * np.pi * np.fft.fftfreq(N) / dlnx
+    s = q + 1j * w
+    u = np.exp((s-2)*np.log(2) + 0.5*np.log(np.pi)
+               + sp.special.loggamma(s/2) - sp.special.loggamma((3-s)/2))
+    u *= np.exp(1j * w * (N-1) * dlnx)  # (x[0]*y[0])^{-iw}
+    if N % 2 == 0:
+        u[N//2] = u[N//2].real  # Nyquist term of a real transform
+    _fftlog_kernels[key] = u
+    return u
+
+
+def fftlog(x, F, q=1.5):
+    '''G(y) = \int F(x) j_0(xy) dx/x, for x log spaced, at y = 1/x[::-1]'''
+    N = len(x)
+    dlnx = np.log(x[-1] / x[0]) / (N-1)
+    u = fftlog_kernel(N, dlnx, q)
+    y = 1. / x[::-1]
+    c = np.fft.fft(F * x**(-q)) / N
+    G = np.fft.fft(c * u).real * y**(-q)
+    return y, G
+
+
+def fftlog_grid(x, n):
+    '''n log spaced points covering the positive values of x,
+    extended by 3 decades below and 2 above to avoid aliasing'''
+    xmin = np.min(x[x > 0])
+    xmax = np.max(x)
+    return np.logspace(np.log10(xmin)-3, np.log10(xmax)+2, n)
+
+
+def fftlog_sample(k, pk, nk):
+    '''pk(k) interpolated on the fftlog_grid of k, and 0 beyond max(k)
+    as for the sine FFT'''
+    pkInter=interpolate.InterpolatedUnivariateSpline(k,pk)
+    kmax=np.max(k)
+    kIn = fftlog_grid(k, nk)
+    pkIn = np.where(kIn <= kmax, pkInter(np.minimum(kIn, kmax)), 0)
+    return kIn, pkIn
+
+
+def _fftlog_xi_from_pk(k, pk, nk=4096):
+    '''xi_from_pk with FFTLog. The r=0 point is added.'''
+    kmax=np.max(k)
+    kIn, pkIn = fftlog_sample(k, pk, nk)
+    r, xi = fftlog(kIn, kIn**3 * pkIn / 2 / np.pi**2)
+    pkInter=interpolate.InterpolatedUnivariateSpline(k,pk*k*k)
+    xi0 = pkInter.integral(0,kmax) /2/np.pi**2    #   (1/2 PI^2) int P(k) k^2 dk
+    return np.append([0], r), np.append([xi0], xi)
+
+
 #********************************************************************
 #  from P(k) to xi(r) for uneven spaced k points
 #********************************************************************
@@ -127,11 +357,20 @@ class P_ln() :
 #  kmax = 10 -> dr = 0.314
 #  rmax = 1000 -> dk = 0.00314
 # since rmax * kmax = N pi / 2, this ensures N > 20000/pi
-# should use FFTlog instead <==
-def xi_from_pk(k,pk,nk=32*1024,direct=True):
+# method='fftlog' (default) uses FFTLog instead, on nk log spaced points
+# (default 4096), and returns log spaced r (with r[0]=0)
+def xi_from_pk(k,pk,nk=None,direct=True,method='fftlog'):
     if (k[0] != 0) :
         k = np.append([0],k)
         pk = np.append([0],pk)
+    if method == 'fftlog':
+        if nk is None:
+            nk = 4096
+        return _fftlog_xi_from_pk(k, pk, nk)
+    if method != 'fft':
+        raise ValueError("Unknown method {}, should be fftlog or fft".format(method))
+    if nk is None:
+        nk = 32*1024
     pkInter=interpolate.InterpolatedUnivariateSpline(k,pk) #,kind='cubic')
     kmax=np.max(k)
     if direct:
@@ -168,19 +407,34 @@ def xi_from_pk(k,pk,nk=32*1024,direct=True):
 #  xi(r) = (2 pi)^{-3} \int exp(ikr) Pk) dk
 #  P(k) = \int exp(ikr) Pk) dk
 #  so for xi -> P same function as for P -> xi but multiply by (2 pi)^3
-def pk_from_xi(r,xi,nr=32*1024):
-    k, Pk = xi_from_pk(r,xi,nr,direct=False)
+def pk_from_xi(r,xi,nr=None,method='fftlog'):
+    k, Pk = xi_from_pk(r,xi,nr,direct=False,method=method)
     Pk *= (2 * np.pi)**3
     return k, Pk
 
 
 #********************************************************************
 # P(k) => xi(r) => cln(r) = log [1 + \xi(r) ] => Pln(k)
-def LogNormalP(k,P,nk=1024*1024):
-    r , xi = xi_from_pk(k,P,nk=nk)
+# with FFTLog, both transforms are done on the same log spaced grid
+def LogNormalP(k,P,nk=None,method='fftlog'):
+    if method == 'fftlog':
+        if nk is None:
+            nk = 4096
+        if (k[0] != 0) :
+            k = np.append([0],k)
+            P = np.append([0],P)
+        kIn, pkIn = fftlog_sample(k, P, nk)
+        r, xi = fftlog(kIn, kIn**3 * pkIn / 2 / np.pi**2)
+        cln = np.log(1+xi)
+        kln, Pln = fftlog(r, 4 * np.pi * r**3 * cln)
+        Pln = np.maximum(Pln,0)
+        return kln, Pln
+    if nk is None:
+        nk = 1024*1024
+    r , xi = xi_from_pk(k,P,nk=nk,method=method)
     cln = np.log(1+xi)
-    nr = nk/2
-    kln , Pln = pk_from_xi(r,cln,nr=nr)
+    nr = nk//2
+    kln , Pln = pk_from_xi(r,cln,nr=nr,method=method)
     Pln = np.maximum(Pln,0)
     return kln, Pln
 
@@ -0,0 +1,522 @@
+# Fused QSO sampling of draw_qso.py
+# The slab is processed in blocks of z-planes. For each block, one parallel
+# numba kernel evaluates the cells (redshift of the cell center, QSO density
+# from the 3 lognormal boxes, dN/dz and density correction, all read from 1D
+# redshift tables) and draws the number of objects of each cell with a
+# single uniform random number: Bernoulli with the product of the density
+# (cond1) and dN/dz (cond2) probabilities, or Poisson. In the planes where
+# these probabilities are bounded by a small value (e.g. randoms), the cells
+# to evaluate are drawn by geometric skipping. A second kernel places only
+# the selected objects (position in the cell, ra, dec, redshift, RSD) and
+# applies the angular and redshift cuts (cond3) and the footprint.
+# No full-slab or full-plane temporary is built (the QSO density of a cell is
+# computed when it is drawn), and the geometry is computed for the candidates
+# only.
+# The random numbers of the z-plane mz come from a counter-based generator
+# (Philox) keyed by the seed, with its counter starting at (0, 0, mz, grf.QSO),
+# disjoint from the white noise of the boxes drawn with the same seed: the
+# catalog does not depend on the block size nor on the number of threads.
+import time
+import numpy as np
+from numba import jit, prange
+from SaclayMocks.cosmology import lerp
+from SaclayMocks.footprint import contains
+from SaclayMocks import grf
+from SaclayMocks import util
+
+
+#********************************************************************
+def plane_generator(seed, mz):
+    '''Generator of the random numbers of the z-plane mz'''
+    return grf.plane_generator(seed, mz, grf.QSO)
+
+
+def tabulate(f, xmin, xmax, n=2**16):
+    '''(x0, 1/dx, f(x)) on n regular points in [xmin, xmax], for
+    SaclayMocks.cosmology.lerp'''
+    x = np.linspace(xmin, xmax, n)
+    return xmin, (n-1)/(xmax-xmin), np.asarray(f(x), dtype=np.float64)
+
+
+@jit(nopython=True, cache=True)
+def lerp_index(x, x0, inv_dx, n):
+    '''(i, w) such that lerp(x) = (1-w) table[i] + w table[i+1]'''
+    u = (x - x0) * inv_dx
+    if u <= 0:
+        return 0, 0.
+    i = int(u)
+    if i >= n - 1:
+        return n - 2, 1.
+    return i, u - i
+
+
+@jit(nopython=True, cache=True)
+def row(table, k, i, w):
+    return table[k, i] + w * (table[k, i+1] - table[k, i])
+
+
+def lognormal_table(z1, z2, z3, zmax=10., n=2**16):
+    '''(x0, 1/dx, table) with rows A_1, A_2, A_3, a_1, a_2, a_3 of z such that
+    the QSO density of draw_qso.py is ptot = sum_i A_i(z) exp(a_i(z) g_i),
+    g_i being the lognormal box at z_i: ptot = c p12 + (1-c) p23, where
+    p12 and p23 interpolate p_i = exp(g_i)**a(z, z_i) between z1, z2 and z2, z3'''
+    z = np.linspace(0, zmax, n)
+    c = util.qso_lognormal_coef()(z)
+    table = np.array([c*(z2-z)/(z2-z1),
+                      c*(z-z1)/(z2-z1) + (1-c)*(z3-z)/(z3-z2),
+                      (1-c)*(z-z2)/(z3-z2),
+                      util.qso_a_of_z(z, z1),
+                      util.qso_a_of_z(z, z2),
+                      util.qso_a_of_z(z, z3)])
+    return 0., (n-1)/zmax, table
+
+
+@jit(nopython=True, cache=True)
+def ra_dec(x, y, z, ra0, dec0):
+    '''box.ComputeRaDecR2 for one point, angles in radians'''
+    numra = (np.cos(ra0)*x - np.sin(dec0)*np.sin(ra0)*y
+             + np.cos(dec0)*np.sin(ra0)*z)
+    denomra = (-np.sin(ra0)*x - np.sin(dec0)*np.cos(ra0)*y
+               + np.cos(dec0)*np.cos(ra0)*z)
+    numdec = np.cos(dec0)*y + np.sin(dec0)*z
+    R = np.sqrt(x*x + y*y + z*z)
+    ra = np.arctan2(numra, denomra)
+    if ra < 0:
+        ra += 2*np.pi
+    return ra, np.arcsin(numdec/R), R
+
+
+@jit(nopython=True, cache=True)
+def diffmod(a, b, c):
+    d = (a - b) % c
+    return min(d, c - d)
+
+
+#********************************************************************
+@jit(nopython=True, inline='always')
+def dndz_prob(redshift, dn_cell, dz0, ddz, corr, density_max, random_cond):
+    '''dN/dz acceptance of a cell (cond2): density / density_max, at most 1.
+    For the QSO, the density is corrected for the z dependence of cond1
+    (due to a(z))'''
+    iz = int(np.rint((redshift - dz0) / ddz))
+    if iz < 0 or iz >= len(dn_cell):
+        return 0.
+    density = dn_cell[iz]
+    if not random_cond:
+        density /= lerp(redshift, corr[0], corr[1], corr[2])
+    return min(density / density_max, 1.)
+
+
+@jit(nopython=True, inline='always')
+def cell_redshift(ix, iy, mz, x_axis, y_axis, z_axis, zR):
+    '''Redshift of the center of the cell (ix, iy, mz)'''
+    zz = z_axis[mz]
+    R = np.sqrt(x_axis[ix]*x_axis[ix] + y_axis[iy]*y_axis[iy] + zz*zz)
+    return lerp(R, zR[0], zR[1], zR[2])
+
+
+@jit(nopython=True, inline='always')
+def density(ix, iy, mz, z_cell, g1, g2, g3, lognormal):
+    '''QSO density ptot of the cell (ix, iy, mz) at redshift z_cell'''
+    # apply a(z): P = exp(delta)**a(z) for each lognormal, and interpolate
+    x0, inv_dx, table = lognormal
+    i, w = lerp_index(z_cell, x0, inv_dx, table.shape[1])
+    return (row(table, 0, i, w) * np.exp(row(table, 3, i, w) * g1[ix, iy, mz])
+            + row(table, 1, i, w) * np.exp(row(table, 4, i, w) * g2[ix, iy, mz])
+            + row(table, 2, i, w) * np.exp(row(table, 5, i, w) * g3[ix, iy, mz]))
+
+
+@jit(nopython=True, inline='always')
+def cell_count(ix, iy, mz, u, scale, g1, g2, g3, lognormal, x_axis, y_axis,
+               z_axis, zR, zfix, dn_cell, dz0, ddz, corr, norm, density_max,
+               random_cond, rand_nb, full_box, poisson):
+    '''(number of objects in the cell (ix, iy, mz), ptot, p1), from the single uniform u.
+    The probability of the cell is p = p1 p2, with p1 = min(norm*ptot, 1)
+    (cond1, rand_nb for the randoms) and p2 the dN/dz acceptance (cond2, 1 if
+    full_box). The cell was drawn with probability scale >= p (1 if all
+    the cells are evaluated, or geometric skipping), so it is accepted if
+    u*scale < p. If poisson, the number of objects is drawn from a Poisson
+    law of mean norm*ptot*p2 instead (scale must be 1).
+    The QSO density of the cell, ptot = sum_i A_i(z) exp(a_i(z) g_i), is
+    computed from the lognormal boxes g_i and the table lognormal of
+    A_1, A_2, A_3, a_1, a_2, a_3 (see lognormal_table).'''
+    z_cell = cell_redshift(ix, iy, mz, x_axis, y_axis, z_axis, zR)
+    ptot = 0.
+    if random_cond:
+        lam1 = rand_nb
+    else:
+        ptot = density(ix, iy, mz, z_cell, g1, g2, g3, lognormal)
+        lam1 = norm * ptot
+    p1 = min(lam1, 1.)
+    # p2 <= 1: no need to compute it if the cell is rejected anyway
+    if poisson:
+        if u <= np.exp(-lam1):
+            return 0, ptot, p1
+    elif u * scale >= p1:
+        return 0, ptot, p1
+    if full_box:
+        p2 = 1.
+    else:
+        if zfix > 0:
+            redshift = zfix
+        else:
+            redshift = z_cell
+        p2 = dndz_prob(redshift, dn_cell, dz0, ddz, corr, density_max, random_cond)
+    if not poisson:
+        return int(u * scale < p1 * p2), ptot, p1
+    lam = lam1 * p2
+    n = 0
+    pk = np.exp(-lam)
+    cdf = pk
+    while u > cdf and n < 1000:
+        n += 1
+        pk *= lam / n
+        cdf += pk
+    return n, ptot, p1
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _select_dense(planes, u, g1, g2, g3, lognormal, x_axis, y_axis, z_axis, zR,
+                  zfix, dn_cell, dz0, ddz, corr, norm, sat_norm, density_max,
+                  random_cond, rand_nb, full_box, poisson, counts, stats):
+    '''counts[j, ix, iy] = number of objects in the cell (ix, iy, planes[j]),
+    from the uniform u[j, ix, iy] (see cell_count).
+    stats[ix] accumulates the sum of p1 (expected number of cells passing
+    cond1), max(ptot), and the number of cells and sum of min(sat_norm*ptot, 1)'''
+    NX = u.shape[1]
+    NY = u.shape[2]
+    for ix in prange(NX):
+        n1 = 0.
+        pmax = stats[ix, 1]
+        nsat = 0
+        ssat = 0.
+        for j in range(len(planes)):
+            for iy in range(NY):
+                n, ptot, p1 = cell_count(ix, iy, planes[j], u[j, ix, iy], 1., g1, g2, g3,
+                                         lognormal, x_axis, y_axis, z_axis, zR, zfix,
+                                         dn_cell, dz0, ddz, corr, norm, density_max,
+                                         random_cond, rand_nb, full_box, poisson)
+                counts[j, ix, iy] = n
+                n1 += p1
+                pmax = max(pmax, ptot)
+                if sat_norm * ptot > 1:
+                    nsat += 1
+                    ssat += 1.
+                else:
+                    ssat += sat_norm * ptot
+        if not random_cond:
+            stats[ix, 0] += n1
+            stats[ix, 1] = pmax
+            stats[ix, 2] += nsat
+            stats[ix, 3] += ssat
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _plane_stats(planes, g1, g2, g3, lognormal, x_axis, y_axis, z_axis, zR,
+                 norm, sat_norm, stats):
+    '''stats of _select_dense for the planes whose cells are not all drawn'''
+    NX = len(x_axis)
+    NY = len(y_axis)
+    for ix in prange(NX):
+        n1 = 0.
+        pmax = stats[ix, 1]
+        nsat = 0
+        ssat = 0.
+        for j in range(len(planes)):
+            for iy in range(NY):
+                z_cell = cell_redshift(ix, iy, planes[j], x_axis, y_axis, z_axis, zR)
+                ptot = density(ix, iy, planes[j], z_cell, g1, g2, g3, lognormal)
+                n1 += min(norm * ptot, 1.)
+                pmax = max(pmax, ptot)
+                if sat_norm * ptot > 1:
+                    nsat += 1
+                    ssat += 1.
+                else:
+                    ssat += sat_norm * ptot
+        stats[ix, 0] += n1
+        stats[ix, 1] = pmax
+        stats[ix, 2] += nsat
+        stats[ix, 3] += ssat
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _select_sparse(mz, ix, iy, u, scale, g1, g2, g3, lognormal, x_axis, y_axis,
+                   z_axis, zR, zfix, dn_cell, dz0, ddz, corr, norm, density_max,
+                   random_cond, rand_nb, full_box, counts):
+    '''counts[k] = number of objects (0 or 1) in the cell (ix[k], iy[k], mz[k]),
+    drawn with probability scale[k] (see cell_count)'''
+    for k in prange(len(u)):
+        counts[k] = cell_count(ix[k], iy[k], mz[k], u[k], scale[k], g1, g2, g3,
+                               lognormal, x_axis, y_axis, z_axis, zR, zfix,
+                               dn_cell, dz0, ddz, corr, norm, density_max,
+                               random_cond, rand_nb, full_box, False)[0]
+
+
+def skip_cells(generator, p, n):
+    '''Sorted indices in [0, n) of the successes of n Bernoulli(p) trials,
+    drawn by geometric skipping: about n*p random numbers instead of n'''
+    m = int(n*p + 5*np.sqrt(n*p) + 10)
+    idx = np.cumsum(generator.geometric(p, size=m)) - 1
+    while idx[-1] < n:
+        idx = np.concatenate([idx, idx[-1] + np.cumsum(generator.geometric(p, size=m))])
+    return idx[idx < n]
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def _place(ix, iy, mz, u, x_axis, y_axis, z_axis, DX, DY, DZ, ra0, dec0,
+           zR, zfix, R_zfix, rsd, vx, vy, vz, growth, H0, z_min, z_max,
+           dra, ddec, full_box, fp_nside, fp_bits, out, keep):
+    '''Position, ra, dec and redshifts of the candidates, and the cuts (cond3),
+    and the footprint bitmap fp_bits if fp_nside > 0.
+    out columns: XX, YY, ZZ, RA, DEC, Z, Z_RSD (degrees, Mpc/h)'''
+    ra0_deg = np.degrees(ra0)
+    dec0_deg = np.degrees(dec0)
+    for i in prange(len(ix)):
+        X = x_axis[ix[i]] + DX * (u[i, 0] - 0.5)
+        Y = y_axis[iy[i]] + DY * (u[i, 1] - 0.5)
+        Z = z_axis[mz[i]] + DZ * (u[i, 2] - 0.5)
+        ra, dec, RR = ra_dec(X, Y, Z, ra0, dec0)
+        ra = np.degrees(ra)
+        dec = np.degrees(dec)
+        if zfix > 0:
+            redshift = zfix
+        else:
+            redshift = lerp(RR, zR[0], zR[1], zR[2])
+        redshift_rsd = redshift
+        if rsd:
+            if zfix > 0:
+                RR_RSD = R_zfix
+            else:
+                RR_RSD = RR
+            if redshift < z_max + 1.:  # dont' go above z=5
+                vpar = (X*vx[ix[i], iy[i], mz[i]] + Y*vy[ix[i], iy[i], mz[i]]
+                        + Z*vz[ix[i], iy[i], mz[i]]) / RR
+                RR_RSD += vpar * (1+redshift) * lerp(redshift, growth[0], growth[1], growth[2]) / H0
+            redshift_rsd = lerp(RR_RSD, zR[0], zR[1], zR[2])
+        out[i, 0] = X
+        out[i, 1] = Y
+        out[i, 2] = Z
+        out[i, 3] = ra
+        out[i, 4] = dec
+        out[i, 5] = redshift
+        out[i, 6] = redshift_rsd
+        keep[i] = full_box or (diffmod(ra, ra0_deg, 360.) < dra and diffmod(dec, dec0_deg, 180.) < ddec
+                               and redshift_rsd > z_min and redshift_rsd < z_max)
+        if fp_nside > 0 and keep[i]:
+            keep[i] = contains(ra, dec, fp_nside, fp_bits)
+
+
+#********************************************************************
+class QSOSampler():
+    '''Draw the QSO (or randoms) of a slab, block of z-planes by block.
+    zR: table of z(R), R in Mpc/h (see cosmology.rescale); lognormal: table
+    of the QSO density (see lognormal_table); corr: table of the a(z) density
+    correction of cond1; growth: table of dD/dz / dD/dz(z=0) (used for the
+    RSD). lognormal and corr are unused for randoms. Tables other than zR
+    and lognormal are made by tabulate.
+    sat_norm is only used for the statistics of min(sat_norm*ptot, 1).
+    Each cell is drawn once with probability p1*p2 (cond1 and cond2, see
+    _select), or with a Poisson count of mean norm*ptot*p2 if poisson.
+    In a plane where the bound of p1*p2 (rand_nb or 1, times the maximal
+    dN/dz acceptance) is below sparse, only the cells drawn with this bound
+    by geometric skipping are evaluated (not if poisson). The statistics of
+    ptot (nnQSO, rho_max, n_saturated, sum_saturated) are accumulated over
+    the planes where all the cells are evaluated (nstats cells), and also
+    over the other planes if full_stats: ptot is then computed in all their
+    cells, for these diagnostics only, which cancels most of the saving of
+    the geometric skipping.
+    If footprint (a footprint.Footprint) is given, only the objects in it
+    are kept.'''
+    def __init__(self, x_axis, y_axis, z_axis, DX, DY, DZ, ra0, dec0, dra, ddec,
+                 z_min, z_max, zR, dn_cell, dz0, ddz, density_max, seed,
+                 norm=1., lognormal=None, corr=None, growth=None, H0=100., zfix=None, R_zfix=0.,
+                 sat_norm=0., random_cond=False, rand_nb=0., full_box=False, nblock=16,
+                 poisson=False, sparse=0.1, footprint=None, full_stats=False):
+        self.x_axis = np.asarray(x_axis, dtype=np.float64)
+        self.y_axis = np.asarray(y_axis, dtype=np.float64)
+        self.z_axis = np.asarray(z_axis, dtype=np.float64)
+        self.DX = DX
+        self.DY = DY
+        self.DZ = DZ
+        self.ra0 = np.radians(ra0)
+        self.dec0 = np.radians(dec0)
+        self.dra = dra
+        self.ddec = ddec
+        self.z_min = z_min
+        self.z_max = z_max
+        self.zR = zR
+        self.dn_cell = np.asarray(dn_cell, dtype=np.float64)
+        self.dz0 = dz0
+        self.ddz = ddz
+        self.density_max = density_max
+        self.seed = seed
+        self.norm = norm
+        dummy = (0., 1., np.ones(2))
+        self.lognormal = lognormal if lognormal is not None else (0., 1., np.ones((6, 2)))
+        self.sat_norm = sat_norm
+        self.corr = corr if corr is not None else dummy
+        self.growth = growth if growth is not None else dummy
+        self.H0 = H0
+        self.zfix = zfix if zfix is not None else -1.
+        self.R_zfix = R_zfix
+        self.random_cond = random_cond
+        self.rand_nb = rand_nb
+        self.full_box = full_box
+        self.nblock = nblock
+        self.poisson = poisson
+        self.sparse = sparse
+        self.full_stats = full_stats
+        if footprint is not None:
+            self.fp_nside = footprint.nside
+            self.fp_bits = footprint.bits
+        else:
+            self.fp_nside = 0
+            self.fp_bits = np.zeros(1, dtype=np.uint8)
+        self.stats = np.zeros((len(self.x_axis), 4))
+        self.ncells = 0
+        self.nstats = 0
+        self.nrandom = 0
+        self.t_select = 0.
+        self.t_place = 0.
+
+    def sample(self, g=None, vx=None, vy=None, vz=None, mz0=0, mz1=None):
+        '''Candidates of the z-planes [mz0, mz1) that pass all the cuts, as a
+        (n, 7) array of XX, YY, ZZ, RA, DEC, Z, Z_RSD, sorted by plane.
+        g is the tuple of the 3 (NX, NY, NZ) lognormal boxes (None for
+        randoms), vx, vy, vz the velocity boxes (None without RSD)'''
+        NX = len(self.x_axis)
+        NY = len(self.y_axis)
+        if mz1 is None:
+            mz1 = len(self.z_axis)
+        rsd = vx is not None
+        if g is None:
+            g = (np.zeros((1, 1, 1), dtype=np.float32),) * 3
+        if not rsd:
+            vx = vy = vz = np.zeros((1, 1, 1), dtype=np.float32)
+        results = []
+        for b0 in range(mz0, mz1, self.nblock):
+            b1 = min(b0+self.nblock, mz1)
+            t0 = time.time()
+            generators = [plane_generator(self.seed, mz) for mz in range(b0, b1)]
+            # upper bound of the probability of the cells of each plane
+            scale = np.ones(b1-b0)
+            if self.random_cond:
+                scale *= self.rand_nb
+            if not self.full_box:
+                scale *= [self.dndz_bound(mz) for mz in range(b0, b1)]
+            # all the cells of dense planes, geometric skipping in the others
+            dense = [j for j in range(b1-b0) if scale[j] > 0
+                     and (self.poisson or scale[j] >= self.sparse)]
+            u_dense = np.empty((len(dense), NX, NY))
+            cells = []
+            u_sparse = []
+            for j, generator in enumerate(generators):
+                if j in dense:
+                    generator.random(out=u_dense[dense.index(j)])
+                elif scale[j] > 0:
+                    cells.append(j*NX*NY + skip_cells(generator, scale[j], NX*NY))
+                    u_sparse.append(generator.random(len(cells[-1])))
+            counts = np.zeros(u_dense.shape, dtype=np.int32)
+            _select_dense(b0 + np.array(dense, dtype=np.int64), u_dense, g[0], g[1], g[2],
+                          self.lognormal, self.x_axis, self.y_axis, self.z_axis, self.zR,
+                          self.zfix, self.dn_cell, self.dz0, self.ddz, self.corr,
+                          self.norm, self.sat_norm, self.density_max, self.random_cond,
+                          self.rand_nb, self.full_box, self.poisson, counts, self.stats)
+            self.nstats += len(dense) * NX * NY
+            if not self.random_cond and self.full_stats:
+                others = [b0+j for j in range(b1-b0) if j not in dense]
+                _plane_stats(np.array(others, dtype=np.int64), g[0], g[1], g[2],
+                             self.lognormal, self.x_axis, self.y_axis, self.z_axis,
+                             self.zR, self.norm, self.sat_norm, self.stats)
+                self.nstats += len(others) * NX * NY
+            jd, ix, iy = np.nonzero(counts)
+            n = counts[jd, ix, iy]
+            selected = [np.repeat((np.array(dense, dtype=np.int64)[jd]*NX + ix)*NY + iy, n)]
+            if len(cells) > 0:
+                cells = np.concatenate(cells)
+                u_sparse = np.concatenate(u_sparse)
+                counts = np.zeros(len(cells), dtype=np.int32)
+                _select_sparse(b0 + cells // (NX*NY), (cells % (NX*NY)) // NY, cells % NY,
+                               u_sparse, scale[cells // (NX*NY)], g[0], g[1], g[2],
+                               self.lognormal, self.x_axis, self.y_axis, self.z_axis,
+                               self.zR, self.zfix, self.dn_cell, self.dz0, self.ddz,
+                               self.corr, self.norm, self.density_max, self.random_cond,
+                               self.rand_nb, self.full_box, counts)
+                selected.append(cells[counts > 0])
+                self.nrandom += len(u_sparse)
+            self.nrandom += u_dense.size
+            self.ncells += (b1-b0) * NX * NY
+            # in the order of the planes, and of the cells in each plane
+            cells = np.sort(np.concatenate(selected), kind='stable')
+            jj = cells // (NX*NY)
+            ix = (cells % (NX*NY)) // NY
+            iy = cells % NY
+            del u_dense, u_sparse, counts
+            t1 = time.time()
+            # positions in the cells, from the generator of each plane
+            u = np.empty((len(jj), 3))
+            bounds = np.searchsorted(jj, np.arange(b1-b0+1))
+            for j, generator in enumerate(generators):
+                generator.random(out=u[bounds[j]:bounds[j+1]])
+            out = np.empty((len(jj), 7))
+            keep = np.zeros(len(jj), dtype=np.bool_)
+            _place(ix, iy, jj + b0, u, self.x_axis, self.y_axis, self.z_axis,
+                   self.DX, self.DY, self.DZ, self.ra0, self.dec0, self.zR,
+                   self.zfix, self.R_zfix, rsd, vx, vy, vz, self.growth, self.H0,
+                   self.z_min, self.z_max, self.dra, self.ddec, self.full_box,
+                   self.fp_nside, self.fp_bits, out, keep)
+            results.append(out[keep])
+            self.t_select += t1 - t0
+            self.t_place += time.time() - t1
+        if len(results) == 0:
+            return np.zeros((0, 7))
+        return np.concatenate(results)
+
+    def dndz_bound(self, mz):
+        '''Upper bound of the dN/dz acceptance (dndz_prob) of the cells of the plane mz'''
+        if self.zfix > 0:
+            zlo = zhi = self.zfix
+        else:
+            zz = self.z_axis[mz]
+            Rlo = np.sqrt(zz*zz + (self.x_axis**2).min() + (self.y_axis**2).min())
+            Rhi = np.sqrt(zz*zz + (self.x_axis**2).max() + (self.y_axis**2).max())
+            zlo = lerp(Rlo, *self.zR)
+            zhi = lerp(Rhi, *self.zR)
+        i0 = max(int(np.rint((zlo - self.dz0) / self.ddz)), 0)
+        i1 = int(np.rint((zhi - self.dz0) / self.ddz))
+        if i1 < i0 or i0 >= len(self.dn_cell):
+            return 0.
+        density = self.dn_cell[i0:i1+1].max()
+        if not self.random_cond:
+            # the linear interpolation of corr is at least its smallest node
+            x0, inv_dx, table = self.corr
+            k0 = min(max(int((zlo - x0) * inv_dx), 0), len(table)-1)
+            k1 = min(max(int((zhi - x0) * inv_dx) + 1, 0), len(table)-1)
+            density /= table[k0:k1+1].min()
+        return min(density / self.density_max, 1.)
+
+    @property
+    def nnQSO(self):
+        '''expected number of cells passing the density draw (cond1)'''
+        return int(round(self.stats[:, 0].sum()))
+
+    @property
+    def rho_max(self):
+        return self.stats[:, 1].max()
+
+    @property
+    def n_saturated(self):
+        '''number of cells with sat_norm*ptot > 1'''
+        return int(self.stats[:, 2].sum())
+
+    @property
+    def sum_saturated(self):
+        '''sum of min(sat_norm*ptot, 1)'''
+        return self.stats[:, 3].sum()
+
+    def print_timings(self):
+        t = self.t_select + self.t_place
+        print("Sampled {} cells in {:.2f} s ({:.3g} cells/s): selection {:.2f} s, placement {:.2f} s".format(
+            self.ncells, t, self.ncells / max(t, 1e-9), self.t_select, self.t_place))
+        print("{} uniform random numbers for the selection ({:.3g} per cell)".format(
+            self.nrandom, self.nrandom / max(self.ncells, 1)))
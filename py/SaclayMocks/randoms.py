@@ -0,0 +1,134 @@
+# Random catalogs drawn from the footprint and the QSO dN/dz, without boxes
+# The sky is split into the nest pixels of nside (e.g. the nside 16 pixels of
+# the outputs), drawn independently: the number of randoms of a pixel is
+# Poisson distributed, with a mean proportional to its area in the
+# footprint. As healpix pixels have equal areas, the footprint pixels of the
+# randoms are drawn uniformly among the ones of the pixel that are set in the
+# footprint bitmap, and the position in a footprint pixel is the center of a
+# uniformly drawn sub-pixel at nside 2**29 (~0.4 mas).
+# The redshifts are drawn by inverse CDF from the dN/dz of
+# etc/nz_qso_desi.dat, linearly interpolated between the bin centers as in
+# draw_qso.py.
+# The random numbers of the pixel pix come from a counter-based generator
+# (Philox) keyed by the seed, with its counter starting at
+# (0, 0, pix, grf.RANDOMS), disjoint from the streams of the boxes and QSO
+# drawn with the same seed: the catalog does not depend on how the pixels are
+# shared among jobs and processes.
+import os
+import multiprocessing
+import numpy as np
+import healpy as hp
+from SaclayMocks import grf
+
+NSIDE_MAX = 2**29
+# THING_ID of the randoms: THING_ID_OFFSET + 1, 2, ..., above the ones of
+# draw_qso.py (chunk*1e9 + slice*1e6 + k)
+THING_ID_OFFSET = 2**60
+
+
+#********************************************************************
+def pixel_generator(seed, pix):
+    '''Generator of the random numbers of the pixel pix'''
+    return grf.plane_generator(seed, int(pix), grf.RANDOMS)
+
+
+class RedshiftDistribution():
+    '''dN/dz per deg^2 of the dN/dz file (number per deg^2 per bin), linearly
+    interpolated between the bin centers, between zmin and zmax.
+    n_deg2 is the number per deg^2 between zmin and zmax'''
+    def __init__(self, zmin, zmax, filename=None, n=2**16):
+        if filename is None:
+            filename = os.path.expandvars("$SACLAYMOCKS_BASE/etc/nz_qso_desi.dat")
+        d = np.loadtxt(filename)
+        delta_z = d[1,0]-d[0,0]
+        zc = (d[:,0]+d[:,1])/2
+        if zmin < zc[0] or zmax > zc[-1] or zmin >= zmax:
+            raise ValueError("[{}, {}] is not in the dN/dz range [{}, {}] of {}".format(
+                zmin, zmax, zc[0], zc[-1], filename))
+        self.zmin = zmin
+        self.zmax = zmax
+        self.z = np.linspace(zmin, zmax, n)
+        self.dndz = np.interp(self.z, zc, d[:,2]) / delta_z
+        cdf = np.zeros(n)
+        cdf[1:] = np.cumsum((self.dndz[1:]+self.dndz[:-1])/2*np.diff(self.z))
+        self.n_deg2 = cdf[-1]
+        self.cdf = cdf / cdf[-1]
+
+    def number(self, z1, z2):
+        '''Number per deg^2 between z1 and z2 (within [zmin, zmax])'''
+        return self.n_deg2 * (np.interp(z2, self.z, self.cdf) - np.interp(z1, self.z, self.cdf))
+
+    def sample(self, u):
+        '''Redshifts of the uniform random numbers u'''
+        return np.interp(u, self.cdf, self.z)
+
+
+#********************************************************************
+_sampler = None
+
+
+def _sample_task(pix):
+    return _sampler.sample(pix)
+
+
+class RandomSampler():
+    '''Randoms with density objects per deg^2 between the redshifts of the
+    RedshiftDistribution redshift, in the footprint (a footprint.Footprint)
+    if given, otherwise on the full sky, by nest pixel at nside'''
+    def __init__(self, nside, redshift, density, seed, footprint=None):
+        npix = hp.nside2npix(nside)
+        if footprint is None:
+            self.fine_nside = nside
+            self.mask = np.ones((npix, 1), dtype=bool)
+        else:
+            if footprint.nside < nside:
+                raise ValueError("nside {} > footprint nside {}".format(nside, footprint.nside))
+            self.fine_nside = footprint.nside
+            self.mask = footprint.mask().reshape(npix, -1)
+        self.nside = nside
+        self.redshift = redshift
+        self.density = density
+        self.seed = seed
+        self.area = hp.nside2pixarea(self.fine_nside, degrees=True)
+
+    def pixels(self):
+        '''Pixels at nside that overlap the footprint'''
+        return np.flatnonzero(self.mask.any(axis=1))
+
+    def expected(self, pix):
+        '''Mean number of randoms in the pixel pix'''
+        return self.density * self.area * self.mask[pix].sum()
+
+    def count(self, pix):
+        '''Number of randoms of the pixel pix (first draw of its generator)'''
+        return pixel_generator(self.seed, pix).poisson(self.expected(pix))
+
+    def offsets(self, pixels):
+        '''Number of randoms in the pixels before each pixel, e.g. for ids
+        that do not depend on how the pixels are shared'''
+        counts = np.array([self.count(pix) for pix in pixels], dtype=np.int64)
+        return np.cumsum(counts) - counts
+
+    def sample(self, pix):
+        '''ra, dec (degrees) and z of the randoms of the pixel pix'''
+        generator = pixel_generator(self.seed, pix)
+        n = generator.poisson(self.expected(pix))
+        if n == 0:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+        fine = pix * self.mask.shape[1] + np.flatnonzero(self.mask[pix])
+        sub = (NSIDE_MAX // self.fine_nside)**2
+        ipix = fine[generator.integers(len(fine), size=n)] * sub + generator.integers(sub, size=n)
+        theta, phi = hp.pix2ang(NSIDE_MAX, ipix, nest=True)
+        ra = phi*180/np.pi
+        dec = (np.pi/2 - theta) * 180/np.pi
+        z = self.redshift.sample(generator.random(n))
+        return ra, dec, z
+
+    def sample_pixels(self, pixels, nproc=1):
+        '''sample of each pixel, computed by nproc processes'''
+        global _sampler
+        if nproc <= 1:
+            return [self.sample(pix) for pix in pixels]
+        _sampler = self
+        with multiprocessing.get_context('fork').Pool(nproc) as pool:
+            return pool.map(_sample_task, pixels, chunksize=1)
@@ -0,0 +1,197 @@
+# Slab-decomposed real 3D FFT, distributed over several local processes.
+# The real box (NX,NY,NZ) and its transform (NX,NY,NZ//2+1) live in
+# memory-mapped .npy buffers shared by all the workers:
+#   forward : r2c over (y,z) on x-slabs, then c2c over x on y-slabs
+#   backward: c2c over x on y-slabs, then c2r over (y,z) on x-slabs
+# Each worker only holds one slab (and its pyfftw plan) at a time, so the
+# memory per process is bounded by block_mb, whatever the box size.
+# Normalisation is the FFTW one (unnormalised in both directions), as for
+# pyfftw.FFTW(...).execute() used in make_boxes.py
+# With a wisdom.WisdomManager, the slab plans are made (and their wisdom
+# saved) by it; preplan plans all the slabs of a box, e.g. in fftw_wisdom.py
+import os
+import multiprocessing
+import numpy as np
+import pyfftw
+
+
+_plans = {}   # pyfftw plans cached in each worker process
+_wisdom = None  # wisdom.WisdomManager of the workers, set before they are forked
+
+
+#********************************************************************
+def _make_plan(input_array, output_array, axes, direction, threads):
+    if _wisdom is not None:
+        return _wisdom.plan(input_array, output_array, axes, direction, threads)
+    return pyfftw.FFTW(input_array, output_array, axes=axes, threads=threads,
+                       direction=direction, flags=('FFTW_DESTROY_INPUT',))
+
+
+def _get_plan(kind, shape, threads):
+    '''Return a cached pyfftw plan for this process.
+    shape is the shape of the real slab for 'r2c_yz' and 'c2r_yz', and of
+    the complex slab for 'fft_x' and 'ifft_x' '''
+    key = (kind, shape, threads)
+    if key not in _plans:
+        if kind in ('r2c_yz', 'c2r_yz'):
+            rr = pyfftw.empty_aligned(shape, dtype='float32')
+            cc = pyfftw.empty_aligned(shape[:2]+(shape[2]//2+1,), dtype='complex64')
+            if kind == 'r2c_yz':
+                plan = _make_plan(rr, cc, (1, 2), 'FFTW_FORWARD', threads)
+            else:
+                plan = _make_plan(cc, rr, (1, 2), 'FFTW_BACKWARD', threads)
+        else:
+            c1 = pyfftw.empty_aligned(shape, dtype='complex64')
+            c2 = pyfftw.empty_aligned(shape, dtype='complex64')
+            if kind == 'fft_x':
+                direction = 'FFTW_FORWARD'
+            else:
+                direction = 'FFTW_BACKWARD'
+            plan = _make_plan(c1, c2, (0,), direction, threads)
+        _plans[key] = plan
+    return _plans[key]
+
+
+def block_sizes(NX, NY, NZ, block_mb=256):
+    '''Number of x-planes of the x-slabs and of y-planes of the y-slabs,
+    for about block_mb Mbytes per worker'''
+    NZk = NZ//2 + 1
+    # x-slab: real + complex slab, in the plan buffers and in the copy
+    nbytes = 2 * NY * (NZ*4 + NZk*8)
+    nx_block = int(max(1, min(NX, block_mb*2**20 // nbytes)))
+    # y-slab: two complex buffers, plus the copy
+    nbytes = 3 * NX * NZk * 8
+    ny_block = int(max(1, min(NY, block_mb*2**20 // nbytes)))
+    return nx_block, ny_block
+
+
+def preplan(NX, NY, NZ, wisdom_manager, threads=1, block_mb=256):
+    '''Plan, with wisdom_manager, the slab transforms of SlabFFT(NX, NY, NZ,
+    threads=threads, block_mb=block_mb), in this process'''
+    global _wisdom
+    _wisdom = wisdom_manager
+    nx_block, ny_block = block_sizes(NX, NY, NZ, block_mb)
+    for nx in sorted({nx_block, NX % nx_block} - {0}):
+        for kind in ('r2c_yz', 'c2r_yz'):
+            _get_plan(kind, (nx, NY, NZ), threads)
+    for ny in sorted({ny_block, NY % ny_block} - {0}):
+        for kind in ('fft_x', 'ifft_x'):
+            _get_plan(kind, (NX, ny, NZ//2+1), threads)
+
+
+#********************************************************************
+def _yz_pass(args):
+    '''r2c or c2r over the (y,z) axes of the x-slab [x0:x1]'''
+    kind, src_path, dst_path, x0, x1, threads = args
+    src = np.load(src_path, mmap_mode='r')
+    dst = np.load(dst_path, mmap_mode='r+')
+    if kind == 'r2c_yz':
+        shape = (x1-x0,) + src.shape[1:]
+    else:
+        shape = (x1-x0,) + dst.shape[1:]
+    plan = _get_plan(kind, shape, threads)
+    plan.input_array[:] = src[x0:x1]
+    plan.execute()
+    dst[x0:x1] = plan.output_array
+    dst.flush()
+    del src, dst
+
+
+def _x_pass(args):
+    '''c2c over the x axis of the y-slab [:, y0:y1] (the transpose step)'''
+    kind, src_path, dst_path, y0, y1, threads = args
+    if src_path == dst_path:
+        src = np.load(src_path, mmap_mode='r+')
+        dst = src
+    else:
+        src = np.load(src_path, mmap_mode='r')
+        dst = np.load(dst_path, mmap_mode='r+')
+    shape = (src.shape[0], y1-y0, src.shape[2])
+    plan = _get_plan(kind, shape, threads)
+    plan.input_array[:] = src[:, y0:y1]
+    plan.execute()
+    dst[:, y0:y1] = plan.output_array
+    dst.flush()
+    del src, dst
+
+
+#********************************************************************
+class SlabFFT():
+    '''Real <-> complex 3D FFT of a (NX,NY,NZ) float32 box, decomposed in
+    x-slabs and y-slabs processed by nproc local worker processes.
+    The shared buffers are .npy memory maps created in workdir.
+    The workers plan with wisdom_manager (a wisdom.WisdomManager) if given'''
+    def __init__(self, NX, NY, NZ, nproc, workdir, threads=1, block_mb=256, wisdom_manager=None):
+        global _wisdom
+        self.NX = NX
+        self.NY = NY
+        self.NZ = NZ
+        self.NZk = NZ//2 + 1
+        self.nproc = nproc
+        self.threads = threads
+        self.workdir = workdir
+        self.nx_block, self.ny_block = block_sizes(NX, NY, NZ, block_mb)
+        self.real_path = os.path.join(workdir, "slabfft_real.npy")
+        self.cplx_path = os.path.join(workdir, "slabfft_cplx.npy")
+        self.scratch_path = os.path.join(workdir, "slabfft_scratch.npy")
+        self.extra_paths = set()
+        _wisdom = wisdom_manager
+        self.pool = multiprocessing.get_context('fork').Pool(nproc)
+        print("SlabFFT: {} processes, x-slabs of {} planes, y-slabs of {} planes".format(
+            nproc, self.nx_block, self.ny_block))
+
+    def _x_blocks(self):
+        return [(x0, min(x0+self.nx_block, self.NX)) for x0 in range(0, self.NX, self.nx_block)]
+
+    def _y_blocks(self):
+        return [(y0, min(y0+self.ny_block, self.NY)) for y0 in range(0, self.NY, self.ny_block)]
+
+    def real_buffer(self, ibuf=0):
+        '''Shared (NX,NY,NZ) float32 buffer; ibuf > 0 gives other buffers,
+        e.g. to write a box while the next one is computed'''
+        path = self.real_path
+        if ibuf > 0:
+            path = path.replace(".npy", "_{}.npy".format(ibuf))
+            self.extra_paths.add(path)
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                         shape=(self.NX, self.NY, self.NZ))
+
+    def complex_buffer(self, path=None):
+        '''Shared (NX,NY,NZ//2+1) complex64 buffer'''
+        if path is None:
+            path = self.cplx_path
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.complex64,
+                                         shape=(self.NX, self.NY, self.NZk))
+
+    def forward(self, box, boxk):
+        '''r2c FFT of the memory-mapped box into the memory-mapped boxk'''
+        box.flush()
+        tasks = [('r2c_yz', box.filename, boxk.filename, x0, x1, self.threads)
+                 for x0, x1 in self._x_blocks()]
+        self.pool.map(_yz_pass, tasks, chunksize=1)
+        tasks = [('fft_x', boxk.filename, boxk.filename, y0, y1, self.threads)
+                 for y0, y1 in self._y_blocks()]
+        self.pool.map(_x_pass, tasks, chunksize=1)
+        return np.load(boxk.filename, mmap_mode='r+')
+
+    def backward(self, boxk, box):
+        '''c2r FFT of the memory-mapped boxk into the memory-mapped box.
+        boxk is left untouched, the x-pass goes through the scratch buffer'''
+        boxk.flush()
+        scratch = self.complex_buffer(self.scratch_path)
+        del scratch
+        tasks = [('ifft_x', boxk.filename, self.scratch_path, y0, y1, self.threads)
+                 for y0, y1 in self._y_blocks()]
+        self.pool.map(_x_pass, tasks, chunksize=1)
+        tasks = [('c2r_yz', self.scratch_path, box.filename, x0, x1, self.threads)
+                 for x0, x1 in self._x_blocks()]
+        self.pool.map(_yz_pass, tasks, chunksize=1)
+        return np.load(box.filename, mmap_mode='r+')
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for path in [self.real_path, self.cplx_path, self.scratch_path] + sorted(self.extra_paths):
+            if os.path.isfile(path):
+                os.remove(path)
+
@@ -0,0 +1,37 @@
+import unittest
+import numpy as np
+from SaclayMocks import grf
+
+
+class TestGRF(unittest.TestCase):
+
+    def test_hermitian(self):
+        # boxk is the rfftn of a real box: irfftn then rfftn gives it back
+        for NX, NY, NZ in [(8, 6, 10), (7, 5, 9), (6, 9, 8)]:
+            boxk = grf.draw_boxk(NX, NY, NZ, 5).astype(np.complex128)
+            box = np.fft.irfftn(boxk, s=(NX, NY, NZ))
+            np.testing.assert_allclose(np.fft.rfftn(box), boxk, rtol=0, atol=1e-10*np.abs(boxk).max())
+            # normalisation of the FFT of a N(0,1) box
+            self.assertAlmostEqual(box.std(), 1., delta=0.2)
+
+    def test_threads(self):
+        NX, NY, NZ = 13, 6, 8
+        box1 = grf.draw_box(NX, NY, NZ, 7, threads=1)
+        boxk1 = grf.draw_boxk(NX, NY, NZ, 7, threads=1)
+        for threads in [2, 3, 8]:
+            np.testing.assert_array_equal(grf.draw_box(NX, NY, NZ, 7, threads=threads), box1)
+            np.testing.assert_array_equal(grf.draw_boxk(NX, NY, NZ, 7, threads=threads), boxk1)
+        # planes drawn in any order, also in a non contiguous view
+        out = np.empty((NX, NY, NZ+2), dtype=np.float32)
+        for ix0, ix1 in [(9, 13), (0, 4), (4, 9)]:
+            grf.draw_planes(out[:, :, :NZ], ix0, ix1, 7, grf.REALSPACE)
+        np.testing.assert_array_equal(out[:, :, :NZ], box1)
+        # another seed or domain
+        self.assertFalse(np.any(grf.draw_box(NX, NY, NZ, 8) == box1))
+        out = np.empty((NX, NY, NZ), dtype=np.float32)
+        grf.draw_planes(out, 0, NX, 7, grf.KSPACE)
+        self.assertFalse(np.any(out == box1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import unittest
+import os
+import json
+import tempfile
+import shutil
+import numpy as np
+import fitsio
+from SaclayMocks import boxio
+from SaclayMocks import manifest
+
+
+def write_box(box, outDir, name, nfile, seed=1, options=None):
+    '''Slabs of box as make_boxes.py writes them: slab i holds the x-planes
+    [i*NX//nfile:(i+1)*NX//nfile]. Return their (i, filename, crc32)'''
+    NX, NY, NZ = box.shape
+    hdict = {'DX': 2., 'DY': 2., 'DZ': 2., 'NX': NX, 'NY': NY, 'NZ': NZ}
+    slabs = []
+    for i in range(nfile):
+        i0 = i*NX//nfile
+        i1 = (i+1)*NX//nfile
+        keys = [("seed", np.int32(seed), "seed")] if i == 0 else []
+        keys += [("SLABMEAN", float(box[i0:i1].mean()), "mean"),
+                 ("SLABVAR", float(box[i0:i1].var()), "var")]
+        filename = os.path.join(outDir, "{}-{}.fits".format(name, i))
+        slabs.append((i, filename, boxio.write_slab(box, filename, i0, i1, hdict, keys, options)))
+    return slabs
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.box = np.random.RandomState(0).normal(size=(10, 4, 6)).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_record(self):
+        m = manifest.Manifest(self.dir, seed=1)
+        m.set_plan(['box'], 10, run='r1')
+        slabs = write_box(self.box, self.dir, 'box', 4)
+        for i, filename, crc in slabs[:3]:
+            m.record('box', 'pk', 4, i, filename, crc)
+        self.assertEqual(m.missing('box', 'pk', 4), [3])
+        # another P(k) or number of slabs: all of them are redone
+        self.assertEqual(m.missing('box', 'pk2', 4), [0, 1, 2, 3])
+        self.assertEqual(m.missing('box', 'pk', 5), [0, 1, 2, 3, 4])
+        # the records are seen by a reader before the manifest is saved
+        reader = manifest.Manifest(self.dir)
+        self.assertEqual(reader.run, 'r1')
+        self.assertEqual(sorted(reader.fields['box']['slabs']), ['0', '1', '2'])
+        m.record('box', 'pk', 4, *slabs[3])
+        m.finish()
+        self.assertFalse(os.path.isfile(m.logname))
+        reader.reload()
+        self.assertEqual(reader.state, 'done')
+        self.assertEqual(reader.missing('box', 'pk', 4, verify=True), [])
+        # truncated and corrupted files
+        with open(slabs[1][1], 'ab') as f:
+            f.write(b'\0')
+        data = fitsio.read(slabs[2][1])
+        data[0, 0, 0] += 1
+        fitsio.write(slabs[2][1], data, clobber=True)
+        reader = manifest.Manifest(self.dir, seed=1)
+        self.assertEqual(reader.missing('box', 'pk', 4), [1])
+        self.assertEqual(reader.missing('box', 'pk', 4, verify=True), [1, 2])
+        # another seed
+        self.assertEqual(manifest.Manifest(self.dir, seed=2).fields, {})
+
+    def test_partial_log(self):
+        m = manifest.Manifest(self.dir, seed=1)
+        m.set_plan(['box'], 10)
+        slabs = write_box(self.box, self.dir, 'box', 2)
+        m.record('box', 'pk', 2, *slabs[0])
+        # line being written by make_boxes.py
+        line = json.dumps({'field': 'box', 'pk': 'pk', 'nHDU': 2, 'i': 1, 'file': 'box-1.fits'})
+        with open(m.logname, 'a') as f:
+            f.write(line[:20])
+        self.assertEqual(list(manifest.Manifest(self.dir).fields['box']['slabs']), ['0'])
+
+    def test_ready(self):
+        # slabs of unequal widths: bounds 0, 2, 5, 7, 10
+        m = manifest.Manifest(self.dir, seed=1)
+        m.set_plan(['box', 'eta'], 10)
+        slabs = write_box(self.box, self.dir, 'box', 4)
+        for i, filename, crc in slabs[:3]:
+            m.record('box', 'pk', 4, i, filename, crc)
+        self.assertTrue(m.ready(['box'], 0, 7))
+        self.assertTrue(m.ready(['box'], 5, 7))
+        self.assertFalse(m.ready(['box'], 5, 8))
+        self.assertFalse(m.ready(['box'], 9, 10))
+        # eta is planned but not written, other fields are ignored
+        self.assertFalse(m.ready(['box', 'eta'], 0, 2))
+        self.assertTrue(m.ready(['box', 'vx'], 0, 2))
+        m.record('box', 'pk', 4, *slabs[3])
+        self.assertTrue(m.ready(['box'], 0, 10))
+
+    def test_wait_slice(self):
+        m = manifest.Manifest(self.dir, seed=1)
+        m.set_plan(['box'], 10, run='r1')
+        slabs = write_box(self.box, self.dir, 'box', 4)
+        for i, filename, crc in slabs[:2]:
+            m.record('box', 'pk', 4, i, filename, crc)
+        reader = manifest.Manifest(self.dir)
+        reader.wait_slice(['box'], 0, 2, timeout=1, poll=0.1, run='r1')
+        # slice 1 (x-planes 5 to 10) needs slabs 2 and 3, and slab 1 with a halo
+        with self.assertRaises(RuntimeError):
+            reader.wait_slice(['box'], 1, 2, timeout=0.3, poll=0.1)
+        # manifest of another run
+        with self.assertRaises(RuntimeError):
+            reader.wait_slice(['box'], 0, 2, timeout=0.3, poll=0.1, run='r2')
+        m.finish('failed')
+        with self.assertRaises(RuntimeError):
+            reader.wait_slice(['box'], 1, 2, poll=0.1, run='r1')
+
+    def test_adopt(self):
+        m = manifest.Manifest(self.dir, seed=1)
+        m.set_plan(['box'], 10)
+        write_box(self.box, self.dir, 'box', 4)
+        hdict = {'DX': 2., 'DY': 2., 'DZ': 2., 'NX': 10, 'NY': 4, 'NZ': 6}
+        self.assertEqual(m.adopt('box', 'pk', 4, dict(hdict, NX=12)), [])
+        self.assertEqual(m.adopt('box', 'pk', 4, hdict), [0, 1, 2, 3])
+        self.assertEqual(manifest.Manifest(self.dir, seed=1).missing('box', 'pk', 4, verify=True), [])
+        # made with another seed
+        m = manifest.Manifest(self.dir, seed=2)
+        m.set_plan(['box'], 10)
+        self.assertEqual(m.adopt('box', 'pk', 4, hdict), [])
+
+
+class TestBoxIO(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.box = np.random.RandomState(1).normal(size=(10, 4, 6)).astype(np.float32)
+        self.hdict = {'DX': 2., 'DY': 2., 'DZ': 2., 'NX': 10, 'NY': 4, 'NZ': 6}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def check_read(self, reader, rtol=0, atol=0):
+        for ix0 in range(10):
+            for ix1 in range(ix0+1, 11):
+                np.testing.assert_allclose(reader.read(ix0, ix1), self.box[ix0:ix1], rtol=rtol, atol=atol)
+        for nslice in [1, 3, 4]:
+            data = np.concatenate([reader.read_slice(i, nslice) for i in range(nslice)])
+            np.testing.assert_allclose(data, self.box, rtol=rtol, atol=atol)
+
+    def test_fits(self):
+        for nfile in [1, 3, 4, 10]:
+            name = "box{}".format(nfile)
+            write_box(self.box, self.dir, name, nfile)
+            reader = boxio.BoxReader(self.dir, name)
+            self.assertEqual((reader.NX, reader.NY, reader.NZ, reader.DX), (10, 4, 6, 2.))
+            np.testing.assert_array_equal(reader.bounds, np.arange(nfile+1)*10//nfile)
+            self.check_read(reader)
+            moments = reader.moments(0, 10)
+            self.assertAlmostEqual(moments.mean, self.box.mean(), places=6)
+            self.assertAlmostEqual(moments.var, self.box.var(), places=6)
+            if nfile == 4:
+                self.assertEqual(reader.slabs(5, 8), (2, 4))
+                self.assertIsNone(reader.moments(1, 5))
+
+    def test_fits_manifest(self):
+        # the number of slabs comes from the manifest while they are written
+        m = manifest.Manifest(self.dir, seed=1)
+        m.set_plan(['box'], 10)
+        slabs = write_box(self.box, self.dir, 'box', 4)
+        for i, filename, crc in slabs:
+            m.record('box', 'pk', 4, i, filename, crc)
+        os.remove(slabs[0][1])
+        reader = boxio.BoxReader(self.dir, 'box')
+        np.testing.assert_array_equal(reader.bounds, [0, 2, 5, 7, 10])
+        np.testing.assert_array_equal(reader.read(5, 8), self.box[5:8])
+
+    def test_precision(self):
+        for precision, atol in [('float16', 2e-3), ('int16', 1e-4)]:
+            name = "box_" + precision
+            write_box(self.box, self.dir, name, 3, options={'precision': precision})
+            self.check_read(boxio.BoxReader(self.dir, name), atol=atol*np.abs(self.box).max())
+
+    def test_hdf5(self):
+        try:
+            import h5py
+        except ImportError:
+            self.skipTest("h5py is not installed")
+        keys = [("SLABMEAN", np.array([self.box[c:c+3].mean() for c in range(0, 10, 3)]), ""),
+                ("SLABVAR", np.array([self.box[c:c+3].var() for c in range(0, 10, 3)]), "")]
+        for precision, atol in [('float32', 0), ('int16', 1e-4)]:
+            name = "box_" + precision
+            crc = boxio.write_slab(self.box, os.path.join(self.dir, name+".h5"), 0, 10, self.hdict, keys,
+                                   {'chunk': 3, 'compression': 'gzip', 'precision': precision})
+            self.assertEqual(crc, manifest.checksum(manifest.read_data(os.path.join(self.dir, name+".h5"))))
+            self.assertTrue(boxio.exists(self.dir, name))
+            reader = boxio.BoxReader(self.dir, name)
+            np.testing.assert_array_equal(reader.bounds, [0, 3, 6, 9, 10])
+            self.check_read(reader, atol=atol*np.abs(self.box).max())
+            moments = reader.moments(3, 9)
+            self.assertAlmostEqual(moments.mean, self.box[3:9].mean(), places=6)
+            self.assertIsNone(reader.moments(2, 9))
+
+
+if __name__ == '__main__':
+    unittest.main()
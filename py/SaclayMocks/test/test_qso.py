@@ -0,0 +1,176 @@
+import unittest
+import numpy as np
+from scipy.stats import poisson
+from SaclayMocks import box
+from SaclayMocks import cosmology
+from SaclayMocks import qso
+
+
+class TestQSOSampler(unittest.TestCase):
+    '''QSOSampler on a small box: z = R/1000, the dN/dz acceptance is 0.05
+    below z = 3 and 1 above, and the QSO density is ptot = exp(g)'''
+    NX = 24
+    NZ = 48
+    DX = 10.
+    R0 = 3000.
+    norm = 0.3
+
+    def setUp(self):
+        self.x_axis = (np.arange(self.NX)+0.5)*self.DX - self.NX*self.DX/2
+        self.z_axis = (np.arange(self.NZ)+0.5)*self.DX + self.R0 - self.NZ*self.DX/2
+        self.zR = qso.tabulate(lambda R: R/1000., 0, 10000)
+        self.dz0 = 0.
+        self.ddz = 0.01
+        z = self.dz0 + self.ddz*np.arange(1000)
+        self.dn_cell = np.where(z < 3., 0.05, 1.)
+        g = np.random.RandomState(1).normal(0, 0.5, (self.NX, self.NX, self.NZ))
+        self.g = (g, np.zeros_like(g), np.zeros_like(g))
+        table = np.zeros((6, 2))
+        table[0] = 1.
+        table[3] = 1.
+        self.lognormal = (0., 0.1, table)
+
+    def sampler(self, **kwargs):
+        args = dict(seed=3, norm=self.norm, lognormal=self.lognormal,
+                    corr=qso.tabulate(np.ones_like, 0, 10))
+        args.update(kwargs)
+        return qso.QSOSampler(self.x_axis, self.x_axis, self.z_axis, self.DX, self.DX, self.DX,
+                              0., 0., 180., 90., 0., 10., self.zR, self.dn_cell, self.dz0,
+                              self.ddz, 1., **args)
+
+    def expected(self, poisson=False):
+        '''Expected number of objects: sum of p1*p2 (of norm*ptot*p2 if poisson)'''
+        x = self.x_axis.reshape(-1, 1, 1)
+        y = self.x_axis.reshape(1, -1, 1)
+        R = np.sqrt(x*x + y*y + self.z_axis**2)
+        p2 = self.dn_cell[np.rint((R/1000. - self.dz0)/self.ddz).astype(int)]
+        lam = self.norm*np.exp(self.g[0])
+        if not poisson:
+            lam = np.minimum(lam, 1.)
+        return (lam*p2).sum()
+
+    def check_mean(self, cat, poisson=False):
+        n = self.expected(poisson)
+        self.assertLess(abs(len(cat) - n), 5*np.sqrt(n))
+
+    def test_dense(self):
+        self.check_mean(self.sampler(sparse=0.).sample(self.g))
+
+    def test_sparse(self):
+        sampler = self.sampler(sparse=2.)
+        cat = sampler.sample(self.g)
+        self.check_mean(cat)
+        # about one random number per cell drawn with the bound of its plane
+        self.assertLess(sampler.nrandom, sampler.ncells)
+
+    def test_poisson(self):
+        sampler = self.sampler(poisson=True)
+        cat = sampler.sample(self.g)
+        self.check_mean(cat, poisson=True)
+        self.assertEqual(sampler.nrandom, sampler.ncells)
+
+    def test_block_size(self):
+        # some planes are dense, some sparse
+        cat1 = self.sampler(nblock=1).sample(self.g)
+        cat7 = self.sampler(nblock=7).sample(self.g)
+        self.assertGreater(len(cat1), 0)
+        np.testing.assert_array_equal(cat1, cat7)
+
+    def test_stats(self):
+        # in all the planes, whether drawn by geometric skipping or not
+        for sparse, full_stats in [(0., False), (2., True)]:
+            sampler = self.sampler(sparse=sparse, sat_norm=1., full_stats=full_stats)
+            sampler.sample(self.g)
+            self.assertEqual(sampler.nstats, sampler.ncells)
+            ptot = np.exp(self.g[0])
+            self.assertEqual(sampler.nnQSO, int(round(np.minimum(self.norm*ptot, 1).sum())))
+            self.assertAlmostEqual(sampler.rho_max, ptot.max())
+            self.assertEqual(sampler.n_saturated, (ptot > 1).sum())
+            self.assertAlmostEqual(sampler.sum_saturated, np.minimum(ptot, 1).sum())
+
+    def test_partial_stats(self):
+        # only in the planes drawn cell by cell (z > 3 here)
+        sampler = self.sampler(sat_norm=1.)
+        sampler.sample(self.g)
+        dense = [mz for mz in range(self.NZ) if sampler.dndz_bound(mz) >= sampler.sparse]
+        self.assertEqual(sampler.nstats, len(dense)*self.NX*self.NX)
+        self.assertLess(sampler.nstats, sampler.ncells)
+        ptot = np.exp(self.g[0][:, :, dense])
+        self.assertEqual(sampler.nnQSO, int(round(np.minimum(self.norm*ptot, 1).sum())))
+        self.assertEqual(sampler.n_saturated, (ptot > 1).sum())
+
+    def test_cuts(self):
+        for XX, YY, ZZ, ra, dec, z, z_rsd in self.sampler().sample(self.g):
+            self.assertLess(abs(XX), self.NX*self.DX/2)
+            self.assertLess(abs(ZZ - self.R0), self.NZ*self.DX/2)
+            self.assertAlmostEqual(z, np.sqrt(XX*XX + YY*YY + ZZ*ZZ)/1000.)
+            self.assertEqual(z, z_rsd)
+
+
+class TestKernels(unittest.TestCase):
+
+    def test_skip_cells(self):
+        generator = np.random.Generator(np.random.Philox(key=5))
+        n = 1000
+        for p in [0.003, 0.05, 0.5]:
+            hits = np.zeros(n)
+            ntrial = 400
+            for k in range(ntrial):
+                idx = qso.skip_cells(generator, p, n)
+                self.assertTrue(np.all(np.diff(idx) > 0))
+                self.assertTrue(np.all((idx >= 0) & (idx < n)))
+                hits[idx] += 1
+            # each cell is a success with probability p
+            mean = ntrial*n*p
+            self.assertLess(abs(hits.sum() - mean), 5*np.sqrt(mean))
+            self.assertLess(abs(hits[:n//2].sum() - mean/2), 5*np.sqrt(mean/2))
+        np.testing.assert_array_equal(qso.skip_cells(generator, 1., 10), np.arange(10))
+
+    def test_poisson(self):
+        # counts of the uniform quantiles u: Poisson inversion of the cdf
+        one = np.ones(1)
+        g = np.zeros((1, 1, 1))
+        table = (0., 1., one)
+        u = (np.arange(100000) + 0.5) / 100000
+        for lam in [0.05, 1., 3.7, 20.]:
+            n = np.array([qso.cell_count(0, 0, 0, v, 1., g, g, g, (0., 1., np.ones((6, 2))),
+                                         one, one, one, table, -1., one, 0., 1., table,
+                                         1., 1., True, lam, True, True)[0] for v in u])
+            pmf = np.bincount(n) / len(u)
+            np.testing.assert_allclose(pmf, poisson.pmf(np.arange(len(pmf)), lam), rtol=0, atol=2e-5)
+
+    def test_lerp(self):
+        x0, inv_dx, table = qso.tabulate(np.sin, 0.5, 2., n=100)
+        xx = np.linspace(0, 3, 1001)
+        grid = x0 + np.arange(len(table)) / inv_dx
+        out = np.empty(len(xx))
+        cosmology.lerp_array(xx, x0, inv_dx, table, out)
+        # constant beyond the ends of the table
+        np.testing.assert_allclose(out, np.interp(xx, grid, table), rtol=0, atol=1e-12)
+        rows = np.array([table, 2*table])
+        for x in xx:
+            i, w = qso.lerp_index(x, x0, inv_dx, len(table))
+            self.assertAlmostEqual(qso.row(rows, 1, i, w), 2*np.interp(x, grid, table))
+
+    def test_rescale(self):
+        table = qso.tabulate(np.sqrt, 0., 10.)
+        self.assertAlmostEqual(cosmology.lerp(7*0.7, *cosmology.rescale(table, 0.7)),
+                               cosmology.lerp(7, *table))
+
+    def test_ra_dec(self):
+        rng = np.random.RandomState(2)
+        x, y = rng.uniform(-1000, 1000, (2, 1000))
+        z = rng.uniform(-3000, 3000, 1000)
+        for ra0, dec0 in [(0., 0.), (2., 0.5), (5., -1.)]:
+            ra, dec, R = box.ComputeRaDecR2(x, y, z, ra0, dec0)
+            for i in range(len(x)):
+                r, d, RR = qso.ra_dec(x[i], y[i], z[i], ra0, dec0)
+                self.assertAlmostEqual(np.cos(r), np.cos(ra[i]))
+                self.assertAlmostEqual(np.sin(r), np.sin(ra[i]))
+                self.assertTrue(0 <= r < 2*np.pi)
+                self.assertAlmostEqual(d, dec[i])
+                self.assertAlmostEqual(RR, R[i], places=8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import tempfile
+import shutil
+import numpy as np
+from SaclayMocks import slabfft
+
+
+class TestSlabFFT(unittest.TestCase):
+    '''SlabFFT against numpy.fft in double precision. The slab transforms are
+    float32 FFTW ones, the tolerance is RTOL times the largest modulus'''
+    RTOL = 1e-5
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def check(self, NX, NY, NZ, nproc, block_mb):
+        box0 = np.random.RandomState(NX).normal(size=(NX, NY, NZ)).astype(np.float32)
+        fft = slabfft.SlabFFT(NX, NY, NZ, nproc, self.dir, block_mb=block_mb)
+        try:
+            box = fft.real_buffer()
+            box[:] = box0
+            boxk = fft.forward(box, fft.complex_buffer())
+            ref = np.fft.rfftn(box0.astype(np.float64))
+            np.testing.assert_allclose(boxk, ref, rtol=0, atol=self.RTOL*np.abs(ref).max())
+            # unnormalised: backward(forward(box)) = NX*NY*NZ * box
+            boxk[:] = ref
+            out = fft.backward(boxk, fft.real_buffer(1))
+            np.testing.assert_array_equal(boxk, ref.astype(np.complex64))
+            np.testing.assert_allclose(out / (NX*NY*NZ), box0, rtol=0, atol=self.RTOL*np.abs(box0).max())
+            return np.array(boxk)
+        finally:
+            fft.close()
+
+    def test_one_slab(self):
+        self.check(8, 6, 10, 1, 256)
+
+    def test_slabs(self):
+        # block_mb=0: slabs of one plane, NX and NY not divisible by nproc
+        for NX, NY, NZ, nproc in [(10, 7, 12, 3), (9, 5, 7, 2), (16, 16, 16, 4)]:
+            self.check(NX, NY, NZ, nproc, 0)
+
+    def test_decomposition(self):
+        # the slab decomposition only changes the output at the float32 rounding level
+        ref = self.check(10, 7, 12, 1, 256)
+        for nproc in [1, 3]:
+            boxk = self.check(10, 7, 12, nproc, 0)
+            np.testing.assert_allclose(boxk, ref, rtol=0, atol=self.RTOL*np.abs(ref).max())
+
+    def test_block_sizes(self):
+        self.assertEqual(slabfft.block_sizes(10, 7, 12, 0), (1, 1))
+        self.assertEqual(slabfft.block_sizes(10, 7, 12, 256), (10, 7))
+        nx, ny = slabfft.block_sizes(1024, 1024, 1024, 256)
+        self.assertLessEqual(2*1024*(1024*4 + 513*8)*nx, 256*2**20)
+        self.assertLessEqual(3*1024*513*8*ny, 256*2**20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -11,7 +11,9 @@ import sys
 from matplotlib import pyplot as plt
 import fitsio
 from SaclayMocks import constant
-import h5py
+from SaclayMocks import cosmology
+from SaclayMocks import footprint
+from SaclayMocks.cosmology import fgrowth
 try:
     import picca.wedgize
     use_picca = True
@@ -123,20 +125,6 @@ def diffmod(a,b,c) :
     return np.minimum(d,c-d)
 
 
-def fgrowth(z, Om0=constant.omega_M_0, unnormed=False):
-    # Assume flat lambda CDM cosmo, with only Om and Ol
-    # Comes from cosmolopy.perturbation
-    Om = 1 / (1 + (1 - Om0)/(Om0*(1+z)**3))
-    Ol = 1 - Om
-    a = 1 / (1+z)
-    if unnormed:
-        norm = 1.0
-    else:
-        norm = 1.0 / fgrowth(0.0, Om0, unnormed=True)
-    return (norm * (5./2.) * a * Om /
-            (Om**(4./7.) - Ol + (1. + Om/2.) * (1. + Ol/70.)))
-
-
 def primes(n):
     ''' decomposition in prime factors
     '''
@@ -350,26 +338,16 @@ def zeff(filename, rmin=80., rmax=120.):
     return np.sum(z[msk]*we[msk]) / np.sum(we[msk])
 
 
-class desi_footprint():
+class desi_footprint(footprint.Footprint):
     def __init__(self, filename="$SACLAYMOCKS_BASE/etc/desi-healpix-weights.fits"):
         '''
         return a mask to select only desi footprint
         from quickquasars script (desisim)
+        the mask is a cached bitmap, see SaclayMocks.footprint
         '''
         desi_nside =256  # same resolution as original map (cf quickquasars)
         self.desi_nside = desi_nside
-        if filename is None:
-            filename = os.path.expandvars("$SACLAYMOCKS_BASE/etc/desi-healpix-weights.fits")
-        pixmap = fitsio.read(filename, ext=0)
-        npix = len(pixmap)
-        truenside = hp.npix2nside(npix)
-        if truenside < desi_nside:
-            print("Warning downsampling is fuzzy...Passed nside={}, but file {} is stored at nside={}".format(truenside, filename, desi_nside))
-        healpix_weight = hp.pixelfunc.ud_grade(pixmap, desi_nside, order_in='NESTED', order_out='NESTED')
-        self.healpix_weight = healpix_weight
-    def selection(self, ra, dec):
-        healpix = radec2pix(self.desi_nside, ra, dec)
-        return np.where(self.healpix_weight[healpix] > 0.99)[0]
+        footprint.Footprint.__init__(self, filename, nside=desi_nside, threshold=0.99)
 
 
 def sigma_p1d(redshift=None, filename="$SACLAYMOCKS_BASE/etc/pkmiss_interp.fits.gz", p1dmiss=None, pixel=0.2, N=10000):
@@ -544,6 +522,7 @@ def extract_h5file(fname):
     This function creates a dictionnary that contains all the parameters
     stored in the h5file produced by picca
     '''
+    import h5py
     f = h5py.File(os.path.expandvars(fname),'r')
 
     free_p = [ el.decode('UTF-8') for el in f['best fit'].attrs['list of free pars'] ]
@@ -792,47 +771,12 @@ def loop_on_h5file(file_list, param, digits=5):
 
     return res
 
-class cosmo:
+class cosmo(cosmology.Cosmology):
     '''
     From picca.constant.py
     https://github.com/igmhub/picca/blob/master/py/picca/constants.py
+    The tables are built once and cached, see SaclayMocks.cosmology
     '''
-    def __init__(self, Om, Ok=0., Or=0., wl=-1., H0=100.):
-        ### Ignore evolution of neutrinos from matter to radiation
-        ### H0 in km/s/Mpc
-        c = constant.c
-        Ol = 1.-Ok-Om-Or
-
-        nbins = 10000
-        zmax = 10.
-        dz = zmax/nbins
-        z = sp.arange(nbins)*dz
-        hubble = H0*sp.sqrt( Ol*(1.+z)**(3.*(1.+wl)) + Ok*(1.+z)**2 + Om*(1.+z)**3 + Or*(1.+z)**4 )
-
-        chi = sp.zeros(nbins)
-        for i in range(1,nbins):
-            chi[i] = chi[i-1]+c*(1./hubble[i-1]+1./hubble[i])/2.*dz
-
-        self.r_comoving = interpolate.interp1d(z,chi)
-
-        ### dm here is the comoving angular diameter distance
-        if Ok==0.:
-            dm = chi
-        elif Ok<0.:
-            dm = sp.sin(H0*sp.sqrt(-Ok)/c*chi)/(H0*sp.sqrt(-Ok)/c)
-        elif Ok>0.:
-            dm = sp.sinh(H0*sp.sqrt(Ok)/c*chi)/(H0*sp.sqrt(Ok)/c)
-
-        self.hubble = interpolate.interp1d(z,hubble)
-        self.r_2_z = interpolate.interp1d(chi,z)
-
-        ### D_H
-        self.dist_hubble = interpolate.interp1d(z,c/hubble)
-        ### D_M
-        self.dm = interpolate.interp1d(z,dm)
-        ### D_V
-        y = sp.power(z*self.dm(z)**2*self.dist_hubble(z),1./3.)
-        self.dist_v = interpolate.interp1d(z,y)
 
 
 def kms2mpc(redshift, omega_m=None, omega_k=None, h=None):
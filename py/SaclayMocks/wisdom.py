@@ -0,0 +1,159 @@
+# FFTW wisdom manager
+# Wisdom is saved in one file per (CPU model, transform, shape, dtype,
+# threads, planner effort):
+#   <directory>/<cpu model>/<kind>.<shape>.<dtype>.<threads>.<effort>.npy
+# kind is r2c, c2r or c2c, followed by -inplace for in-place transforms and
+# by -axes<axes> for transforms over some of the axes only (the slabs of
+# SaclayMocks.slabfft), e.g. r2c-inplace or c2c-axes0.
+# directory is cache.directory("wisdom") by default ($SACLAYMOCKS_CACHE/wisdom
+# or $SACLAYMOCKS_BASE/etc/wisdom). The older
+# etc/wisdom.<shape>.<ncpu>.npy (make_boxes.py) and etc/wisdom1D_<ncpu>.npy
+# (merge_spectra.py) files are still read (FFTW_MEASURE only).
+# Planning without wisdom overwrites the arrays (except with FFTW_ESTIMATE),
+# so plans must be made before the arrays are filled: then the FFTs can no
+# longer produce null boxes. bin/fftw_wisdom.py pre-plans the shapes of a
+# production and benchmarks thread counts and planner efforts.
+import os
+import re
+import time
+import platform
+import numpy as np
+import pyfftw
+from SaclayMocks import cache
+
+
+EFFORTS = ['FFTW_ESTIMATE', 'FFTW_MEASURE', 'FFTW_PATIENT', 'FFTW_EXHAUSTIVE']
+
+
+#********************************************************************
+def cpu_model():
+    '''CPU model name, usable in a path'''
+    name = None
+    if os.path.isfile("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    name = line.split(":", 1)[1]
+                    break
+    if not name:
+        name = platform.processor() or platform.machine() or "unknown"
+    return "_".join(re.findall("[A-Za-z0-9.]+", name))
+
+
+def shape_str(shape):
+    return "-".join([str(n) for n in shape])
+
+
+def transform_kind(input_array, output_array, axes=None):
+    '''r2c, c2r or c2c, followed by -inplace if the arrays share their
+    memory and by -axes<axes> if axes are not all the axes of the arrays'''
+    if not np.iscomplexobj(input_array):
+        kind = 'r2c'
+    elif not np.iscomplexobj(output_array):
+        kind = 'c2r'
+    else:
+        kind = 'c2c'
+    if np.may_share_memory(input_array, output_array):
+        kind += '-inplace'
+    if axes is not None and sorted(axes) != list(range(input_array.ndim)):
+        kind += '-axes' + shape_str(axes)
+    return kind
+
+
+#********************************************************************
+class WisdomManager():
+    '''Load, plan and save FFTW wisdom for a given planner effort'''
+    def __init__(self, directory=None, effort='FFTW_MEASURE'):
+        if effort not in EFFORTS:
+            raise ValueError("Unknown planner effort {}, should be in {}".format(effort, EFFORTS))
+        if directory is None:
+            directory = cache.directory("wisdom")
+        self.directory = os.path.join(directory, cpu_model())
+        self.effort = effort
+
+    def filename(self, kind, shape, dtype, threads):
+        return os.path.join(self.directory, "{}.{}.{}.{}.{}.npy".format(
+            kind, shape_str(shape), np.dtype(dtype).name, threads, self.effort))
+
+    def legacy_filename(self, shape, threads):
+        '''wisdom.<shape>.<ncpu>.npy files of older make_boxes.py versions,
+        wisdom1D_<ncpu>.npy for the 1D FFTs of older merge_spectra.py ones'''
+        wisdom_path = os.path.expandvars("$SACLAYMOCKS_BASE/etc/")
+        if tuple(shape) == ('1d',):
+            return wisdom_path+"wisdom1D_"+str(threads)+".npy"
+        if len(shape) == 3 and shape[0] == shape[1] == shape[2]:
+            return wisdom_path+"wisdom."+str(shape[0])+"."+str(threads)+".npy"
+        return wisdom_path+"wisdom."+shape_str(shape)+"."+str(threads)+".npy"
+
+    def load(self, kind, shape, dtype, threads):
+        '''Import the wisdom of this transform, return True if found'''
+        filename = self.filename(kind, shape, dtype, threads)
+        # older versions only made out-of-place transforms over all the axes
+        if not os.path.isfile(filename) and self.effort == 'FFTW_MEASURE' and '-' not in kind:
+            filename = self.legacy_filename(shape, threads)
+        if not os.path.isfile(filename):
+            return False
+        pyfftw.import_wisdom(tuple(np.load(filename)))
+        return True
+
+    def save(self, kind, shape, dtype, threads):
+        filename = self.filename(kind, shape, dtype, threads)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # unique temporary name: several processes can save at once
+            tmp = filename + ".{}.tmp.npy".format(os.getpid())
+            np.save(tmp, pyfftw.export_wisdom())
+            os.replace(tmp, filename)
+        except OSError as e:
+            print("WARNING: wisdom not saved in {}: {}".format(filename, e))
+            return
+        print("Wisdom saved in {}".format(filename))
+
+    def plan(self, input_array, output_array, axes, direction='FFTW_FORWARD', threads=1):
+        '''pyfftw.FFTW plan of input_array -> output_array, destroying its
+        input. Without wisdom, planning overwrites both arrays: call it
+        before filling them. The new wisdom is saved.
+        The key of a real transform is the shape of its real array'''
+        kind = transform_kind(input_array, output_array, axes)
+        if kind.startswith('c2r'):
+            shape = output_array.shape
+            dtype = output_array.dtype
+        else:
+            shape = input_array.shape
+            dtype = input_array.dtype
+        found = self.load(kind, shape, dtype, threads)
+        t0 = time.time()
+        fft = None
+        if found:
+            try:
+                fft = pyfftw.FFTW(input_array, output_array, axes=axes, direction=direction,
+                                  threads=threads, flags=(self.effort, 'FFTW_DESTROY_INPUT', 'FFTW_WISDOM_ONLY'))
+            except RuntimeError:
+                # e.g. wisdom made for arrays of another alignment
+                found = False
+        if fft is None:
+            fft = pyfftw.FFTW(input_array, output_array, axes=axes, direction=direction,
+                              threads=threads, flags=(self.effort, 'FFTW_DESTROY_INPUT'))
+        if not found:
+            print("{} {} planned with {} in {} s".format(kind, shape_str(shape), self.effort, time.time()-t0))
+            if self.effort != 'FFTW_ESTIMATE':
+                self.save(kind, shape, dtype, threads)
+        return fft
+
+    def preplan(self, shape, threads, dtype=np.float32, inplace=False):
+        '''Plan (and save) the r2c and c2r transforms of a real box of this
+        shape, on temporary arrays. If inplace, the transforms are done in
+        a padded buffer, as make_boxes.py -inplace True'''
+        cdtype = np.result_type(dtype, np.complex64)
+        kshape = tuple(shape[:-1])+(shape[-1]//2+1,)
+        if inplace:
+            buf = pyfftw.empty_aligned(tuple(shape[:-1])+(2*kshape[-1],), dtype=dtype)
+            box = buf[..., :shape[-1]]
+            boxk = buf.view(cdtype)
+        else:
+            box = pyfftw.empty_aligned(shape, dtype=dtype)
+            boxk = pyfftw.empty_aligned(kshape, dtype=cdtype)
+        axes = tuple(range(len(shape)))
+        fft_r2c = self.plan(box, boxk, axes, 'FFTW_FORWARD', threads)
+        fft_c2r = self.plan(boxk, box, axes, 'FFTW_BACKWARD', threads)
+        return fft_r2c, fft_c2r